@@ -0,0 +1,95 @@
+from batch import haystack_paths, largest_first, load_checkpoint, run
+import xcorr
+import synthiq
+import unittest as ut
+import numpy as np
+import StringIO
+import tempfile
+import shutil
+import json
+import os
+
+class BatchFixture(ut.TestCase):
+    """Test fixture with a directory of cs16 captures of different size
+    that contain the same burst at known offsets"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.burst = synthiq.pattern(128, 1)
+        self.offsets = {}
+        for k, length in enumerate((3000, 9000, 5000)):
+            name = os.path.join(self.directory, 'cap{}.cs16'.format(k))
+            samples, offsets = synthiq.capture(length, self.burst, bursts=2,
+                                               snr=10, seed=k)
+            synthiq.write_cs16(name, samples)
+            self.offsets[name] = list(offsets)
+        self.names = sorted(self.offsets)
+        self.patterns = [xcorr.Pattern(self.burst, 'burst')]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_batch(self, paths, checkpoint=None):
+        out = StringIO.StringIO()
+        result = run(self.patterns, paths, out, checkpoint, 2, 0.5)
+        return result, [json.loads(line) for line in out.getvalue().splitlines()]
+
+class HaystackPathsExpandGlobsAndLists(BatchFixture):
+    def runTest(self):
+        listing = os.path.join(self.directory, 'list')
+        with open(listing, 'w') as fh:
+            fh.write(self.names[2] + '\n\n' + self.names[0] + '\n')
+        assert haystack_paths([os.path.join(self.directory, '*.cs16')]) == self.names
+        assert haystack_paths([self.names[1]], listing) == \
+            [self.names[1], self.names[2], self.names[0]]
+        assert haystack_paths(['missing', 'missing']) == ['missing']
+
+class LargestCapturesComeFirst(BatchFixture):
+    def runTest(self):
+        assert largest_first(self.names + ['missing']) == \
+            [self.names[1], self.names[2], self.names[0], 'missing']
+
+class BatchFindsBurstsInAllCaptures(BatchFixture):
+    def runTest(self):
+        (searched, found, failed), lines = self.run_batch(self.names + ['missing'])
+        assert (searched, found, failed) == (3, 6, 1)
+        for name in self.names:
+            assert [line['offset'] for line in lines
+                    if line['file'] == name] == self.offsets[name]
+        assert all(line['score'] > 0.5 for line in lines if 'score' in line)
+        assert [line['file'] for line in lines if 'error' in line] == ['missing']
+
+class BatchResumesFromCheckpoint(BatchFixture):
+    def runTest(self):
+        checkpoint = os.path.join(self.directory, 'checkpoint')
+        self.run_batch(self.names[:2], checkpoint)
+        assert load_checkpoint(checkpoint) == set(self.names[:2])
+        (searched, found, _), lines = self.run_batch(self.names, checkpoint)
+        assert searched == 1
+        assert set(line['file'] for line in lines) == set([self.names[2]])
+        assert load_checkpoint(checkpoint) == set(self.names)
+
+class PeaksAreWrittenBeforeTheCheckpoint(BatchFixture):
+    def runTest(self):
+        checkpoint = os.path.join(self.directory, 'checkpoint')
+        writes = []
+
+        class Recorder(object):
+            def write(self, data):
+                if data:
+                    writes.append((data, load_checkpoint(checkpoint)))
+
+            def flush(self):
+                pass
+
+        name = self.names[1]
+        run(self.patterns, [name], Recorder(), checkpoint, 1, 0.5,
+            block_size=2048)
+        # one write per block with a burst, while the capture is searched
+        assert len(writes) == 2
+        assert [json.loads(data)['offset'] for data, _ in writes] == \
+            self.offsets[name]
+        assert all(name not in done for _, done in writes)
+        assert load_checkpoint(checkpoint) == set([name])
+
+if __name__ == '__main__':
+    ut.main()
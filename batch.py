@@ -0,0 +1,228 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""\
+Search the same patterns in many captures
+
+Patterns are loaded and transformed once, before a pool of worker
+processes is forked that inherits them. Every worker searches whole
+captures, largest first so a long capture does not end up running
+alone at the end.
+
+Peaks are streamed as JSON lines, one object per peak with the capture
+name, pattern name, offset, position and score. Workers send the peaks
+of every block to the parent as soon as they are final, so lines of
+captures searched at the same time interleave and no capture is held in
+memory as a whole. Captures that fail are reported by a line with an
+error message.
+
+With a checkpoint file the names of all completed captures are appended
+to it once the sink of their peaks is closed, and a run that is
+restarted with the same checkpoint skips them. Peaks of a capture that
+was being searched when the run was interrupted may be written again.
+
+While metrics are collected (see hpmc.metrics), every worker sends the
+counters of a capture, its busy and CPU time with its peaks.
+"""
+
+import os
+import time
+import glob
+import json
+import Queue
+import logging
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+
+import iqfile
+import xcorr
+import peaks
+from hpmc import metrics
+
+# state inherited by the worker processes
+loaded = {}
+
+# seconds between checks of the pool while waiting for messages
+POLL_INTERVAL = 1.0
+
+
+def haystack_paths(names, list_file=None):
+    """Capture names from names, which may be glob patterns, and from
+    the lines of list_file, in order and without duplicates"""
+    if list_file:
+        with open(list_file, 'r') as listing:
+            names = list(names) + [line.strip() for line in listing
+                                   if line.strip()]
+    paths = []
+    seen = set()
+    for name in names:
+        matches = sorted(glob.glob(name)) if glob.has_magic(name) else [name]
+        for path in matches:
+            if path not in seen:
+                seen.add(path)
+                paths.append(path)
+    return paths
+
+
+def load_checkpoint(name):
+    """Names of the captures a checkpoint file lists as completed"""
+    if not name or not os.path.exists(name):
+        return set()
+    with open(name, 'r') as checkpoint:
+        return set(line.rstrip('\n') for line in checkpoint if line.strip())
+
+
+def largest_first(paths):
+    """paths sorted by decreasing file size, missing files last"""
+    def size(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return -1
+    return sorted(paths, key=size, reverse=True)
+
+
+class QueueSink(object):
+    """Sends the peaks of capture name to the parent process"""
+    def __init__(self, name):
+        self.name = name
+
+    def write(self, found):
+        """Add peaks"""
+        if len(found):
+            loaded['queue'].put(('peaks', self.name, found))
+
+    def close(self):
+        """Nothing to release"""
+        pass
+
+
+class JsonSink(object):
+    """Writes the peaks of capture name as JSON lines to the file object
+    out, which is shared by all captures"""
+    def __init__(self, out, name, names):
+        self.out = out
+        self.name = name
+        self.names = names
+        self.count = 0
+
+    def write(self, found):
+        """Add peaks"""
+        self.out.write(json_lines(self.name, found, self.names))
+        self.out.flush()
+        self.count += len(found)
+
+    def close(self):
+        """Leaves the shared output open"""
+        self.out.flush()
+
+
+def search_file(name):
+    """Searches the loaded patterns in capture name, sending its peaks
+    and finally ('done', name, frames, error message, metrics counters)
+    to the parent"""
+    began, cpu = time.time(), metrics.cpu_time()
+    try:
+        haystack = iqfile.IQFile(name)
+        read = lambda offset, n: iqfile.IQArray(haystack, offset, n,
+                                                loaded['dtype'])
+        peaks.search(read, 0, haystack.getnframes(), loaded['patterns'],
+                     loaded['threshold'], QueueSink(name),
+                     loaded['block_size'], xcorr.correlations,
+                     loaded['separation'], loaded['top'], loaded['subsample'])
+        result = name, haystack.getnframes(), None
+    except Exception, e:
+        result = name, 0, '{}: {}'.format(type(e).__name__, e)
+    metrics.add('worker_busy_seconds', time.time() - began)
+    metrics.add('worker_cpu_seconds', metrics.cpu_time() - cpu)
+    loaded['queue'].put(('done',) + result + (metrics.drain(),))
+
+
+def messages(queue, outcome, count):
+    """Messages of count searched captures from queue. outcome is the
+    AsyncResult of the searches, checked while no message arrives"""
+    while count > 0:
+        try:
+            message = queue.get(timeout=POLL_INTERVAL)
+        except Queue.Empty:
+            if outcome.ready():
+                # raises what failed in a worker
+                outcome.get()
+            continue
+        if message[0] == 'done':
+            count -= 1
+        yield message
+
+
+def json_lines(name, found, names):
+    """JSON lines of the peaks found in capture name"""
+    return ''.join(json.dumps(OrderedDict((
+        ('file', name),
+        ('pattern', names[peak['pattern']]),
+        ('offset', int(peak['offset'])),
+        ('position', float(peak['position'])),
+        ('score', float(peak['score']))))) + '\n' for peak in found)
+
+
+def run(patterns, paths, out, checkpoint=None, workers=None, threshold=0.5,
+        block_size=xcorr.BLOCK_SIZE, separation=None, top=None,
+        subsample=False, dtype=np.complex64):
+    """Searches xcorr.Patterns in the captures paths with workers
+    processes (default: one per core) and writes JSON lines to the file
+    object out. Captures are decoded to dtype. Returns (captures
+    searched, peaks found, failures)"""
+    done = load_checkpoint(checkpoint)
+    todo = largest_first([path for path in paths if path not in done])
+    if done:
+        logging.info("skipping {} completed captures".format(
+            len(paths) - len(todo)))
+
+    # transform the patterns once, the workers inherit the spectra
+    nfft = xcorr.fft_length(max(pattern.length for pattern in patterns))
+    for pattern in patterns:
+        pattern.spectrum(nfft)
+    queue = multiprocessing.Queue()
+    loaded.update(patterns=patterns, threshold=threshold,
+                  block_size=block_size, separation=separation, top=top,
+                  subsample=subsample, dtype=dtype, queue=queue)
+    names = [pattern.name for pattern in patterns]
+
+    searched = found = failed = 0
+    progress = open(checkpoint, 'a') if checkpoint else None
+    sinks = {}
+    # workers discard the metrics counted before they were forked
+    pool = multiprocessing.Pool(workers or None, metrics.drain)
+    try:
+        outcome = pool.map_async(search_file, todo, chunksize=1)
+        for message in messages(queue, outcome, len(todo)):
+            name = message[1]
+            if name not in sinks:
+                sinks[name] = JsonSink(out, name, names)
+            if message[0] == 'peaks':
+                sinks[name].write(message[2])
+                continue
+            _, _, frames, error, counters = message
+            metrics.merge(counters)
+            sink = sinks.pop(name)
+            sink.close()
+            if error is not None:
+                logging.error("{}: {}".format(name, error))
+                out.write(json.dumps(OrderedDict((('file', name),
+                                                  ('error', error)))) + '\n')
+                out.flush()
+                failed += 1
+                continue
+            if progress:
+                progress.write(name + '\n')
+                progress.flush()
+                os.fsync(progress.fileno())
+            searched += 1
+            found += sink.count
+            logging.info("{}: {} frames, {} peaks".format(name, frames,
+                                                          sink.count))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        if progress:
+            progress.close()
+    return searched, found, failed
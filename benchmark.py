@@ -0,0 +1,131 @@
+"""\
+Usage:  benchmark.py [-s SIZES] [-r REPEAT] [-p LENGTH] [-j WORKERS] [--seed SEED]
+                     [--only NAMES] [--dir DIR] [--out FILE]
+
+Times the hot paths of parseiq on deterministic synthetic captures and
+reports throughput in MSamples/s and peak RSS (including workers).
+
+Options:
+        -s SIZES    comma separated capture lengths in frames
+                    [default: 65536,262144,1048576]
+        -r REPEAT   runs per case, the fastest one is reported [default: 3]
+        -p LENGTH   pattern length in frames [default: 1024]
+        -j WORKERS  worker processes for correlation_index and convert,
+                    0 for one per core [default: 0]
+        --seed SEED     seed of the synthetic captures [default: 0]
+        --only NAMES    comma separated benchmarks to run (default: all)
+        --dir DIR       directory for the generated captures (default: a
+                        temporary directory that is removed afterwards)
+        --out FILE      write the results as JSON to FILE
+"""
+
+from docopt import docopt
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+import numpy as np
+
+import iqfile
+import iqdump
+import iq2npy
+import parseiq
+import synthiq
+from hpmc import profiler
+
+
+def measure(run, repeat):
+    """Returns (fastest seconds, peak RSS in bytes) of repeat calls of run"""
+    sampler = profiler.Sampler(interval=0.01)
+    sampler.start()
+    best = None
+    try:
+        for _ in range(repeat):
+            began = time.time()
+            run()
+            seconds = time.time() - began
+            best = seconds if best is None else min(best, seconds)
+    finally:
+        sampler.stop()
+    return best, int(sampler.recorder.arrays()[1].max())
+
+
+def cases(directory, size, pattern_length, workers, seed):
+    """Yields (name, run) of all benchmarks for captures of size frames"""
+    needle = synthiq.pattern(pattern_length, seed)
+    samples, _ = synthiq.capture(size, needle, seed=seed)
+    wav = os.path.join(directory, 'capture-{}.wav'.format(size))
+    npy = os.path.join(directory, 'capture-{}.npy'.format(size))
+    synthiq.write_wav(wav, samples)
+    haystack = iqfile.IQFile(wav)
+    widened = parseiq.read_n_iq_frames(haystack).astype(np.complex64)
+    pattern = widened[:pattern_length]
+
+    def dump(fmt):
+        with open(os.devnull, 'wb') as out:
+            iqdump.dump(haystack, out, fmt)
+
+    yield 'read_n_iq_frames', lambda: parseiq.read_n_iq_frames(haystack)
+    yield 'correlate', lambda: parseiq.correlate(widened, widened[::-1])
+    yield 'correlation_index', lambda: parseiq.correlation_index(
+        widened, pattern, workers)
+    yield 'iq2npy.convert', lambda: iq2npy.convert(wav, npy, workers=workers)
+    for fmt in ('text', 'cf32'):
+        yield 'dump.' + fmt, lambda fmt=fmt: dump(fmt)
+
+
+def revision():
+    """git commit of the benchmarked tree, None outside of a checkout"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=open(os.devnull, 'w'),
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """entry point"""
+    args = docopt(__doc__)
+    sizes = [int(size) for size in args['-s'].split(',')]
+    only = args['--only'].split(',') if args['--only'] else None
+    directory = args['--dir'] or tempfile.mkdtemp(prefix='piqbench')
+
+    results = []
+    try:
+        for size in sizes:
+            for name, run in cases(directory, size, int(args['-p']),
+                                   int(args['-j']), int(args['--seed'])):
+                if only and name not in only:
+                    continue
+                seconds, peak_rss = measure(run, int(args['-r']))
+                results.append({'name': name, 'frames': size,
+                                'seconds': seconds,
+                                'msamples_per_s': size / seconds / 1e6,
+                                'peak_rss': peak_rss})
+                print '{:<20} {:>10} frames {:>10.2f} MS/s {:>8.1f} MiB'.format(
+                    name, size, size / seconds / 1e6, peak_rss / 2.0 ** 20)
+                sys.stdout.flush()
+    finally:
+        if not args['--dir']:
+            shutil.rmtree(directory)
+
+    if args['--out']:
+        with open(args['--out'], 'w') as out:
+            json.dump({'revision': revision(),
+                       'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'machine': platform.machine(),
+                       'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+                       'seed': int(args['--seed']),
+                       'pattern': int(args['-p']),
+                       'repeat': int(args['-r']),
+                       'results': results}, out, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+from cfo import parse_range, segment_bounds, shift, Bank, search, CFO_DTYPE
+import xcorr
+import peaks
+import corrpool
+import synthiq
+import unittest as ut
+import numpy as np
+
+class ShiftedBurstFixture(ut.TestCase):
+    """Test fixture with a capture holding copies of a burst that are
+    shifted by a frequency offset"""
+    def setUp(self):
+        self.burst = synthiq.pattern(256, 3)
+        self.cycles = 0.003
+        shifted = self.burst * np.exp(2j * np.pi * self.cycles * np.arange(256))
+        self.samples, self.offsets = synthiq.capture(20000, shifted, bursts=3,
+                                                     snr=4, seed=5)
+        self.read = lambda offset, n: self.samples[offset:offset + n]
+        self.patterns = [xcorr.Pattern(self.burst, 'burst')]
+
+    def search(self, frequencies, **kwargs):
+        sink = peaks.ArraySink()
+        search(self.read, 0, len(self.samples), self.patterns, 0.5, sink,
+               block_size=4096, frequencies=frequencies, **kwargs)
+        return np.concatenate(sink.parts) if sink.parts else \
+            np.zeros(0, dtype=CFO_DTYPE)
+
+class ParseRangeIncludesBothEnds(ut.TestCase):
+    def runTest(self):
+        np.testing.assert_allclose(parse_range('-300:300:100'),
+                                   [-300, -200, -100, 0, 100, 200, 300])
+        np.testing.assert_allclose(parse_range('0.1:0.3:0.1'), [0.1, 0.2, 0.3])
+        assert list(parse_range('5:5:1')) == [5]
+        for text in ('1:2', '2:1:1', '0:1:0', 'a:b:c'):
+            with self.assertRaises(ValueError):
+                parse_range(text)
+
+class BankShiftsEveryPattern(ut.TestCase):
+    def runTest(self):
+        patterns = [xcorr.Pattern(np.ones(8, dtype=np.complex64), 'a'),
+                    xcorr.Pattern(np.ones(4), 'b')]
+        bank = Bank(patterns, [-100, 0, 250], rate=1000)
+        assert [member.name for member in bank.members] == \
+            ['a@-100', 'a@0', 'a@250', 'b@-100', 'b@0', 'b@250']
+        assert bank.members[0].dtype == np.complex64
+        np.testing.assert_allclose(bank.members[5].samples,
+                                   np.exp(0.5j * np.pi * np.arange(4)),
+                                   atol=1e-12)
+
+class SegmentsAreCombinedIntoTrials(ShiftedBurstFixture):
+    def runTest(self):
+        frequencies = parse_range('-0.004:0.004:0.00025')
+        bank = Bank(self.patterns, frequencies)
+        bounds = segment_bounds(256, 0.004)
+        assert len(bank.members) == len(bounds) - 1 < len(frequencies)
+        values = list(xcorr.correlations(self.samples, bank.members))
+        middles = (bounds[:-1] + bounds[1:] - 1) / 2.0
+        # trial 28 is the offset of the bursts
+        for trial in (0, 19, 32, 28):
+            # the pattern rotated by the trial offset at every segment centre
+            rotated = np.concatenate([
+                self.burst[first:last] * np.exp(2j * np.pi *
+                                                frequencies[trial] * middle)
+                for first, last, middle in zip(bounds[:-1], bounds[1:],
+                                               middles)])
+            expected = xcorr.normalized_correlation(self.samples, rotated)
+            combined = np.dot(bank.weights[0][trial], values)
+            np.testing.assert_allclose(combined, expected, atol=1e-12)
+        # bursts lose little against the exactly shifted pattern
+        shifted = xcorr.normalized_correlation(
+            self.samples, shift(self.patterns[0], self.cycles).samples)
+        scores = combined.real[self.offsets]
+        assert (scores >= 0.97 * shifted.real[self.offsets]).all()
+
+class OffsetBurstsAreMissedWithoutBank(ShiftedBurstFixture):
+    def runTest(self):
+        assert len(self.search([0.0])) == 0
+
+class BankFindsBurstsAndTheirOffset(ShiftedBurstFixture):
+    def runTest(self):
+        found = self.search(parse_range('-0.004:0.004:0.001'))
+        assert found.dtype == CFO_DTYPE
+        assert list(found['offset']) == list(self.offsets)
+        assert (found['pattern'] == 0).all()
+        np.testing.assert_allclose(found['frequency'], self.cycles)
+        assert (found['score'] > 0.75).all()
+
+class FinelySteppedBankFindsBursts(ShiftedBurstFixture):
+    def runTest(self):
+        found = self.search(parse_range('-0.004:0.004:0.00025'))
+        assert list(found['offset']) == list(self.offsets)
+        np.testing.assert_allclose(found['frequency'], self.cycles)
+        assert (found['score'] > 0.75).all()
+
+class UnshiftedTrialMatchesPlainSearch(ShiftedBurstFixture):
+    def runTest(self):
+        self.samples, self.offsets = synthiq.capture(20000, self.burst,
+                                                     bursts=3, seed=6)
+        found = self.search([0.0])
+        sink = peaks.ArraySink()
+        peaks.search(self.read, 0, len(self.samples), self.patterns, 0.5,
+                     sink, 4096)
+        plain = sink.result()
+        assert len(found) == 3
+        for name in peaks.PEAK_DTYPE.names:
+            np.testing.assert_array_equal(found[name], plain[name])
+
+class BankWorksWithCorrelationPool(ShiftedBurstFixture):
+    def runTest(self):
+        # shifted copies and segments
+        for text in ('0:0.004:0.001', '0:0.004:0.0002'):
+            frequencies = parse_range(text)
+            bank = Bank(self.patterns, frequencies)
+            with corrpool.CorrelationPool(bank.members, 2,
+                                          capacity=4096) as pool:
+                found = self.search(frequencies, bank=bank,
+                                    correlate=pool.correlations)
+            expected = self.search(frequencies)
+            assert len(found) == 3
+            for name in CFO_DTYPE.names:
+                np.testing.assert_allclose(found[name], expected[name])
+
+if __name__ == '__main__':
+    ut.main()
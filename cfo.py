@@ -0,0 +1,273 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""\
+Frequency offset tolerant pattern search
+
+A carrier frequency offset (CFO) between pattern and haystack rotates
+the products of the correlation and quickly destroys its peak. A Bank
+searches every pattern at a range of trial frequency offsets in one
+pass over the haystack, as a segmented matched filter:
+
+    The pattern is shifted to the centre of the range and split into
+    segments short enough that the remaining offset of any trial
+    rotates a segment by at most SEGMENT_DRIFT cycles. Every segment,
+    zero padded to the length of the pattern, is correlated with each
+    haystack block like a pattern of its own: the block is read,
+    decoded and transformed once, and every segment adds a spectrum
+    product and an inverse FFT. The normalized correlation with the
+    pattern shifted to a trial frequency is then a fixed linear
+    combination of the normalized segment correlations, a DFT across
+    the segments evaluated at the trial frequencies (see Bank). All
+    trials of a chunk of lags come out of one matrix product.
+
+The number of segments grows with the width of the frequency range in
+units of the resolution of the pattern (1 / its length), not with the
+number of trials: a few hundred Hz of drift against a pattern of a few
+hundred microseconds needs one to three segments, however finely the
+range is stepped. Treating every segment as rotated by the offset at
+its centre loses at most 1 - sinc(SEGMENT_DRIFT) (2.6%) of the
+correlation at the ends of the range and nothing at its centre. Where
+the range is so wide that a pattern would need as many segments as
+there are trials, the bank correlates exactly shifted copies of the
+pattern instead.
+
+The correlation values of all trials form an offset x lag surface per
+pattern, which is reduced to the best trial of every lag before the
+peaks are extracted.
+
+Frequencies are in Hz for captures that record their sampling rate,
+in cycles per frame otherwise. Peaks carry the frequency offset of the
+trial that matched best, the offset of the haystack against the pattern.
+"""
+
+import sys
+import itertools
+import numpy as np
+
+import xcorr
+import peaks
+
+CFO_DTYPE = np.dtype(peaks.PEAK_DTYPE.descr + [('frequency', np.float64)])
+
+# largest rotation (in cycles) of a pattern segment by the offset of a
+# trial from the centre of the range
+SEGMENT_DRIFT = 0.125
+
+# number of lags combined into trial values at a time
+COMBINE_CHUNK = 1 << 14
+
+
+def parse_range(text):
+    """Trial frequencies of a LOW:HIGH:STEP range, both ends included"""
+    try:
+        low, high, step = [float(part) for part in text.split(':')]
+    except ValueError:
+        raise ValueError('frequency range {} is not LOW:HIGH:STEP'.format(text))
+    if step <= 0 or high < low:
+        raise ValueError('frequency range {} is empty'.format(text))
+    count = int(np.floor((high - low) / step + 1e-9)) + 1
+    return low + step * np.arange(count)
+
+
+def shift(pattern, cycles, name=None):
+    """xcorr.Pattern of pattern shifted by cycles per frame"""
+    phase = 2 * np.pi * cycles * np.arange(pattern.length)
+    samples = (pattern.samples * np.exp(1j * phase)).astype(pattern.dtype)
+    return xcorr.Pattern(samples, name)
+
+
+def segment_bounds(length, residual):
+    """Boundaries of the segments of a pattern of length frames which
+    the largest residual frequency offset (in cycles per frame) rotates
+    by at most SEGMENT_DRIFT cycles each"""
+    count = max(1, int(np.ceil(length * residual / SEGMENT_DRIFT - 1e-9)))
+    return np.linspace(0, length, count + 1).round().astype(int)
+
+
+class Bank(object):
+    """A pattern search at every trial frequency (in Hz with a rate, in
+    cycles per frame otherwise). members holds the patterns that are
+    correlated with the haystack: the segments of the first pattern,
+    then those of the second and so on. counts holds the number of
+    members per pattern.
+
+    weights holds per pattern the (trials x segments) matrix that turns
+    the normalized correlations of its segments into those of the
+    pattern at every trial frequency: with segment m spanning the
+    frames around t[m] and c[k] the offset of trial k from the centre
+    of the range, weights[k, m] = exp(-2j pi c[k] t[m]) * std(segment
+    m) / std(pattern at trial k). The pattern means drop out of the
+    combination. None marks a pattern whose members are exactly shifted
+    copies, one per trial"""
+    def __init__(self, patterns, frequencies, rate=0):
+        self.patterns = patterns
+        self.frequencies = np.asarray(frequencies, dtype=np.float64)
+        self.trials = len(self.frequencies)
+        cycles = self.frequencies / rate if rate else self.frequencies
+        centre = (cycles.max() + cycles.min()) / 2
+        residuals = cycles - centre
+        self.members = []
+        self.counts = []
+        self.weights = []
+        for pattern in patterns:
+            bounds = segment_bounds(pattern.length, np.abs(residuals).max())
+            if len(bounds) - 1 >= self.trials:
+                members = [shift(pattern, c, '{}@{:g}'.format(pattern.name, f))
+                           for c, f in zip(cycles, self.frequencies)]
+                weights = None
+            else:
+                members, weights = self.segments(pattern, bounds, centre,
+                                                 residuals)
+            self.members += members
+            self.counts.append(len(members))
+            self.weights.append(weights)
+
+    @staticmethod
+    def segments(pattern, bounds, centre, residuals):
+        """(members, weights) of pattern split at bounds"""
+        centred = shift(pattern, centre)
+        members = []
+        for m, (first, last) in enumerate(zip(bounds[:-1], bounds[1:])):
+            samples = np.zeros(pattern.length, dtype=centred.samples.dtype)
+            samples[first:last] = centred.samples[first:last]
+            members.append(xcorr.Pattern(samples,
+                                         '{}#{}'.format(pattern.name, m)))
+
+        middles = (bounds[:-1] + bounds[1:] - 1) / 2.0
+        rotations = np.exp(-2j * np.pi * np.outer(residuals, middles))
+        means = np.array([member.mean for member in members])
+        stds = np.array([member.std for member in members])
+        wide = centred.samples.astype(np.complex128)
+        power = np.mean(np.square(wide.real) + np.square(wide.imag))
+        # segments do not overlap, the power of the pattern is the same
+        # at every trial
+        trial_means = np.dot(rotations.conjugate(), means)
+        trial_stds = np.sqrt(np.maximum(
+            power - np.square(np.abs(trial_means)), 0.0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weights = rotations * stds / trial_stds[:, np.newaxis]
+        # undefined like the correlation with a constant pattern
+        weights[trial_stds == 0] = np.nan
+        return members, weights.astype(centred.dtype)
+
+    def combine(self, k, values):
+        """Best trial value and trial id (k * trials + trial) at every lag
+        of pattern k, given the correlation values of its members. Trial
+        values are combined in the precision of the values, one chunk of
+        lags at a time, and only the best one is kept"""
+        weights = self.weights[k]
+        if weights is None:
+            best = np.array(values[0])
+            scores = peaks.score(best)
+            trials = np.zeros(len(best), dtype=np.int32)
+            for trial, candidate in enumerate(values[1:], 1):
+                candidate_scores = peaks.score(candidate)
+                better = candidate_scores > scores
+                best[better] = candidate[better]
+                scores[better] = candidate_scores[better]
+                trials[better] = trial
+            return best, trials + k * self.trials
+
+        count = len(values[0])
+        best = np.empty(count, dtype=values[0].dtype)
+        trials = np.empty(count, dtype=np.int32)
+        # trials at which the pattern is constant never match
+        rows = np.flatnonzero(~np.isnan(weights).any(axis=1))
+        if not len(rows):
+            best.fill(np.nan)
+            trials.fill(k * self.trials)
+            return best, trials
+        weights = weights[rows].astype(best.dtype, copy=False)
+        # the real parts of all trial values, from real and imaginary
+        # parts of the segment values
+        scoring = np.concatenate((weights.real.T, -weights.imag.T))
+        for first in range(0, count, COMBINE_CHUNK):
+            last = min(count, first + COMBINE_CHUNK)
+            parts = np.array([part[first:last] for part in values])
+            scores = np.dot(np.concatenate((parts.real, parts.imag)).T,
+                            scoring)
+            # windows without variance are NaN at every trial
+            chosen = np.argmax(scores, axis=1)
+            best[first:last] = np.einsum('ij,ji->i', weights[chosen], parts)
+            trials[first:last] = rows[chosen]
+        return best, trials + k * self.trials
+
+    def annotate(self, found):
+        """CFO_DTYPE records of peaks found with trial ids as pattern"""
+        result = np.zeros(len(found), dtype=CFO_DTYPE)
+        for name in peaks.PEAK_DTYPE.names:
+            result[name] = found[name]
+        result['pattern'] = found['pattern'] // self.trials
+        result['frequency'] = self.frequencies[found['pattern'] % self.trials]
+        return result
+
+
+def best_trials(blocks, bank):
+    """Reduces the (offset, member, values) blocks of the bank members to
+    (offset, pattern index, values, trial ids) of the best trial at
+    every lag"""
+    owners = [k for k, count in enumerate(bank.counts) for _ in range(count)]
+    pending = []
+    for position, (offset, _, values) in enumerate(blocks):
+        pending.append(values)
+        k = owners[position % len(owners)]
+        if len(pending) == bank.counts[k]:
+            best, trials = bank.combine(k, pending)
+            pending = []
+            yield offset, k, best, trials
+
+
+def search(read, start, count, patterns, threshold, sink,
+           block_size=xcorr.BLOCK_SIZE, correlate=xcorr.correlations,
+           separation=None, top=None, subsample=False, ranges=None,
+           frequencies=(0.0,), rate=0, bank=None):
+    """Frequency offset tolerant drop-in for peaks.search. Every pattern
+    is searched at all trial frequencies, correlate() has to work with
+    the members of the Bank (default: Bank(patterns, frequencies,
+    rate)). Peaks are written to sink as CFO_DTYPE records with the
+    frequency of the best trial. Returns the number of peaks"""
+    if bank is None:
+        bank = Bank(patterns, frequencies, rate)
+    if ranges is None:
+        ranges = [(start, count)]
+
+    detectors = [peaks.PeakDetector(threshold, separation or pattern.length,
+                                     top, subsample, k)
+                 for k, pattern in enumerate(patterns)]
+    blocks = itertools.chain.from_iterable(
+        xcorr.correlation_blocks(read, first, frames, bank.members,
+                                 block_size, correlate)
+        for first, frames in ranges)
+
+    def found():
+        for offset, k, values, members in best_trials(blocks, bank):
+            yield detectors[k].feed(offset, values, members)
+        for detector in detectors:
+            yield detector.flush()
+
+    total = 0
+    for records in found():
+        if len(records):
+            sink.write(bank.annotate(records))
+            total += len(records)
+    return total
+
+
+class CsvSink(peaks.CsvSink):
+    """Writes frequency offset tolerant peaks as CSV lines with the
+    frequency offset"""
+    header = 'pattern,offset,position,score,real,imag,frequency\n'
+
+    def line(self, peak):
+        """CSV line of a peak"""
+        return peaks.CsvSink.line(self, peak)[:-1] + ',{:.6g}\n'.format(
+            peak['frequency'])
+
+
+def open_sink(name, names):
+    """Sink for frequency offset tolerant peaks: NPY for names ending in
+    .npy, CSV otherwise, CSV on stdout for '-'"""
+    if name == '-':
+        return CsvSink(sys.stdout, names)
+    if name.endswith('.npy'):
+        return peaks.NpySink(name, CFO_DTYPE)
+    return CsvSink(open(name, 'w'), names)
@@ -0,0 +1,116 @@
+from corrpool import CorrelationPool, chunks
+import xcorr
+import unittest as ut
+import numpy as np
+import tempfile
+import iqfile
+import os
+import signal
+from hpmc import metrics
+
+class RandomIQFixture(ut.TestCase):
+    """Test fixture with a random haystack and two needles"""
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.haystack = (rng.randn(20000) + 1j * rng.randn(20000))
+        self.needles = [xcorr.Pattern(self.haystack[3000:3100]),
+                        xcorr.Pattern(self.haystack[7000:7020])]
+
+class ChunksCoverRangeWithoutGaps(ut.TestCase):
+    def runTest(self):
+        ranges = list(chunks(10000, 4, 100))
+        assert ranges[0] == (0, 1250)
+        assert ranges[-1][1] == 10000
+        for previous, current in zip(ranges, ranges[1:]):
+            assert previous[1] == current[0]
+            assert current[1] - current[0] <= previous[1] - previous[0]
+
+class PoolMatchesSingleProcess(RandomIQFixture):
+    def runTest(self):
+        with CorrelationPool(self.needles, 3, capacity=20000) as pool:
+            values = pool.correlations(self.haystack)
+        for needle, value in zip(self.needles, values):
+            np.testing.assert_allclose(
+                value, xcorr.normalized_correlation(self.haystack, needle),
+                rtol=1e-9, atol=1e-9)
+
+class PoolReadsBlocksOfSourceInPlace(RandomIQFixture):
+    def runTest(self):
+        source = np.memmap(tempfile.TemporaryFile(), dtype=np.complex128,
+                           mode='w+', shape=self.haystack.shape)
+        source[:] = self.haystack
+        with CorrelationPool(self.needles, 2, source=source,
+                             capacity=5000) as pool:
+            assert pool.locate(source[4000:9099]) == 4000
+            assert pool.locate(self.haystack[4000:9099]) is None
+            values = pool.correlations(source[4000:9099], count=5000)
+        np.testing.assert_allclose(
+            values[0], xcorr.normalized_correlation(self.haystack[4000:9099],
+                                                    self.needles[0]),
+            rtol=1e-9, atol=1e-9)
+        assert len(values[1]) == 5000
+
+class PoolWorkersWidenLazyBlocksOfSourceFile(RandomIQFixture):
+    def runTest(self):
+        frames = np.round(100 * np.column_stack((self.haystack.real,
+                                                 self.haystack.imag)))
+        name = tempfile.mktemp(suffix='.cs16')
+        frames.astype('<i2').tofile(name)
+        try:
+            source = iqfile.IQFile(name)
+            block = iqfile.IQArray(source, 4000, 5099)
+            with CorrelationPool(self.needles, 2, source=source,
+                                 capacity=5000) as pool:
+                assert pool.locate(block) == 4000
+                values = pool.correlations(block, count=5000)
+            np.testing.assert_allclose(
+                values[0], xcorr.normalized_correlation(np.asarray(block),
+                                                        self.needles[0]),
+                rtol=1e-9, atol=1e-9)
+        finally:
+            os.unlink(name)
+
+class PoolRejectsBlocksAboveCapacity(RandomIQFixture):
+    def runTest(self):
+        with CorrelationPool(self.needles, 1, capacity=100) as pool:
+            self.assertRaises(ValueError, pool.correlations, self.haystack)
+
+class PoolWithSourceRejectsOtherBlocks(RandomIQFixture):
+    def runTest(self):
+        with CorrelationPool(self.needles, 1, source=self.haystack,
+                             capacity=5000) as pool:
+            assert pool.input is None
+            self.assertRaises(ValueError, pool.correlations,
+                              self.haystack[:5099].copy())
+
+class DeadWorkerFailsTheSearch(RandomIQFixture):
+    def runTest(self):
+        with CorrelationPool(self.needles, 1, capacity=20000) as pool:
+            os.kill(pool.processes[0].pid, signal.SIGKILL)
+            pool.processes[0].join()
+            self.assertRaises(RuntimeError, pool.correlations, self.haystack)
+
+class PoolWorkersReportMetrics(RandomIQFixture):
+    def runTest(self):
+        name = tempfile.mktemp(suffix='.npy')
+        np.save(name, self.haystack.astype(np.complex64))
+        try:
+            source = iqfile.IQFile(name)
+            collected = metrics.start()
+            try:
+                with CorrelationPool(self.needles, 2, source=source,
+                                     capacity=20000) as pool:
+                    pool.correlations(iqfile.IQArray(source))
+            finally:
+                metrics.stop()
+            counters = collected.report()['counters']
+            # every worker reads the frames of its own chunks
+            assert counters['read_frames'] >= len(self.haystack)
+            assert counters['pool_tasks'] >= 2
+            assert counters['worker_busy_seconds'] > 0
+            assert counters['pool_wait_seconds'] > 0
+        finally:
+            os.unlink(name)
+
+if __name__ == '__main__':
+    ut.main()
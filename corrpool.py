@@ -0,0 +1,208 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""\
+Worker pool for the normalized cross-correlation
+
+Workers are forked once and keep their prepared patterns. Haystack data
+is never pickled: it is either read straight from a source that existed
+before the fork (the memmap of the input file, or an iqfile.IQFile whose
+16 bit frames each worker widens for its own chunk) or from an input
+buffer in anonymous shared memory. Workers pull chunks of offsets
+from a queue, chunk sizes shrink as the job nears completion so the load
+balances, and every worker writes its values directly into a shared
+output array. A worker that dies (e.g. killed by the OOM killer) fails
+the search instead of leaving the caller waiting for its results.
+
+While metrics are collected (see hpmc.metrics), workers send the time
+they spent on and waiting for tasks, their CPU time and the frames they
+read with every result, and the time the caller waits for the results
+of a block is counted as pool_wait_seconds.
+"""
+
+import mmap
+import time
+import Queue
+import multiprocessing
+import numpy as np
+
+import iqfile
+import xcorr
+from hpmc import metrics
+
+# smallest chunk handed to a worker, in overlap-save segments
+MIN_CHUNK_SEGMENTS = 4
+
+# seconds between liveness checks of the workers while waiting for results
+POLL_INTERVAL = 1.0
+
+
+def shared_array(shape, dtype):
+    """Allocates a numpy array in anonymous memory that is shared with
+    processes forked afterwards"""
+    dtype = np.dtype(dtype)
+    count = int(np.prod(shape))
+    buf = mmap.mmap(-1, max(1, count * dtype.itemsize))
+    return np.frombuffer(buf, dtype=dtype, count=count).reshape(shape)
+
+
+def chunks(count, workers, minimum):
+    """Splits range(count) into guided chunks: each chunk is a share of
+    the remaining work, but never less than minimum offsets"""
+    first = 0
+    while first < count:
+        size = max(minimum, (count - first) // (2 * workers))
+        yield first, min(count, first + size)
+        first += size
+
+
+class CorrelationPool(object):
+    """Pool of processes correlating patterns with haystack blocks.
+    source is an optional array (e.g. a memmap) that blocks may be views
+    of, or an iqfile.IQFile that blocks may be iqfile.IQArray ranges of;
+    those are read by the workers themselves, and then blocks must be.
+    Without a source blocks are copied to shared memory. capacity is the
+    largest number of offsets correlated per block"""
+    def __init__(self, patterns, workers=None, source=None,
+                 capacity=xcorr.BLOCK_SIZE):
+        self.patterns = xcorr.as_patterns(patterns)
+        self.longest = max(pattern.length for pattern in self.patterns)
+        self.nfft = xcorr.fft_length(self.longest)
+        self.minimum = MIN_CHUNK_SEGMENTS * (self.nfft - self.longest + 1)
+        self.workers = workers or multiprocessing.cpu_count()
+        self.source = source
+        self.capacity = capacity
+        self.dtype = xcorr.result_dtype(self.patterns)
+        if isinstance(source, iqfile.IQFile):
+            self.read = lambda offset, n: source.iq(offset, n, self.dtype)
+        else:
+            self.read = lambda offset, n: source[offset:offset + n]
+
+        for pattern in self.patterns:
+            pattern.spectrum(self.nfft)
+
+        # blocks and values are kept in the precision of the patterns
+        self.input = None
+        if source is None:
+            self.input = shared_array((capacity + self.longest - 1,),
+                                      self.dtype)
+        self.output = shared_array((len(self.patterns), capacity), self.dtype)
+
+        self.tasks = multiprocessing.Queue()
+        self.done = multiprocessing.Queue()
+        self.processes = []
+        for _ in range(self.workers):
+            process = multiprocessing.Process(target=self.work)
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Stops all workers"""
+        # a dead worker may have taken the queue's lock with it
+        alive = all(process.is_alive() for process in self.processes)
+        for process in self.processes:
+            if alive:
+                self.tasks.put('STOP')
+            else:
+                process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+    def work(self):
+        """Worker process main loop"""
+        # the parent already counted what was collected before the fork
+        metrics.drain()
+        waited = time.time()
+        for task in iter(self.tasks.get, 'STOP'):
+            base, length, first, last, counts = task
+            if metrics.active:
+                began, cpu = time.time(), metrics.cpu_time()
+                metrics.add('worker_idle_seconds', began - waited)
+            try:
+                span = min(length, last + self.longest - 1) - first
+                if base is None:
+                    block = self.input[first:first + span]
+                else:
+                    block = self.read(base + first, span)
+                values = xcorr.correlations(block, self.patterns, self.nfft,
+                                            last - first)
+                for k, count in enumerate(counts):
+                    chunk = next(values)[:max(0, count - first)]
+                    self.output[k, first:first + len(chunk)] = chunk
+                error = None
+            except Exception, e:
+                error = e
+            if metrics.active:
+                waited = time.time()
+                metrics.add('worker_busy_seconds', waited - began)
+                metrics.add('worker_cpu_seconds', metrics.cpu_time() - cpu)
+                metrics.add('pool_tasks')
+            self.done.put((last - first, error, metrics.drain()))
+
+    def check(self):
+        """Raises RuntimeError if a worker is no longer running"""
+        for process in self.processes:
+            if not process.is_alive():
+                raise RuntimeError('correlation worker {} exited with code {}'
+                                   .format(process.pid, process.exitcode))
+
+    def locate(self, block):
+        """Returns the offset of block within source, or None if block is
+        not a contiguous view or lazy range of source"""
+        if isinstance(block, iqfile.IQArray):
+            return block.offset if block.file is self.source else None
+        if (self.source is None or isinstance(self.source, iqfile.IQFile)
+                or not isinstance(block, np.ndarray)
+                or block.dtype != self.source.dtype
+                or not block.flags.c_contiguous
+                or not np.may_share_memory(block, self.source)):
+            return None
+        offset, remainder = divmod(block.ctypes.data - self.source.ctypes.data,
+                                   block.itemsize)
+        if remainder or offset < 0 or offset + len(block) > len(self.source):
+            return None
+        return offset
+
+    def correlations(self, haystack, patterns=None, nfft=None, count=None):
+        """Drop-in parallel replacement for xcorr.correlations over the
+        pool's patterns. The returned arrays are views into the shared
+        output buffer and are only valid until the next call"""
+        counts = [max(0, len(haystack) - pattern.length + 1)
+                  for pattern in self.patterns]
+        if count is not None:
+            counts = [min(count, n) for n in counts]
+        total = max(counts)
+        if total > self.capacity:
+            raise ValueError('block exceeds pool capacity')
+
+        base = self.locate(haystack)
+        if base is None:
+            if self.input is None:
+                raise ValueError('block is not part of the pool source')
+            self.input[:len(haystack)] = np.asarray(haystack)
+
+        for first, last in chunks(total, self.workers, self.minimum):
+            self.tasks.put((base, len(haystack), first, last, counts))
+
+        error = None
+        began = time.time()
+        while total > 0:
+            try:
+                size, result, counters = self.done.get(timeout=POLL_INTERVAL)
+            except Queue.Empty:
+                self.check()
+                continue
+            metrics.merge(counters)
+            error = error or result
+            total -= size
+        metrics.add('pool_wait_seconds', time.time() - began)
+        if error is not None:
+            raise error
+
+        return [self.output[k, :n] for k, n in enumerate(counts)]
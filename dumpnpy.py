@@ -1,25 +1,31 @@
 """\
-Usage:  dumpnpy.py FILE
+Usage:  dumpnpy.py [-o OFFSET] [-f FRAMES] [--format FORMAT] FILE
 
 Arguments:
-        FILE    NPY file to dump
+        FILE    NPY file to dump (or raw complex64, cs16, 16 bit I/Q WAV)
+
+Options:
+        -o OFFSET   Number of frames to skip [default: 0]
+        -f FRAMES   Limit number of frames to dump
+        --format FORMAT  complex, text (I Q columns), csv, raw (as stored),
+                    cf32 or cs16 [default: complex]
 """
 
 from docopt import docopt
 import sys
-import numpy as np
+
+import iqfile
+import iqdump
 
 def main():
     """entry point"""
     args = docopt(__doc__)
-    data = np.memmap(args['FILE'], dtype=np.complex64, mode='r')
-
-    for v in np.nditer(data, flags=['external_loop', 'buffered'], op_flags=['readonly']):
-        print v
+    iqdump.dump(iqfile.IQFile(args['FILE']), sys.stdout, args['--format'],
+                int(args['-o']), int(args['-f']) if args['-f'] else None)
 
 
 if __name__ == '__main__':
     try:
         main()
     except Exception, e:
-        print 'ERROR: ' + e
+        print >> sys.stderr, 'ERROR: ' + str(e)
@@ -0,0 +1,133 @@
+from follow import growth, sample_blocks, search
+from iqfile import IQFile
+from iqindex import sidecar_name
+from docopt import docopt
+import parseiq
+import piq
+import peaks
+import reftick
+import xcorr
+import synthiq
+import unittest as ut
+import numpy as np
+import threading
+import tempfile
+import shutil
+import time
+import os
+
+class RecorderFixture(ut.TestCase):
+    """Test fixture with a capture that a recorder thread writes to a WAV
+    file in chunks that do not line up with blocks or bursts"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.name = os.path.join(self.directory, 'live.wav')
+        self.burst = synthiq.pattern(300, 4)
+        self.samples, _ = synthiq.capture(30000, self.burst, bursts=5, seed=8)
+        # a short burst at the very end only the short pattern reaches
+        short = synthiq.pattern(40, 5)
+        self.samples[-45:-5] += 1000 * short
+        self.frames = synthiq.frames(self.samples)
+        self.patterns = [xcorr.Pattern(self.burst, 'long'),
+                         xcorr.Pattern(short, 'short')]
+        synthiq.write_wav(self.name, self.samples[:0])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def record(self, chunk=777, pause=0.005):
+        def write():
+            with open(self.name, 'ab') as out:
+                for first in range(0, len(self.frames), chunk):
+                    out.write(self.frames[first:first + chunk].tostring())
+                    out.flush()
+                    time.sleep(pause)
+        recorder = threading.Thread(target=write)
+        recorder.start()
+        return recorder
+
+class FollowedSearchMatchesSearchOfFinishedCapture(RecorderFixture):
+    def runTest(self):
+        recorder = self.record()
+        live = peaks.ArraySink()
+        search(None, 0, None, self.patterns, 0.5, live, block_size=4096,
+               iq_file=IQFile(self.name), poll=0.002, idle=0.1)
+        recorder.join()
+
+        haystack = IQFile(self.name)
+        read = lambda offset, n: haystack.iq(offset, n)
+        finished = peaks.ArraySink()
+        peaks.search(read, 0, haystack.getnframes(), self.patterns, 0.5,
+                     finished, block_size=4096)
+        live, finished = live.result(), finished.result()
+        assert len(finished) == 6 and finished['pattern'][-1] == 1
+        order = np.lexsort((live['offset'], live['pattern']))
+        expected = np.lexsort((finished['offset'], finished['pattern']))
+        for name in ('pattern', 'offset'):
+            np.testing.assert_array_equal(live[name][order],
+                                          finished[name][expected])
+        np.testing.assert_allclose(live['score'][order],
+                                   finished['score'][expected], rtol=1e-5)
+
+class SampleBlocksCoverAppendedFrames(RecorderFixture):
+    def runTest(self):
+        recorder = self.record(chunk=5000)
+        blocks = list(sample_blocks(IQFile(self.name), 100, 3000, 0.002, 0.1))
+        recorder.join()
+        assert [offset for offset, _ in blocks] == \
+            list(np.cumsum([100] + [len(samples) for _, samples in blocks[:-1]]))
+        np.testing.assert_array_equal(
+            np.concatenate([samples for _, samples in blocks]),
+            IQFile(self.name).iq(100))
+
+class FollowedTicksMatchTicksOfFinishedCapture(RecorderFixture):
+    def runTest(self):
+        noise = synthiq.noise(np.random.RandomState(3), len(self.frames))
+        self.frames = synthiq.frames(100 * noise)
+        for first in range(1000, len(self.frames), 3000):
+            self.frames[first:first + 8] = 10000
+        recorder = self.record()
+        live = np.concatenate(list(reftick.track_ticks(
+            sample_blocks(IQFile(self.name), 0, 4096, 0.002, 0.1), 8, 10)))
+        recorder.join()
+        assert list(live['offset']) == range(1000, 30000, 3000)
+
+class GrowthStopsWhenIdle(RecorderFixture):
+    def runTest(self):
+        began = time.time()
+        assert list(growth(IQFile(self.name), 0.01, 0.05)) == [0]
+        assert time.time() - began < 1
+
+class IndexedSearchesCannotFollow(RecorderFixture):
+    def runTest(self):
+        self.record(chunk=len(self.frames), pause=0).join()
+        pattern = os.path.join(self.directory, 'burst.npy')
+        np.save(pattern, self.burst)
+        arguments = docopt(parseiq.__doc__, ['search', '--index', '--follow',
+                                             self.name, pattern])
+        self.assertRaises(ValueError, parseiq.run, arguments)
+        arguments = docopt(piq.__doc__, ['findpattern', '--index', '--follow',
+                                         pattern, self.name])
+        self.assertRaises(ValueError, piq.Piq(arguments).dispatch)
+        # rejected before the index was built
+        assert not os.path.exists(sidecar_name(self.name))
+
+class GrowingNpyIsMappedBeyondItsHeader(ut.TestCase):
+    def runTest(self):
+        handle, name = tempfile.mkstemp('.npy')
+        os.close(handle)
+        try:
+            samples = np.arange(20, dtype=np.complex64)
+            np.save(name, samples[:8])
+            with open(name, 'ab') as out:
+                out.write(samples[8:13].tostring() + '\0\0\0')
+            iq_file = IQFile(name)
+            np.testing.assert_array_equal(iq_file.iq(), samples[:13])
+            with open(name, 'ab') as out:
+                out.write('\0' * 5 + samples[14:20].tostring())
+            assert iq_file.refresh() == 20
+        finally:
+            os.unlink(name)
+
+if __name__ == '__main__':
+    ut.main()
@@ -0,0 +1,123 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""\
+Live processing of captures that are still being recorded
+
+The size of the capture is polled every `poll` seconds; the process
+sleeps in between, so following an idle recorder costs next to no CPU.
+Whenever the file grew it is mapped again (see iqfile.IQFile.refresh)
+and only the new frames are processed.
+
+Correlation continues exactly where the last refresh stopped: the
+offsets computed so far are those at which every pattern fitted into
+the capture, and the next block starts at the first missing one, re-
+reading the len(pattern)-1 frames of overlap it needs. The peak
+detectors keep their context, so a peak that straddles a refresh is
+found once, like in a search of the finished file. A frame is correlated
+at most `poll` seconds (plus the time to correlate) after it has been
+written; a peak is final once `separation` more offsets are known.
+
+Following stops when the file did not grow for `idle` seconds (never
+with 0) or on Ctrl-C, and what is still pending is processed and
+flushed as if the capture had ended there.
+"""
+
+import os
+import time
+
+import iqfile
+import xcorr
+import peaks
+from hpmc import metrics
+
+# seconds between two checks of the file size
+POLL = 1.0
+
+
+def growth(iq_file, poll=POLL, idle=0):
+    """Yields the number of frames of an iqfile.IQFile, then again every
+    time it grew. Stops after idle seconds without growth (never with 0)
+    or on Ctrl-C"""
+    size = None
+    quiet = 0.0
+    try:
+        while True:
+            current = os.path.getsize(iq_file.name)
+            if current != size:
+                size = current
+                quiet = 0.0
+                yield iq_file.refresh()
+            elif idle and quiet >= idle:
+                return
+            time.sleep(poll)
+            quiet += poll
+    except KeyboardInterrupt:
+        return
+
+
+def sample_blocks(iq_file, start=0, block_size=1 << 20, poll=POLL, idle=0,
+                  dtype=None):
+    """Yields consecutive (offset, samples) blocks of at most block_size
+    frames from start as they are appended to iq_file"""
+    position = start
+    for end in growth(iq_file, poll, idle):
+        while position < end:
+            frames = min(block_size, end - position)
+            yield position, iq_file.iq(position, frames, dtype)
+            position += frames
+
+
+def correlation_blocks(iq_file, start, needles, block_size=xcorr.BLOCK_SIZE,
+                       correlate=xcorr.correlations, poll=POLL, idle=0,
+                       dtype=None):
+    """xcorr.correlation_blocks over the frames from start of a capture
+    that is growing. Yields (offset, pattern, values) as soon as the
+    frames they need were written"""
+    patterns = xcorr.as_patterns(needles)
+    longest = max(pattern.length for pattern in patterns)
+    shortest = min(pattern.length for pattern in patterns)
+    nfft = xcorr.fft_length(longest)
+    if dtype is None:
+        dtype = xcorr.result_dtype(patterns)
+
+    position = start
+    end = start
+    for end in growth(iq_file, poll, idle):
+        # only offsets at which every pattern fits, so that no pattern is
+        # ahead of the others when the next frames arrive
+        while end - position >= longest:
+            count = min(block_size, end - position - longest + 1)
+            block = iqfile.IQArray(iq_file, position, count + longest - 1,
+                                   dtype)
+            values = iter(correlate(block, patterns, nfft, count))
+            for pattern in patterns:
+                yield position, pattern, next(values)
+            metrics.add('correlated_frames', count)
+            position += count
+
+    # the capture ended: offsets only the shorter patterns reach
+    if end - position >= shortest:
+        block = iqfile.IQArray(iq_file, position, end - position, dtype)
+        values = iter(correlate(block, patterns, nfft))
+        for pattern in patterns:
+            yield position, pattern, next(values)
+        metrics.add('correlated_frames', end - position - shortest + 1)
+
+
+def search(read, start, count, patterns, threshold, sink,
+           block_size=xcorr.BLOCK_SIZE, correlate=xcorr.correlations,
+           separation=None, top=None, subsample=False, ranges=None,
+           iq_file=None, poll=POLL, idle=0, dtype=None):
+    """Drop-in for peaks.search that follows iq_file from start while it
+    is recorded, writing peaks to sink as soon as they are final. read
+    and count are not used, frames are read from iq_file as they are
+    written. Returns the number of peaks"""
+    if ranges is not None:
+        raise ValueError('a capture that is recorded cannot be indexed')
+    blocks = correlation_blocks(iq_file, start, patterns, block_size,
+                                correlate, poll, idle, dtype)
+    total = 0
+    for found in peaks.extract(blocks, patterns, threshold, separation, top,
+                               subsample):
+        sink.write(found)
+        total += len(found)
+    return total
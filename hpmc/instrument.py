@@ -0,0 +1,88 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""\
+Run a command under the profiling options of the command line tools
+
+run() calls the function that carries out a command of parseiq.py or
+piq.py with whatever was asked for on the command line: memory sampling
+(see profiler, --profile-out), metrics (see metrics, --metrics-out) and
+cProfile (--cprofile). The reports are written when the function
+returns or fails.
+"""
+
+import logging
+import cProfile
+
+import profiler
+import metrics
+
+
+def run(function, args=(), profile_out=None, metrics_out=None,
+        cprofile_out=None, namespace='parseiq', labels=None):
+    """Calls function(*args), writing a memory profile to profile_out,
+    metrics (in namespace, with labels) to metrics_out and cProfile
+    statistics to cprofile_out for those that are given. Returns the
+    result of function"""
+    if profile_out:
+        profiler.start()
+    if metrics_out:
+        metrics.start(namespace, labels)
+    cprofile = cProfile.Profile() if cprofile_out else None
+    try:
+        if cprofile:
+            return cprofile.runcall(function, *args)
+        return function(*args)
+    finally:
+        if cprofile:
+            cprofile.dump_stats(cprofile_out)
+            logging.info("cProfile statistics written to {}".format(
+                cprofile_out))
+        if metrics_out:
+            report = metrics.stop().write(metrics_out)
+            logging.info("{:.3f}s, {:.3f}s CPU, metrics written to {}".format(
+                report['seconds'], report['cpu_seconds'], metrics_out))
+        if profile_out:
+            report = profiler.stop().write(profile_out)
+            logging.info("peak RSS {} bytes, profile written to {}".format(
+                report['peak_rss'], profile_out))
+
+
+if __name__ == '__main__':
+    import unittest as ut
+    import tempfile
+    import shutil
+    import pstats
+    import json
+    import os
+
+    class ReportsAreWrittenAfterTheRun(ut.TestCase):
+        def setUp(self):
+            self.directory = tempfile.mkdtemp()
+
+        def tearDown(self):
+            shutil.rmtree(self.directory)
+
+        def runTest(self):
+            names = [os.path.join(self.directory, name)
+                     for name in ('metrics.json', 'cprofile.out')]
+
+            def count(n):
+                metrics.add('read_frames', n)
+                return n
+
+            assert run(count, (7,), None, *names,
+                       labels={'command': 'count'}) == 7
+            report = json.load(open(names[0]))
+            assert report['counters'] == {'read_frames': 7}
+            assert report['labels'] == {'command': 'count'}
+            assert pstats.Stats(names[1]).total_calls > 0
+            assert metrics.active is None
+
+    class ReportsAreWrittenWhenTheRunFails(ReportsAreWrittenAfterTheRun):
+        def runTest(self):
+            name = os.path.join(self.directory, 'metrics.prom')
+            self.assertRaises(ZeroDivisionError, run, lambda: 1 / 0,
+                              metrics_out=name, namespace='piq')
+            assert 'piq_run_seconds' in open(name).read()
+            assert metrics.active is None
+
+    ut.main()
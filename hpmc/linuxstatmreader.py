@@ -20,6 +20,36 @@ Measure process memory consumption using Linux' /proc/<pid>/statm
 
 
 import os
+import glob
+
+# bytes per page, the unit of all statm values
+PAGESIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def children(pid):
+    """Returns the pids of the child processes of pid"""
+    found = []
+    listings = glob.glob('/proc/{}/task/*/children'.format(pid))
+    if listings:
+        for name in listings:
+            try:
+                with open(name, 'r') as listing:
+                    found.extend(int(x) for x in listing.read().split())
+            except IOError:
+                pass
+        return found
+
+    # kernels without CONFIG_PROC_CHILDREN: scan the parent of every process
+    for name in glob.glob('/proc/[0-9]*/stat'):
+        try:
+            with open(name, 'r') as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except (IOError, IndexError):
+            continue
+        if int(fields[1]) == pid:
+            found.append(int(name.split('/')[2]))
+    return found
+
 
 class LinuxStatmReader(object):
     keys = ['size', 'resident', 'share', 'text', 'lib', 'data', 'dt']
@@ -32,7 +62,7 @@ class LinuxStatmReader(object):
     def readstatm(self):
         """Read data from /proc/<pid>/statm and return it as string"""
         lines = []
-        with open('/proc/{}/statm'.format(pid), 'r') as statm:
+        with open('/proc/{}/statm'.format(self.pid), 'r') as statm:
             lines = statm.readlines()
         return lines[0]
         
@@ -42,6 +72,13 @@ class LinuxStatmReader(object):
         values = [int(x) for x in self.readstatm().split(" ")]
         return dict(zip(LinuxStatmReader.keys, values))
 
+    def resident(self):
+        """Resident set size in bytes, 0 if the process is gone"""
+        try:
+            return int(self.readstatm().split(" ")[1]) * PAGESIZE
+        except (IOError, IndexError):
+            return 0
+
 if __name__ == '__main__':
     import unittest as ut
     from mock import Mock
@@ -56,6 +93,25 @@ if __name__ == '__main__':
         def runTest(self):
             assert lsr(123).pid == 123
     
+    class ALinuxStatmReaderReadsItsOwnProcess(ut.TestCase):
+        def runTest(self):
+            assert lsr().get()['resident'] > 0
+            assert lsr().resident() == lsr().get()['resident'] * PAGESIZE
+
+    class ALinuxStatmReaderReportsNoMemoryForAMissingProcess(ut.TestCase):
+        def runTest(self):
+            assert lsr(1 << 30).resident() == 0
+
+    class ChildrenListsForkedProcesses(ut.TestCase):
+        def runTest(self):
+            pid = os.fork()
+            if pid == 0:
+                os._exit(0)
+            try:
+                assert pid in children(os.getpid())
+            finally:
+                os.waitpid(pid, 0)
+
     class MockedLSR(ut.TestCase):
         def setUp(self):
             self.mylsr = lsr()
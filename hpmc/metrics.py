@@ -0,0 +1,322 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""\
+Counters and per stage CPU time of a run, for dashboards
+
+Metrics accumulate named counters (frames and bytes read, seconds spent
+decoding, waiting for or working in the correlation pool, ...) and,
+following the stage markers and timed sections of the profiler, the
+wall clock and CPU time (user + system, os.times()) of every stage and
+exclusive section. Stages also report the counters that grew during
+them and the rate of correlated frames.
+
+CPU time is that of the process itself. Worker processes inherit the
+active metrics when they are forked; they drain() the counters they
+inherited, add their own (busy, idle and CPU seconds, frames they read)
+and send drain() with every result, which the parent merge()s. Counters
+may overlap sections: decoding happens inside the correlate section.
+
+The module keeps a single active Metrics. add() and the profiler markers
+cost a global lookup while no metrics are collected, so they may be
+called unconditionally on the hot path (once per block, not per sample).
+
+write() exports the report as JSON or, for names ending in .prom, in the
+Prometheus text format, for the textfile collector of node_exporter.
+"""
+
+import os
+import json
+import time
+import threading
+
+# description of the counters, the HELP lines of the Prometheus export
+COUNTERS = {
+    'read_frames': 'Frames read from captures',
+    'read_bytes': 'Bytes read from captures',
+    'decode_seconds': 'Time widening frames to complex samples, including '
+                      'faulting in pages that were not read ahead',
+    'correlated_frames': 'Haystack offsets correlated with all patterns',
+    'prefetch_read_seconds': 'Time the prefetch thread spent reading ahead',
+    'prefetch_stall_seconds': 'Time the search waited for a prefetched block',
+    'pool_wait_seconds': 'Time the search waited for the correlation pool',
+    'pool_tasks': 'Chunks correlated by pool workers',
+    'worker_busy_seconds': 'Time workers spent on tasks',
+    'worker_idle_seconds': 'Time workers waited for tasks',
+    'worker_cpu_seconds': 'CPU time of workers',
+}
+
+
+def cpu_time():
+    """User and system CPU time of the process so far"""
+    times = os.times()
+    return times[0] + times[1]
+
+
+class Metrics(object):
+    """Counters and wall clock and CPU time per stage and section"""
+    def __init__(self, namespace='parseiq', labels=None):
+        self.namespace = namespace
+        self.labels = labels or {}
+        self.counters = {}
+        self.stages = []
+        self.sections = {}
+        self.stack = []
+        self.lock = threading.Lock()
+        self.began = None
+        self.end = None
+
+    def start(self, name='start'):
+        """Start timing with a first stage"""
+        self.began = time.time()
+        self.began_cpu = cpu_time()
+        self.stage(name)
+
+    def stop(self):
+        """End the last stage"""
+        self.end = time.time()
+        self.end_cpu = cpu_time()
+        self.end_counters = dict(self.counters)
+
+    def add(self, name, value=1):
+        """Add value to counter name"""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def drain(self):
+        """Counters added since the last drain(), which are reset"""
+        with self.lock:
+            counters, self.counters = self.counters, {}
+        return counters
+
+    def merge(self, counters):
+        """Add counters, as returned by drain() in a worker"""
+        for name, value in counters.items():
+            self.add(name, value)
+
+    def stage(self, name):
+        """Mark the beginning of stage name, ending the previous one"""
+        with self.lock:
+            counters = dict(self.counters)
+        self.stages.append((name, time.time(), cpu_time(), counters))
+
+    def enter(self, name):
+        """Begin a timed section"""
+        now = (time.time(), cpu_time())
+        if self.stack:
+            self.charge(now)
+        self.stack.append([name, now])
+
+    def leave(self):
+        """End the innermost timed section"""
+        now = (time.time(), cpu_time())
+        self.charge(now)
+        self.stack.pop()
+        if self.stack:
+            self.stack[-1][1] = now
+
+    def charge(self, now):
+        """Charge wall and CPU time since the last switch to the innermost
+        section"""
+        name, since = self.stack[-1]
+        seconds, cpu = self.sections.get(name, (0.0, 0.0))
+        self.sections[name] = (seconds + now[0] - since[0],
+                               cpu + now[1] - since[1])
+        self.stack[-1][1] = now
+
+    def report(self):
+        """Dict with the counters, the per stage time, counter growth and
+        correlation rate, and the section totals"""
+        ends = [stage[1:] for stage in self.stages[1:]] + \
+            [(self.end, self.end_cpu, self.end_counters)]
+        stages = []
+        rated = correlated = 0.0
+        for (name, began, cpu, counters), end in zip(self.stages, ends):
+            grown = dict((key, value - counters.get(key, 0))
+                         for key, value in end[2].items()
+                         if value != counters.get(key, 0))
+            stage = {'name': name,
+                     'start': began - self.began,
+                     'seconds': end[0] - began,
+                     'cpu_seconds': end[1] - cpu,
+                     'counters': grown}
+            if grown.get('correlated_frames') and stage['seconds'] > 0:
+                stage['frames_per_second'] = \
+                    grown['correlated_frames'] / stage['seconds']
+                rated += stage['seconds']
+                correlated += grown['correlated_frames']
+            stages.append(stage)
+        return {'labels': self.labels,
+                'seconds': self.end - self.began,
+                'cpu_seconds': self.end_cpu - self.began_cpu,
+                'frames_per_second': correlated / rated if rated else None,
+                'counters': self.end_counters,
+                'stages': stages,
+                'sections': dict((name, {'seconds': seconds,
+                                         'cpu_seconds': cpu})
+                                 for name, (seconds, cpu)
+                                 in self.sections.items())}
+
+    def prometheus(self, report=None):
+        """Report in the Prometheus text exposition format"""
+        report = report or self.report()
+        lines = []
+
+        def metric(name, kind, text, samples):
+            name = '{}_{}'.format(self.namespace, name)
+            lines.append('# HELP {} {}'.format(name, text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                labels = dict(self.labels, **labels)
+                pairs = ','.join('{}="{}"'.format(key, str(labels[key]).replace(
+                    '\\', '\\\\').replace('"', '\\"'))
+                    for key in sorted(labels))
+                lines.append('{}{} {!r}'.format(
+                    name, '{' + pairs + '}' if pairs else '', float(value)))
+
+        metric('run_seconds', 'gauge', 'Wall clock time of the run',
+               [({}, report['seconds'])])
+        metric('run_cpu_seconds', 'gauge', 'CPU time of the run',
+               [({}, report['cpu_seconds'])])
+        if report['frames_per_second'] is not None:
+            metric('frames_per_second', 'gauge',
+                   'Correlated frames per second of the stages correlating',
+                   [({}, report['frames_per_second'])])
+        for name in sorted(report['counters']):
+            metric(name + '_total', 'counter',
+                   COUNTERS.get(name, name.replace('_', ' ')),
+                   [({}, report['counters'][name])])
+
+        # stages that were entered more than once are summed up
+        seconds, cpu = {}, {}
+        for stage in report['stages']:
+            seconds[stage['name']] = seconds.get(stage['name'], 0.0) + \
+                stage['seconds']
+            cpu[stage['name']] = cpu.get(stage['name'], 0.0) + \
+                stage['cpu_seconds']
+        metric('stage_seconds', 'gauge', 'Wall clock time per stage',
+               [({'stage': name}, seconds[name]) for name in sorted(seconds)])
+        metric('stage_cpu_seconds', 'gauge', 'CPU time per stage',
+               [({'stage': name}, cpu[name]) for name in sorted(cpu)])
+        sections = report['sections']
+        if sections:
+            metric('section_seconds', 'gauge', 'Wall clock time per section',
+                   [({'section': name}, sections[name]['seconds'])
+                    for name in sorted(sections)])
+            metric('section_cpu_seconds', 'gauge', 'CPU time per section',
+                   [({'section': name}, sections[name]['cpu_seconds'])
+                    for name in sorted(sections)])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, name):
+        """Write the report to file name, in the Prometheus text format if
+        name ends in .prom, as JSON otherwise, and return it. The file is
+        replaced atomically, a collector never reads a partial one"""
+        report = self.report()
+        temporary = '{}.{}.tmp'.format(name, os.getpid())
+        with open(temporary, 'w') as out:
+            if name.endswith('.prom'):
+                out.write(self.prometheus(report))
+            else:
+                json.dump(report, out, indent=1, sort_keys=True)
+        os.rename(temporary, name)
+        return report
+
+
+# the counters and profiler markers are reported to
+active = None
+
+
+def start(namespace='parseiq', labels=None):
+    """Start the active metrics"""
+    global active
+    active = Metrics(namespace, labels)
+    active.start()
+    return active
+
+
+def stop():
+    """Stop and return the active metrics"""
+    global active
+    metrics, active = active, None
+    if metrics:
+        metrics.stop()
+    return metrics
+
+
+def add(name, value=1):
+    """Add value to counter name, if collecting metrics"""
+    if active:
+        active.add(name, value)
+
+
+def drain():
+    """Counters added since the last drain(), None if not collecting"""
+    if active:
+        return active.drain()
+
+
+def merge(counters):
+    """Add counters returned by drain() in a worker, if collecting"""
+    if active and counters:
+        active.merge(counters)
+
+
+if __name__ == '__main__':
+    import unittest as ut
+
+    class CountersAreIgnoredWithoutMetrics(ut.TestCase):
+        def runTest(self):
+            add('read_frames', 10)
+            merge({'read_frames': 1})
+            assert drain() is None
+
+    class StagesReportTimeAndCounterGrowth(ut.TestCase):
+        def runTest(self):
+            metrics = start(labels={'command': 'test'})
+            add('read_frames', 5)
+            metrics.stage('search')
+            add('correlated_frames', 1000)
+            sum(i * i for i in xrange(1000000))
+            stop()
+            report = metrics.report()
+            first, search = report['stages']
+            assert first['counters'] == {'read_frames': 5}
+            assert search['counters'] == {'correlated_frames': 1000}
+            assert search['cpu_seconds'] > 0
+            assert search['frames_per_second'] == report['frames_per_second']
+            assert report['counters'] == {'read_frames': 5,
+                                          'correlated_frames': 1000}
+
+    class WorkerCountersAreMerged(ut.TestCase):
+        def runTest(self):
+            metrics = start()
+            add('pool_tasks', 1)
+            # what a forked worker inherited is not sent back
+            inherited = drain()
+            add('pool_tasks', 2)
+            sent = drain()
+            metrics.merge(inherited)
+            merge(sent)
+            stop()
+            assert metrics.report()['counters'] == {'pool_tasks': 3}
+
+    class PrometheusExportHasOneSampleLinePerSeries(ut.TestCase):
+        def runTest(self):
+            metrics = start(labels={'command': 'search'})
+            add('read_bytes', 4096)
+            metrics.stage('search')
+            metrics.stage('search')
+            metrics.enter('correlate')
+            metrics.leave()
+            stop()
+            text = metrics.prometheus()
+            assert 'parseiq_read_bytes_total{command="search"} 4096.0\n' in text
+            assert '# TYPE parseiq_read_bytes_total counter\n' in text
+            samples = [line.split(' ')[0] for line in text.splitlines()
+                       if not line.startswith('#')]
+            assert len(samples) == len(set(samples))
+            assert 'parseiq_stage_seconds{command="search",stage="search"}' \
+                in samples
+            assert 'parseiq_section_cpu_seconds{command="search",' \
+                'section="correlate"}' in samples
+
+    ut.main()
@@ -0,0 +1,323 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""\
+Sample memory usage in the background and attribute it to stages
+
+A Sampler thread reads /proc/<pid>/statm of the process and all of its
+child processes (e.g. worker pools) every interval seconds and records
+their summed resident set size. Note that pages shared between processes
+(forked mappings, shared result buffers) are counted once per process.
+
+A Profiler splits the run into consecutive named stages, marked with
+stage(), and additionally accumulates the time spent in named sections
+(timed() iterators) exclusively: time spent in a nested section is not
+charged to the enclosing one.
+
+The module keeps a single active profiler, so applications can emit
+stage markers unconditionally; they cost nothing unless profiling was
+started with start(). Stage markers and sections are also reported to
+the active metrics (see metrics), whether or not memory is profiled.
+"""
+
+import os
+import json
+import time
+import threading
+
+from linuxstatmreader import LinuxStatmReader, children
+from recorder import Recorder
+import metrics
+
+# seconds between two memory samples
+INTERVAL = 0.05
+
+# number of samples after which the list of child processes is refreshed
+CHILD_REFRESH = 10
+
+
+class Sampler(threading.Thread):
+    """Background thread recording the resident set size of a process
+    and its children. x of the recorder is the time, y the RSS in bytes"""
+    def __init__(self, pid=None, interval=INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pid = pid or os.getpid()
+        self.interval = interval
+        self.readers = [LinuxStatmReader(self.pid)]
+        self.recorder = Recorder(lambda i: time.time(),
+                                 lambda i: self.resident())
+        self.running = False
+        self.lock = threading.Lock()
+
+    def resident(self):
+        """Summed RSS of the process and its children"""
+        return sum(reader.resident() for reader in self.readers)
+
+    def refresh(self):
+        """Update the list of sampled child processes"""
+        self.readers = [LinuxStatmReader(self.pid)] + \
+            [LinuxStatmReader(pid) for pid in children(self.pid)]
+
+    def sample(self):
+        """Record a sample now"""
+        with self.lock:
+            self.recorder.record()
+
+    def run(self):
+        count = 0
+        while self.running:
+            if count % CHILD_REFRESH == 0:
+                self.refresh()
+            self.sample()
+            count += 1
+            time.sleep(self.interval)
+
+    def start(self):
+        self.running = True
+        threading.Thread.start(self)
+
+    def stop(self):
+        """Stop sampling after a final sample"""
+        self.running = False
+        self.join()
+        self.refresh()
+        self.sample()
+
+
+class Profiler(object):
+    """Timeline of stages with their duration and peak RSS"""
+    def __init__(self, interval=INTERVAL):
+        self.sampler = Sampler(interval=interval)
+        self.stages = []
+        self.sections = {}
+        self.stack = []
+        self.began = None
+        self.end = None
+
+    def start(self, name='start'):
+        """Start sampling with a first stage"""
+        self.began = time.time()
+        self.sampler.start()
+        self.stage(name)
+
+    def stop(self):
+        """End the last stage and stop sampling"""
+        self.sampler.stop()
+        self.end = time.time()
+
+    def stage(self, name):
+        """Mark the beginning of stage name, ending the previous one.
+        Every stage gets at least the sample taken at its beginning"""
+        self.stages.append((name, time.time(), time.clock()))
+        self.sampler.sample()
+
+    def enter(self, name):
+        """Begin a timed section"""
+        now = time.time()
+        if self.stack:
+            self.charge(now)
+        self.stack.append([name, now])
+
+    def leave(self):
+        """End the innermost timed section"""
+        self.charge(time.time())
+        self.stack.pop()
+        if self.stack:
+            self.stack[-1][1] = time.time()
+
+    def charge(self, now):
+        """Charge the time since the last switch to the innermost section"""
+        name, since = self.stack[-1]
+        self.sections[name] = self.sections.get(name, 0.0) + now - since
+        self.stack[-1][1] = now
+
+    def report(self):
+        """Dict with the per stage timeline, the section totals, the
+        overall peak RSS and the raw samples. Before stop() the last stage
+        ends now"""
+        times, rss = self.sampler.recorder.arrays()
+        end = time.time() if self.end is None else self.end
+        ends = [began for _, began, _ in self.stages[1:]] + [end]
+        clock_ends = [clock for _, _, clock in self.stages[1:]] + [time.clock()]
+        stages = []
+        for (name, began, clock), end, clock_end in zip(self.stages, ends,
+                                                        clock_ends):
+            inside = rss[(times >= began) & (times <= end)]
+            stages.append({'name': name,
+                           'start': began - self.began,
+                           'seconds': end - began,
+                           'cpu_seconds': clock_end - clock,
+                           'peak_rss': int(inside.max()) if len(inside) else None})
+        return {'stages': stages,
+                'sections': self.sections,
+                'seconds': end - self.began,
+                'peak_rss': int(rss.max()) if len(rss) else None,
+                'interval': self.sampler.interval,
+                'timeline': [[t - self.began, int(r)]
+                             for t, r in zip(times.tolist(), rss.tolist())]}
+
+    def write(self, name):
+        """Write the report as JSON to file name and return it"""
+        report = self.report()
+        with open(name, 'w') as out:
+            json.dump(report, out, indent=1)
+        return report
+
+
+# the profiler stage markers and timed sections are reported to
+active = None
+
+
+def start(interval=INTERVAL):
+    """Start the active profiler"""
+    global active
+    active = Profiler(interval)
+    active.start()
+    return active
+
+
+def stop():
+    """Stop and return the active profiler"""
+    global active
+    profiler, active = active, None
+    if profiler:
+        profiler.stop()
+    return profiler
+
+
+def recorders():
+    """The active profiler and metrics, those that exist"""
+    return [recorder for recorder in (active, metrics.active) if recorder]
+
+
+def stage(name):
+    """Mark the beginning of stage name, if profiling"""
+    if active:
+        active.stage(name)
+    if metrics.active:
+        metrics.active.stage(name)
+
+
+def timed(name, iterable):
+    """Yields the items of iterable, charging the time spent producing
+    them to section name, if profiling"""
+    targets = recorders()
+    if not targets:
+        for item in iterable:
+            yield item
+        return
+    iterator = iter(iterable)
+    while True:
+        for target in targets:
+            target.enter(name)
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            for target in targets:
+                target.leave()
+        yield item
+
+
+def section(name, function):
+    """Wraps function so the time spent in it, and in producing the items
+    of the iterator it may return, is charged to section name, if
+    profiling"""
+    def wrapped(*args, **kwargs):
+        targets = recorders()
+        if not targets:
+            return function(*args, **kwargs)
+        for target in targets:
+            target.enter(name)
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            for target in targets:
+                target.leave()
+        if hasattr(result, 'next'):
+            return timed(name, result)
+        return result
+    return wrapped
+
+
+if __name__ == '__main__':
+    import unittest as ut
+
+    class ASamplerRecordsResidentMemory(ut.TestCase):
+        def runTest(self):
+            sampler = Sampler(interval=0.001)
+            sampler.start()
+            time.sleep(0.02)
+            sampler.stop()
+            times, rss = sampler.recorder.arrays()
+            assert len(times) >= 2
+            assert (rss > 0).all()
+            assert (times[1:] >= times[:-1]).all()
+
+    class AProfilerReportsStagesInOrder(ut.TestCase):
+        def runTest(self):
+            profiler = start(0.001)
+            stage('allocate')
+            data = bytearray(32 << 20)
+            time.sleep(0.01)
+            stage('free')
+            del data
+            time.sleep(0.01)
+            stop()
+            report = profiler.report()
+            names = [s['name'] for s in report['stages']]
+            assert names == ['start', 'allocate', 'free']
+            assert all(s['seconds'] >= 0 for s in report['stages'])
+            assert report['peak_rss'] >= report['stages'][1]['peak_rss'] > 32 << 20
+
+    class StageMarkersAreIgnoredWithoutProfiler(ut.TestCase):
+        def runTest(self):
+            stage('nothing')
+            assert list(timed('nothing', [1, 2])) == [1, 2]
+
+    class TimedSectionsAreChargedExclusively(ut.TestCase):
+        def runTest(self):
+            def slow(n):
+                for i in range(n):
+                    time.sleep(0.01)
+                    yield i
+
+            def consume(items):
+                total = 0
+                for i in items:
+                    time.sleep(0.005)
+                    total += i
+                return total
+
+            profiler = start()
+            produce = section('produce', slow)
+            total = section('consume', consume)(produce(4))
+            stop()
+            assert total == 6
+            assert profiler.sections['produce'] >= 0.04
+            assert profiler.sections['consume'] >= 0.02
+            # the generator's sleeps are not charged to its consumer
+            assert profiler.sections['produce'] > profiler.sections['consume']
+
+    class ARunningProfilerReportsUpToNow(ut.TestCase):
+        def runTest(self):
+            profiler = Profiler()
+            profiler.start('only')
+            try:
+                report = profiler.report()
+            finally:
+                profiler.stop()
+            assert report['stages'][0]['name'] == 'only'
+            assert report['seconds'] >= report['stages'][0]['seconds'] >= 0
+
+    class MarkersAreReportedToMetrics(ut.TestCase):
+        def runTest(self):
+            collected = metrics.start()
+            stage('search')
+            list(section('correlate', lambda: iter([time.sleep(0.01)]))())
+            metrics.stop()
+            report = collected.report()
+            assert [s['name'] for s in report['stages']] == ['start', 'search']
+            assert report['sections']['correlate']['seconds'] >= 0.01
+
+    ut.main()
@@ -1,36 +1,59 @@
 """\
 Record memory usage points over time
+
+Samples are stored in two preallocated float64 arrays that double in size
+when full, so recording does not create Python objects per sample.
+Comments are kept separately for the few samples that have one.
 """
 
 import time
+import numpy as np
 
 class Recorder(object):
-    """Records arbitrary x/y data.
+    """Records numeric x/y data.
     Optionally add a comment to each sample"""
     getmillis = lambda x: int(round(time.time() * 1000))
     incrementer = lambda x: x
     constantone = lambda x: 1
 
-    def __init__(self, samplefunctionx=incrementer, samplefunctiony=constantone):
+    def __init__(self, samplefunctionx=incrementer, samplefunctiony=constantone,
+                 capacity=1024):
         self.samplefunctionx = samplefunctionx
         self.samplefunctiony = samplefunctiony
-        self.data = []
-        self.counter = 0
+        self.capacity = capacity
+        self.reset()
 
     def record(self, comment=None):
         """Record a new x/y sample and optionally add a commend"""
-        self.data.append({'x': self.samplefunctionx(self.counter),
-                          'y': self.samplefunctiony(self.counter),
-                          'comment': comment})
+        if self.counter == len(self.x):
+            self.x = np.concatenate((self.x, np.zeros(len(self.x))))
+            self.y = np.concatenate((self.y, np.zeros(len(self.y))))
+        self.x[self.counter] = self.samplefunctionx(self.counter)
+        self.y[self.counter] = self.samplefunctiony(self.counter)
+        if comment is not None:
+            self.comments[self.counter] = comment
         self.counter += 1
 
+    def arrays(self):
+        """Views of the recorded x and y values"""
+        return self.x[:self.counter], self.y[:self.counter]
+
+    @property
+    def data(self):
+        """All of the recorded data as list of dicts"""
+        return self.getrecordeddata()
+
     def getrecordeddata(self):
         """Get all of the recorded data"""
-        return self.data
+        x, y = self.arrays()
+        return [{'x': x, 'y': y, 'comment': self.comments.get(i)}
+                for i, (x, y) in enumerate(zip(x.tolist(), y.tolist()))]
 
     def reset(self):
         """Clear all recorded data"""
-        self.data = []
+        self.x = np.zeros(max(1, self.capacity))
+        self.y = np.zeros(max(1, self.capacity))
+        self.comments = {}
         self.counter = 0
 
 
@@ -92,6 +115,23 @@ if __name__ == '__main__':
             assert rec.getrecordeddata()[1]['comment'] == None
             assert rec.getrecordeddata()[2]['comment'] == 123
 
+    class ARecorderGrowsBeyondItsCapacity(ut.TestCase):
+        def runTest(self):
+            rec = Recorder(samplefunctiony = lambda x: 3*x, capacity=2)
+            for _ in range(5):
+                rec.record()
+            x, y = rec.arrays()
+            assert list(x) == [0, 1, 2, 3, 4]
+            assert list(y) == [0, 3, 6, 9, 12]
+
+    class ARecorderForgetsEverythingOnReset(ut.TestCase):
+        def runTest(self):
+            rec = Recorder()
+            rec.record("hello")
+            rec.reset()
+            rec.record()
+            assert rec.data == [{'x': 0, 'y': 1, 'comment': None}]
+
     ut.main()
 
 
@@ -0,0 +1,60 @@
+from iq2npy import convert
+import unittest as ut
+import numpy as np
+import tempfile
+import shutil
+import wave
+import os
+
+class WavFileFixture(ut.TestCase):
+    """Test fixture with a 16 bit I/Q WAV file"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.wav_name = os.path.join(self.directory, 'in.wav')
+        self.npy_name = os.path.join(self.directory, 'out.npy')
+        self.frames = np.random.RandomState(7).randint(
+            -32768, 32767, (1001, 2)).astype('<i2')
+        wav = wave.open(self.wav_name, 'wb')
+        wav.setparams((2, 2, 48000, len(self.frames), 'NONE', 'not compressed'))
+        wav.writeframes(self.frames.tostring())
+        wav.close()
+        self.expected = self.frames[:, 0] + 1j * self.frames[:, 1]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+class ConvertWritesLoadableNpy(WavFileFixture):
+    def runTest(self):
+        convert(self.wav_name, self.npy_name)
+        result = np.load(self.npy_name, mmap_mode='r')
+        assert result.dtype == np.complex64
+        np.testing.assert_array_equal(result, self.expected)
+
+class ConvertInChunksGivesSameResult(WavFileFixture):
+    def runTest(self):
+        convert(self.wav_name, self.npy_name, chunk_size=100)
+        np.testing.assert_array_equal(np.load(self.npy_name), self.expected)
+
+class ConvertWithWorkersGivesSameResult(WavFileFixture):
+    def runTest(self):
+        convert(self.wav_name, self.npy_name, chunk_size=64, workers=3)
+        np.testing.assert_array_equal(np.load(self.npy_name), self.expected)
+
+class ConvertToCs16KeepsFrames(WavFileFixture):
+    def runTest(self):
+        convert(self.wav_name, self.npy_name, chunk_size=100, workers=2,
+                out_format='cs16')
+        result = np.load(self.npy_name, mmap_mode='r')
+        assert result.dtype == np.int16
+        np.testing.assert_array_equal(result, self.frames)
+
+class ConvertToCf64WidensToDouble(WavFileFixture):
+    def runTest(self):
+        convert(self.wav_name, self.npy_name, chunk_size=100,
+                out_format='cf64')
+        result = np.load(self.npy_name, mmap_mode='r')
+        assert result.dtype == np.complex128
+        np.testing.assert_array_equal(result, self.expected)
+
+if __name__ == '__main__':
+    ut.main()
@@ -1,5 +1,5 @@
 """\
-Usage: iq2npy.py [-v] INFILE [OUTFILE]
+Usage: iq2npy.py [-v] [-c FRAMES] [-j WORKERS] [--format FORMAT] INFILE [OUTFILE]
 
 Arguments:
         INFILE      Input WAV file in 16 bit I/Q format
@@ -7,15 +7,22 @@ Arguments:
 
 Options:
         -v          verbose output
+        -c FRAMES   number of frames converted at a time [default: 1048576]
+        -j WORKERS  number of converting processes, 0 for one per core [default: 1]
+        --format FORMAT  output sample format: cf32 for complex64 samples,
+                    cf64 for complex128 samples (double precision searches),
+                    cs16 for compact interleaved int16 I/Q frames that
+                    keep the size of the input [default: cf32]
 """
 
 from __future__ import print_function
 from docopt import docopt
 import sys
-import wave
-import struct
 import numpy as np
 import logging
+import multiprocessing
+
+import iqfile
 
 def error(*objs):
     """print error message to stderr"""
@@ -31,9 +38,51 @@ def verifyfileformat(wavfile):
     if wavfile.getcomptype() != 'NONE':
         raise TypeError('Input file must not be compressed')
 
-def convert(in_name, out_name):
-    """convert the file identified by filename in_name to a complex numpy array and store it to a file named out_name"""
-    wav = wave.open(in_name,'rb')
+# number of frames converted at a time
+CHUNK_SIZE = 1 << 20
+
+# output array layout per sample format
+FORMATS = {'cf32': (np.complex64, lambda length: (length,)),
+           'cf64': (np.complex128, lambda length: (length,)),
+           'cs16': (np.int16, lambda length: (length, 2))}
+
+# input and output mapping of a conversion worker
+mapped = {}
+
+
+def convert_frames(frames, out):
+    """Writes (n, 2) int16 I/Q frames into out: copied as they are for
+    cs16, component by component for complex samples so no wide
+    temporaries are created"""
+    if not np.iscomplexobj(out):
+        out[:] = frames
+        return
+    out.real = frames[:, 0]
+    out.imag = frames[:, 1]
+
+
+def open_mappings(in_name, out_name):
+    """Conversion worker initializer: map input and output once"""
+    mapped['in'] = iqfile.IQFile(in_name).data
+    mapped['out'] = np.lib.format.open_memmap(out_name, mode='r+')
+
+
+def convert_range(frame_range):
+    """Conversion worker: converts the frames in [first, last)"""
+    first, last = frame_range
+    out = mapped['out'][first:last]
+    convert_frames(mapped['in'][first:last], out)
+    out.flush()
+    return last - first
+
+
+def convert(in_name, out_name, chunk_size=CHUNK_SIZE, workers=1, out_format='cf32'):
+    """convert the file identified by filename in_name to a complex numpy array and store it to a file named out_name.
+    out_format selects complex64 samples (cf32), complex128 samples (cf64)
+    or int16 frames (cs16).
+    The conversion runs chunk_size frames at a time, optionally spread over
+    several worker processes that write disjoint frame ranges"""
+    wav = iqfile.IQFile(in_name)
     verifyfileformat(wav)
 
     length = wav.getnframes()
@@ -41,24 +90,37 @@ def convert(in_name, out_name):
 
     logging.info('length: {} frames, channels: {}'.format(length, channels))
     wav.close()
-   
-    # now that we know the format is valid, access data directly
-    npinfile = np.memmap(in_name, dtype=np.int16, mode='r', offset=44) 
-    if npinfile.shape[0]/2 != length:
-        raise TypeError('frame mismatch in direct access')
-
-    # our output file, this will be an npy binary holding complex64 types
-    npfile = np.memmap(out_name, dtype=np.complex64,
-                       mode='w+',
-                       shape=(length,))
-
-    # convert input to complex output
-    npfile[:] = npinfile[0::2] + 1j * npinfile[1::2]
-    
-    # cleanup
-    del npinfile
+
+    if out_format not in FORMATS:
+        raise TypeError('unknown output format {}'.format(out_format))
+    dtype, shape = FORMATS[out_format]
+
+    # our output file, this will be an npy file holding complex64 or
+    # complex128 types or int16 I/Q pairs
+    npfile = np.lib.format.open_memmap(out_name, mode='w+',
+                                       dtype=dtype, shape=shape(length))
     del npfile
 
+    ranges = [(first, min(length, first + chunk_size))
+              for first in range(0, length, chunk_size)]
+
+    if workers == 1:
+        open_mappings(in_name, out_name)
+        converted = sum(convert_range(frame_range) for frame_range in ranges)
+    else:
+        pool = multiprocessing.Pool(workers or None, open_mappings,
+                                    (in_name, out_name))
+        try:
+            converted = sum(pool.imap_unordered(convert_range, ranges))
+        finally:
+            # all ranges are written by now, or a worker failed
+            pool.terminate()
+            pool.join()
+
+    # cleanup
+    mapped.clear()
+    logging.info('converted {} frames'.format(converted))
+
 def main():
     """entry point"""
     logger = logging.getLogger('')
@@ -86,7 +148,8 @@ def main():
         logging.info('input: "{}", output: "{}"'.format(infile_name,
                                                         outfile_name))
 
-        convert(infile_name, outfile_name)
+        convert(infile_name, outfile_name, int(args['-c']), int(args['-j']),
+                args['--format'])
 
         logging.info("done")
 
@@ -0,0 +1,138 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""\
+Usage:  iqclient.py [--socket PATH] [--latency] COMMAND [ARGS...]
+        iqclient.py [--socket PATH] --stats
+
+Thin client of the search daemon (iqserver.py)
+
+Runs a parseiq.py search, peaksearch or dump command line in the daemon,
+e.g. iqclient.py search -t 0.6 capture.wav burst.wav, as if parseiq.py
+was run in the current directory: its output is written to stdout, its
+log messages to stderr, both while the command runs, and the exit
+status is that of the command. The client does not import numpy, it
+starts in a fraction of the time parseiq.py takes.
+
+Options:
+        -h --help       Show this help message and exit
+        --socket PATH   Unix domain socket of the daemon, $PARSEIQ_SOCKET or
+                        parseiq.sock in $XDG_RUNTIME_DIR (/tmp/parseiq-UID.sock
+                        without one) if not given
+        --latency       Report the latency of the request on stderr
+        --stats         Print the request latency statistics of the daemon
+                        as JSON
+"""
+
+import os
+import sys
+import json
+import socket
+import cStringIO
+
+from docopt import docopt
+
+
+def default_socket():
+    """$PARSEIQ_SOCKET, else parseiq.sock in $XDG_RUNTIME_DIR, else
+    /tmp/parseiq-<uid>.sock"""
+    if os.environ.get('PARSEIQ_SOCKET'):
+        return os.environ['PARSEIQ_SOCKET']
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'parseiq.sock')
+    return '/tmp/parseiq-{}.sock'.format(os.getuid())
+
+
+def send_message(connection, header, *payloads):
+    """Sends a JSON header line, which lists the sizes of the payloads
+    that follow it. Payloads may be strings or buffers"""
+    header = dict(header, sizes=[len(payload) for payload in payloads])
+    connection.sendall(json.dumps(header) + '\n')
+    for payload in payloads:
+        connection.sendall(payload)
+
+
+def receive_message(stream):
+    """(header, payloads) of a message sent by send_message(), read from
+    a file object of the socket"""
+    line = stream.readline()
+    if not line:
+        raise EOFError('connection closed')
+    header = json.loads(line)
+    payloads = []
+    for size in header.get('sizes', []):
+        payload = stream.read(size)
+        if len(payload) != size:
+            raise EOFError('connection closed')
+        payloads.append(payload)
+    return header, payloads
+
+
+class Client(object):
+    """Connection to the daemon listening on path (default:
+    default_socket())"""
+    def __init__(self, path=None):
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.connection.connect(path or default_socket())
+        self.stream = self.connection.makefile('rb')
+
+    def request(self, argv, cwd=None, out=None, err=None):
+        """Runs the parseiq.py command line argv (without the program
+        name) in directory cwd (default: the current one). Output and
+        log messages are written to the file objects out and err while
+        the daemon streams them, or collected if out or err are not
+        given. Returns (exit status, collected output, collected log
+        messages, latency)"""
+        streams = {'out': out or cStringIO.StringIO(),
+                   'err': err or cStringIO.StringIO()}
+        send_message(self.connection, {'argv': list(argv),
+                                       'cwd': cwd or os.getcwd()})
+        while True:
+            header, payloads = receive_message(self.stream)
+            if 'stream' not in header:
+                break
+            streams[header['stream']].write(payloads[0])
+            streams[header['stream']].flush()
+        return (header['status'],
+                None if out else streams['out'].getvalue(),
+                None if err else streams['err'].getvalue(),
+                header['latency'])
+
+    def stats(self):
+        """Latency statistics of the daemon per command"""
+        send_message(self.connection, {'stats': True})
+        return receive_message(self.stream)[0]['stats']
+
+    def close(self):
+        """Close the connection"""
+        self.stream.close()
+        self.connection.close()
+
+
+def main():
+    """entry point"""
+    arguments = docopt(__doc__, options_first=True)
+    try:
+        client = Client(arguments['--socket'])
+    except socket.error, e:
+        sys.stderr.write('cannot connect to the daemon at {}: {}, is '
+                         'iqserver.py running?\n'.format(
+                             arguments['--socket'] or default_socket(), e))
+        return 2
+    try:
+        if arguments['--stats']:
+            json.dump(client.stats(), sys.stdout, indent=1, sort_keys=True)
+            sys.stdout.write('\n')
+            return 0
+        status, _, _, latency = client.request(
+            [arguments['COMMAND']] + arguments['ARGS'],
+            out=sys.stdout, err=sys.stderr)
+    finally:
+        client.close()
+    if arguments['--latency']:
+        sys.stderr.write('latency {:.1f} ms, {:.1f} ms queued, {:.1f} ms '
+                         'run\n'.format(1000 * latency['seconds'],
+                                        1000 * latency['queued_seconds'],
+                                        1000 * latency['run_seconds']))
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
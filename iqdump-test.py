@@ -0,0 +1,62 @@
+from iqdump import dump
+from iqfile import IQFile
+import unittest as ut
+import numpy as np
+import tempfile
+import StringIO
+import os
+
+class DumpFixture(ut.TestCase):
+    """Test fixture with the same frames as cs16 and complex64 capture"""
+    def setUp(self):
+        self.frames = np.array([[1, -2], [300, 4], [-32768, 32767], [0, 9]],
+                               dtype='<i2')
+        self.names = [tempfile.mktemp(suffix='.cs16'),
+                      tempfile.mktemp(suffix='.cf32')]
+        self.frames.tofile(self.names[0])
+        samples = self.frames[:, 0] + 1j * self.frames[:, 1]
+        samples.astype(np.complex64).tofile(self.names[1])
+
+    def tearDown(self):
+        for name in self.names:
+            os.unlink(name)
+
+    def dump(self, name, fmt, offset=0, n_frames=None, block_size=None):
+        out = StringIO.StringIO()
+        dump(IQFile(name), out, fmt, offset, n_frames, block_size)
+        return out.getvalue()
+
+class DumpTextFormats(DumpFixture):
+    def runTest(self):
+        for name in self.names:
+            assert self.dump(name, 'complex', 1, 2) == '(300+4j)\n(-32768+32767j)\n'
+            assert self.dump(name, 'text', 3) == '0 9\n'
+            assert self.dump(name, 'csv', 0, 2) == 'i,q\n1,-2\n300,4\n'
+
+class DumpBinaryFormats(DumpFixture):
+    def runTest(self):
+        for name in self.names:
+            cs16 = np.fromstring(self.dump(name, 'cs16', 1, 2), dtype='<i2')
+            np.testing.assert_array_equal(cs16.reshape(-1, 2), self.frames[1:3])
+            cf32 = np.fromstring(self.dump(name, 'cf32', 2), dtype=np.complex64)
+            np.testing.assert_array_equal(cf32, [-32768 + 32767j, 9j])
+        assert self.dump(self.names[0], 'raw') == self.frames.tostring()
+
+class DumpIsIndependentOfBlockSize(DumpFixture):
+    def runTest(self):
+        for fmt in ('complex', 'csv', 'cs16'):
+            assert (self.dump(self.names[1], fmt, 1, block_size=1)
+                    == self.dump(self.names[1], fmt, 1))
+
+class DumpClipsToCs16Range(ut.TestCase):
+    def runTest(self):
+        name = tempfile.mktemp(suffix='.cf32')
+        np.array([40000.4 - 1e6j], dtype=np.complex64).tofile(name)
+        out = StringIO.StringIO()
+        dump(IQFile(name), out, 'cs16')
+        os.unlink(name)
+        np.testing.assert_array_equal(np.fromstring(out.getvalue(), '<i2'),
+                                      [32767, -32768])
+
+if __name__ == '__main__':
+    ut.main()
@@ -0,0 +1,123 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""\
+Bulk dumping of IQ captures
+
+Samples are dumped block by block straight from the mapping of the
+capture, only the selected frame range is ever touched. Every block is
+formatted by a single vectorized operation and written with a single
+write, so dumps run at pipe speed instead of one Python call per sample.
+
+Formats:
+
+    complex  one complex number per line, (I+Qj) as Python prints it
+    text     I and Q in two columns separated by a space
+    csv      I and Q in two comma separated columns below an i,q header
+    raw      the stored frames as they are (int16 pairs or complex)
+    cf32     complex64 samples
+    cs16     interleaved int16 I/Q frames, complex samples are rounded
+             and clipped
+"""
+
+import numpy as np
+
+# frames per write for binary and text formats
+BINARY_BLOCK = 1 << 20
+TEXT_BLOCK = 1 << 16
+
+FORMATS = ('complex', 'text', 'csv', 'raw', 'cf32', 'cs16')
+
+
+def pairs(frames):
+    """(n, 2) I/Q view of raw frames"""
+    if np.iscomplexobj(frames):
+        frames = np.ascontiguousarray(frames)
+        return frames.view(frames.real.dtype).reshape(-1, 2)
+    return frames
+
+
+def columns(frames, separator):
+    """Text lines with I and Q of raw frames in two columns"""
+    iq = pairs(frames)
+    if iq.dtype.kind in 'iu':
+        field = '%d'
+    elif iq.dtype.itemsize <= 4:
+        field = '%.9g'
+    else:
+        field = '%.17g'
+    line = field + separator + field + '\n'
+    return (line * len(iq)) % tuple(iq.ravel().tolist())
+
+
+def complex_lines(frames):
+    """Text lines with one complex number each"""
+    if not np.iscomplexobj(frames):
+        samples = np.empty(len(frames), dtype=np.complex128)
+        samples.real = frames[:, 0]
+        samples.imag = frames[:, 1]
+        frames = samples
+    return '\n'.join(map(str, frames.tolist())) + '\n'
+
+
+def cf32(frames):
+    """complex64 samples of raw frames"""
+    if np.iscomplexobj(frames):
+        return np.ascontiguousarray(frames, dtype=np.complex64)
+    samples = np.empty(len(frames), dtype=np.complex64)
+    samples.real = frames[:, 0]
+    samples.imag = frames[:, 1]
+    return samples
+
+
+def cs16(frames):
+    """(n, 2) little endian int16 frames of raw frames"""
+    if not np.iscomplexobj(frames):
+        return np.ascontiguousarray(frames, dtype='<i2')
+    iq = np.rint(pairs(frames))
+    np.clip(iq, -32768, 32767, out=iq)
+    return iq.astype('<i2')
+
+
+ENCODERS = {
+    'complex': complex_lines,
+    'text': lambda frames: columns(frames, ' '),
+    'csv': lambda frames: columns(frames, ','),
+    'raw': np.ascontiguousarray,
+    'cf32': cf32,
+    'cs16': cs16,
+}
+
+
+def frames_per_write(fmt):
+    """Frames per write for format fmt"""
+    return BINARY_BLOCK if fmt in ('raw', 'cf32', 'cs16') else TEXT_BLOCK
+
+
+def write(blocks, out, fmt='complex'):
+    """Writes blocks of raw frames or complex samples to the file object
+    out in format fmt. Returns the number of frames written"""
+    if fmt not in ENCODERS:
+        raise ValueError('unknown dump format ' + fmt)
+    encode = ENCODERS[fmt]
+    written = 0
+    if fmt == 'csv':
+        out.write('i,q\n')
+    for block in blocks:
+        encoded = encode(block)
+        out.write(encoded if isinstance(encoded, str) else buffer(encoded))
+        written += len(block)
+    out.flush()
+    return written
+
+
+def dump(iq_file, out, fmt='complex', offset=0, n_frames=None,
+         block_size=None):
+    """Writes n_frames (default: all) frames of an iqfile.IQFile from
+    offset to the file object out in format fmt. Returns the number of
+    frames written"""
+    if block_size is None:
+        block_size = frames_per_write(fmt)
+    data = iq_file.data
+    end = len(data) if n_frames is None else min(len(data), offset + n_frames)
+    write((data[first:min(end, first + block_size)]
+           for first in range(offset, end, block_size)), out, fmt)
+    return max(0, end - offset)
@@ -0,0 +1,129 @@
+from iqfile import IQFile, IQArray
+import unittest as ut
+import numpy as np
+import struct
+import tempfile
+import os
+
+def riff(chunks):
+    body = 'WAVE' + ''.join(name + struct.pack('<I', len(payload)) + payload
+                            + '\x00' * (len(payload) & 1)
+                            for name, payload in chunks)
+    return 'RIFF' + struct.pack('<I', len(body)) + body
+
+def fmt(channels=2, bits=16, tag=1):
+    align = channels * bits // 8
+    return ('fmt ', struct.pack('<HHIIHH', tag, channels, 48000,
+                                48000 * align, align, bits))
+
+class TempFileFixture(ut.TestCase):
+    """Test fixture providing a temporary file and reference frames"""
+    def setUp(self):
+        self.name = tempfile.mktemp()
+        self.frames = np.arange(-20, 20, dtype='<i2').reshape(-1, 2)
+
+    def tearDown(self):
+        if os.path.exists(self.name):
+            os.unlink(self.name)
+
+    def write(self, content):
+        with open(self.name, 'wb') as fh:
+            fh.write(content)
+
+class WavDataIsFoundBehindOtherChunks(TempFileFixture):
+    def runTest(self):
+        self.write(riff([fmt(), ('LIST', 'INFOISFT\x03\x00\x00\x00ab\x00'),
+                         ('bext', 'x' * 17),
+                         ('data', self.frames.tostring())]))
+        iq = IQFile(self.name)
+        assert iq.getnframes() == 20
+        assert iq.getframerate() == 48000
+        np.testing.assert_array_equal(iq.data, self.frames)
+
+class WavFramesAreWidenedToComplex(TempFileFixture):
+    def runTest(self):
+        self.write(riff([fmt(), ('data', self.frames.tostring())]))
+        samples = IQFile(self.name).iq(3, 2)
+        assert samples.dtype == np.complex128
+        np.testing.assert_array_equal(samples, [-14 - 13j, -12 - 11j])
+
+class WavWithUnsetDataSizeUsesFileSize(TempFileFixture):
+    def runTest(self):
+        content = riff([fmt(), ('data', self.frames.tostring())])
+        self.write(content.replace('data' + struct.pack('<I', 80),
+                                   'data' + struct.pack('<I', 0)))
+        assert IQFile(self.name).getnframes() == 20
+
+class WavMustBe16BitStereo(TempFileFixture):
+    def runTest(self):
+        self.write(riff([fmt(channels=1), ('data', self.frames.tostring())]))
+        self.assertRaises(TypeError, IQFile, self.name)
+        self.write(riff([fmt(bits=8), ('data', self.frames.tostring())]))
+        self.assertRaises(TypeError, IQFile, self.name)
+        self.write(riff([fmt(tag=3), ('data', self.frames.tostring())]))
+        self.assertRaises(TypeError, IQFile, self.name)
+
+class RawComplexSamplesAreViews(TempFileFixture):
+    def runTest(self):
+        samples = np.arange(10, dtype=np.complex64) * (1 + 2j)
+        self.write(samples.tostring())
+        iq = IQFile(self.name)
+        assert iq.getnframes() == 10
+        assert isinstance(iq.iq(2, 3), np.memmap)
+        np.testing.assert_array_equal(iq.iq(8, 100), samples[8:])
+
+class NpyFilesAreMappedByHeader(TempFileFixture):
+    def runTest(self):
+        samples = np.arange(10, dtype=np.complex64)
+        np.save(self.name, samples)
+        os.rename(self.name + '.npy', self.name)
+        np.testing.assert_array_equal(IQFile(self.name).iq(), samples)
+
+class ReadframesFollowsWaveInterface(TempFileFixture):
+    def runTest(self):
+        self.write(riff([fmt(), ('data', self.frames.tostring())]))
+        iq = IQFile(self.name)
+        iq.setpos(18)
+        assert iq.readframes(5) == self.frames[18:].tostring()
+        assert iq.tell() == 20
+        assert iq.getsampwidth() == 2
+        self.assertRaises(ValueError, iq.setpos, 21)
+
+class Cs16FilesAreMappedAsFrames(TempFileFixture):
+    def runTest(self):
+        name = self.name + '.cs16'
+        with open(name, 'wb') as fh:
+            fh.write(self.frames.tostring())
+        try:
+            iq = IQFile(name)
+            np.testing.assert_array_equal(iq.data, self.frames)
+            np.testing.assert_array_equal(iq.iq(0, 1), [-20 - 19j])
+        finally:
+            os.unlink(name)
+
+class Int16NpyFilesAreMappedAsFrames(TempFileFixture):
+    def runTest(self):
+        np.save(self.name, self.frames.ravel())
+        os.rename(self.name + '.npy', self.name)
+        np.testing.assert_array_equal(IQFile(self.name).data, self.frames)
+
+class IQArrayWidensOnlySlicedFrames(TempFileFixture):
+    def runTest(self):
+        self.write(riff([fmt(), ('data', self.frames.tostring())]))
+        samples = IQArray(IQFile(self.name), 5, 10)
+        assert len(samples) == 10
+        block = samples[2:4]
+        assert block.dtype == np.complex64
+        np.testing.assert_array_equal(block, [-6 - 5j, -4 - 3j])
+        assert samples[-1] == 8 + 9j
+        np.testing.assert_array_equal(np.asarray(samples.view(8, 20)),
+                                      [6 + 7j, 8 + 9j])
+
+class IQArrayIsClippedToFile(TempFileFixture):
+    def runTest(self):
+        self.write(riff([fmt(), ('data', self.frames.tostring())]))
+        assert len(IQArray(IQFile(self.name), 15, 100)) == 5
+        assert len(IQArray(IQFile(self.name), 25)) == 0
+
+if __name__ == '__main__':
+    ut.main()
@@ -0,0 +1,289 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""\
+Zero-copy access to IQ captures
+
+IQFile maps the samples of a capture into memory without decoding them:
+
+    WAV     RIFF chunks are parsed properly (LIST, bext, ... chunks may
+            precede the data chunk), 16 bit stereo PCM is mapped as an
+            (n, 2) int16 array of I/Q frames
+    NPY     files with an NPY header are mapped with np.load. complex
+            arrays hold samples, int16 arrays interleaved I/Q frames
+    cs16    raw interleaved int16 I/Q frames, files named *.cs16
+    other   anything else is taken as raw complex64 samples, the format
+            piq.py and iq2npy.py used historically
+
+16 bit frames (WAV, cs16) stay compact on disk and in memory. IQArray
+wraps a range of a file and widens samples to complex64 only for the
+blocks that are actually sliced out of it.
+
+Slicing a frame range costs O(range); samples outside of it are never
+touched. IQFile also offers the reading part of the wave.Wave_read
+interface so it can stand in for files opened with the wave module.
+
+While metrics are collected (see hpmc.metrics), iq() counts the frames
+and bytes it reads and the time it spends widening them.
+"""
+
+import os
+import time
+import struct
+import numpy as np
+
+from hpmc import metrics
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+NPY_MAGIC = '\x93NUMPY'
+
+
+def riff_chunks(fh):
+    """Yields (id, offset, size) of all chunks of an open RIFF/WAVE file,
+    offset being the position of the chunk payload"""
+    fh.seek(0)
+    header = fh.read(12)
+    if len(header) < 12 or header[0:4] != 'RIFF' or header[8:12] != 'WAVE':
+        raise TypeError('not a RIFF/WAVE file')
+
+    position = 12
+    while True:
+        fh.seek(position)
+        chunk = fh.read(8)
+        if len(chunk) < 8:
+            return
+        chunk_id, size = struct.unpack('<4sI', chunk)
+        yield chunk_id, position + 8, size
+        position += 8 + size + (size & 1)
+
+
+def parse_wav(name):
+    """Returns (format, data offset, data size) of a WAV file. format is a
+    dict with the fields of the fmt chunk"""
+    fmt = None
+    with open(name, 'rb') as fh:
+        fh.seek(0, 2)
+        file_size = fh.tell()
+        for chunk_id, offset, size in riff_chunks(fh):
+            if chunk_id == 'fmt ':
+                fh.seek(offset)
+                fields = struct.unpack('<HHIIHH', fh.read(16))
+                fmt = dict(zip(('tag', 'channels', 'framerate', 'byterate',
+                                'blockalign', 'bits'), fields))
+                if fmt['tag'] == WAVE_FORMAT_EXTENSIBLE and size >= 40:
+                    fh.seek(offset + 24)
+                    fmt['tag'] = struct.unpack('<H', fh.read(2))[0]
+            elif chunk_id == 'data':
+                if fmt is None:
+                    raise TypeError('data chunk precedes fmt chunk')
+                # recorders that are still writing leave the size unset
+                if size == 0 or offset + size > file_size:
+                    size = file_size - offset
+                return fmt, offset, size
+    raise TypeError('no data chunk found')
+
+
+def map_npy(name):
+    """Maps an NPY file like np.load(mmap_mode='r') does. Rows that a
+    recorder which is still writing appended behind a stale shape in the
+    header are mapped as well"""
+    with open(name, 'rb') as fh:
+        version = np.lib.format.read_magic(fh)
+        read_header = np.lib.format.read_array_header_1_0 \
+            if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran, dtype = read_header(fh)
+        offset = fh.tell()
+        fh.seek(0, 2)
+        size = fh.tell()
+    if fortran or len(shape) not in (1, 2) or dtype.hasobject:
+        return np.load(name, mmap_mode='r')
+    row = dtype.itemsize * int(np.prod(shape[1:]))
+    frames = max(shape[0], (size - offset) // row) if row else shape[0]
+    if not frames:
+        return np.zeros((0,) + tuple(shape[1:]), dtype=dtype)
+    return np.memmap(name, dtype=dtype, mode='r', offset=offset,
+                     shape=(frames,) + tuple(shape[1:]))
+
+
+def widen(frames, dtype=None):
+    """Complex samples of dtype (default complex128) of complex samples
+    or (n, 2) I/Q frames"""
+    if np.iscomplexobj(frames):
+        return frames.astype(dtype or np.complex128)
+    result = np.empty(len(frames), dtype=dtype or np.complex128)
+    result.real = frames[:, 0]
+    result.imag = frames[:, 1]
+    return result
+
+
+class IQFile(object):
+    """An IQ capture mapped into memory. data is the raw memmap: (n, 2)
+    int16 frames for WAV files, complex samples otherwise"""
+    def __init__(self, name):
+        self.name = name
+        self.position = 0
+        self.open()
+
+    def open(self):
+        """Maps the samples the file holds now"""
+        name = self.name
+        self.framerate = 0
+        with open(name, 'rb') as fh:
+            magic = fh.read(12)
+
+        if magic[0:4] == 'RIFF' and magic[8:12] == 'WAVE':
+            fmt, offset, size = parse_wav(name)
+            if fmt['tag'] != WAVE_FORMAT_PCM:
+                raise TypeError('Input file must not be compressed')
+            if fmt['channels'] != 2:
+                raise TypeError('Input file must be stereo')
+            if fmt['bits'] != 16:
+                raise TypeError('Input file must be 16 bit')
+            self.framerate = fmt['framerate']
+            frames = size // fmt['blockalign']
+            self.data = np.memmap(name, dtype='<i2', mode='r', offset=offset,
+                                  shape=(frames, 2)) if frames else \
+                np.zeros((0, 2), dtype='<i2')
+        elif magic.startswith(NPY_MAGIC):
+            self.data = map_npy(name)
+            if not self.iscomplex():
+                # a recorder may not have written the whole frame yet
+                self.data = self.data[:len(self.data) & ~1].reshape(-1, 2) \
+                    if self.data.ndim == 1 else self.data.reshape(-1, 2)
+        elif name.endswith('.cs16'):
+            frames = os.path.getsize(name) // 4
+            self.data = np.memmap(name, dtype='<i2', mode='r',
+                                  shape=(frames, 2)) if frames else \
+                np.zeros((0, 2), dtype='<i2')
+        elif magic:
+            frames = os.path.getsize(name) // 8
+            self.data = np.memmap(name, dtype=np.complex64, mode='r',
+                                  shape=(frames,)) if frames else \
+                np.zeros(0, dtype=np.complex64)
+        else:
+            self.data = np.zeros(0, dtype=np.complex64)
+
+    def refresh(self):
+        """Maps the frames appended since the file was opened, for
+        captures that are still being recorded. Returns the number of
+        frames"""
+        self.open()
+        return len(self.data)
+
+    def iscomplex(self):
+        """True if samples are stored as complex numbers"""
+        return np.iscomplexobj(self.data)
+
+    def iq(self, offset=0, n_frames=None, dtype=None):
+        """Returns up to n_frames (default: all) complex samples starting
+        at offset. Complex files are returned as views without copying
+        unless a different dtype is requested, 16 bit frames are widened
+        to dtype (default complex128)"""
+        if n_frames is None:
+            n_frames = len(self.data)
+        frames = self.data[offset:offset + max(0, n_frames)]
+        if self.iscomplex() and (dtype is None or frames.dtype == dtype):
+            metrics.add('read_frames', len(frames))
+            metrics.add('read_bytes', frames.nbytes)
+            return frames
+        if not metrics.active:
+            return widen(frames, dtype)
+        began = time.time()
+        result = widen(frames, dtype)
+        metrics.add('decode_seconds', time.time() - began)
+        metrics.add('read_frames', len(frames))
+        metrics.add('read_bytes', frames.nbytes)
+        return result
+
+    def blocks(self, offset=0, n_frames=None, size=1 << 20, dtype=None):
+        """Yields the samples of up to n_frames (default: all) frames from
+        offset in blocks of at most size frames"""
+        if n_frames is None:
+            n_frames = len(self.data)
+        end = min(len(self.data), offset + n_frames)
+        for first in range(offset, end, size):
+            yield self.iq(first, min(size, end - first), dtype)
+
+    # wave.Wave_read compatible interface
+
+    def getnchannels(self):
+        """Number of channels, I and Q count as one each"""
+        return 2
+
+    def getsampwidth(self):
+        """Bytes per sample of one channel"""
+        return self.data.dtype.itemsize // (1 if self.data.ndim > 1 else 2)
+
+    def getframerate(self):
+        """Sampling rate, 0 if the file does not record it"""
+        return self.framerate
+
+    def getnframes(self):
+        """Number of I/Q frames"""
+        return len(self.data)
+
+    def getcomptype(self):
+        """Compression type, always uncompressed"""
+        return 'NONE'
+
+    def setpos(self, pos):
+        """Set the frame position for readframes()"""
+        if pos < 0 or pos > len(self.data):
+            raise ValueError('position not in range')
+        self.position = pos
+
+    def tell(self):
+        """Current frame position"""
+        return self.position
+
+    def rewind(self):
+        """Rewind to the first frame"""
+        self.position = 0
+
+    def readframes(self, n_frames):
+        """Returns the raw bytes of up to n_frames frames from the current
+        position and advances it"""
+        frames = self.data[self.position:self.position + n_frames]
+        self.position += len(frames)
+        return frames.tostring()
+
+    def close(self):
+        """Release the mapping"""
+        self.data = None
+
+
+class IQArray(object):
+    """Lazily widened range of an IQFile. Behaves like a one dimensional
+    array of complex samples: slicing widens just the sliced frames,
+    np.asarray() widens the whole range"""
+    def __init__(self, iq_file, offset=0, length=None, dtype=np.complex64):
+        self.file = iq_file
+        self.offset = offset
+        available = max(0, iq_file.getnframes() - offset)
+        self.length = available if length is None else min(length, available)
+        self.dtype = np.dtype(dtype)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            first, last, stride = key.indices(self.length)
+            samples = self.file.iq(self.offset + first, max(0, last - first),
+                                   self.dtype)
+            return samples[::stride] if stride != 1 else samples
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError('index out of range')
+        return self.file.iq(self.offset + key, 1, self.dtype)[0]
+
+    def __array__(self, dtype=None):
+        samples = self.file.iq(self.offset, self.length, self.dtype)
+        return samples if dtype is None else samples.astype(dtype)
+
+    def view(self, first, last):
+        """Lazy sub range [first, last)"""
+        last = min(last, self.length)
+        return IQArray(self.file, self.offset + first, max(0, last - first),
+                       self.dtype)
@@ -0,0 +1,83 @@
+from iqindex import ChunkIndex, chunk_stats, open_index, sidecar_name
+from iqfile import IQFile
+import unittest as ut
+import numpy as np
+import tempfile
+import os
+
+class CaptureFixture(ut.TestCase):
+    """Test fixture with a cs16 capture containing silent stretches"""
+    def setUp(self):
+        self.name = tempfile.mktemp(suffix='.cs16')
+        self.frames = np.random.RandomState(5).randint(
+            -1000, 1000, (1000, 2)).astype('<i2')
+        self.frames[200:500] = 0
+        self.frames.tofile(self.name)
+
+    def tearDown(self):
+        for name in (self.name, sidecar_name(self.name)):
+            if os.path.exists(name):
+                os.unlink(name)
+
+class ChunkStatsSummarizeEveryChunk(ut.TestCase):
+    def runTest(self):
+        samples = np.arange(10) * (1 + 1j)
+        stats = chunk_stats(samples, 4)
+        assert len(stats) == 3
+        assert stats['sum'][1] == 22 + 22j
+        assert stats['sumsq'][2] == 2 * (64 + 81)
+        assert abs(stats['peak'][2] - 9 * np.sqrt(2)) < 1e-5
+        assert stats['power'][2] == 145
+
+class IndexIsStoredAsSidecar(CaptureFixture):
+    def runTest(self):
+        index = open_index(IQFile(self.name), 100)
+        assert index.updated == 10
+        assert os.path.exists(sidecar_name(self.name))
+        loaded = ChunkIndex.load(self.name)
+        assert loaded.chunk_size == 100
+        assert loaded.isvalid(IQFile(self.name))
+        assert open_index(IQFile(self.name), 100).updated == 0
+        np.testing.assert_array_equal(loaded.stats, index.stats)
+
+class IndexOnlyComputesAppendedChunks(CaptureFixture):
+    def runTest(self):
+        index = open_index(IQFile(self.name), 100)
+        with open(self.name, 'ab') as fh:
+            fh.write(self.frames[:150].tostring())
+        os.utime(self.name, (0, 0))
+        assert index.update(IQFile(self.name)) == 2
+        rebuilt = ChunkIndex(100)
+        assert rebuilt.update(IQFile(self.name)) == 12
+        np.testing.assert_array_equal(index.stats, rebuilt.stats)
+
+class IndexIsRebuiltWhenCaptureIsRewritten(CaptureFixture):
+    def runTest(self):
+        index = open_index(IQFile(self.name), 100)
+        (self.frames + 1).tofile(self.name)
+        os.utime(self.name, (0, 0))
+        assert index.update(IQFile(self.name)) == 10
+
+class IndexIsRebuiltWhenChunksAreRewrittenInPlace(CaptureFixture):
+    def runTest(self):
+        index = open_index(IQFile(self.name), 100)
+        assert index.stats['power'][3] == 0
+        # signal in a silent middle chunk, the size stays the same
+        self.frames[300:400] = 500
+        self.frames.tofile(self.name)
+        os.utime(self.name, (0, 0))
+        index = open_index(IQFile(self.name), 100)
+        assert index.updated == 10
+        assert index.stats['power'][3] == 500000
+        assert index.active_ranges(0, 1000, 10) == \
+            [(0, 209), (291, 118), (491, 509)]
+
+class ActiveRangesSkipSilentChunks(CaptureFixture):
+    def runTest(self):
+        index = open_index(IQFile(self.name), 100)
+        assert index.active_ranges(0, 1000, 10) == [(0, 209), (491, 509)]
+        assert index.active_ranges(600, 100, 10) == [(600, 100)]
+        assert index.active_ranges(0, 1000, 10, min_power=1e9) == []
+
+if __name__ == '__main__':
+    ut.main()
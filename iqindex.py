@@ -0,0 +1,183 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""\
+Sidecar chunk statistics for IQ captures
+
+The index of a capture FILE is stored next to it as FILE.idx.npz and
+holds, for every chunk of chunk_size frames, the sum and the sum of
+squared magnitudes of its samples (accumulated in double precision), the
+peak magnitude and the mean power.
+
+The index remembers size and modification time of the capture. When the
+capture grew and the first and last complete chunks of the index still
+match, only the new chunks are computed (the capture is being recorded).
+Any other change, such as a capture rewritten in place at the same size,
+rebuilds the index.
+
+Searches use the index to skip all offsets whose windows lie entirely in
+chunks with a mean power at or below a limit. With the default limit of
+zero only digital silence is skipped, where the correlation is undefined
+and can never reach the threshold.
+"""
+
+import os
+import numpy as np
+
+# number of frames summarized per chunk
+CHUNK_SIZE = 1 << 16
+
+# number of chunks computed per read
+CHUNK_BATCH = 64
+
+STATS_DTYPE = np.dtype([('sum', np.complex128),
+                        ('sumsq', np.float64),
+                        ('peak', np.float32),
+                        ('power', np.float32)])
+
+
+def sidecar_name(name):
+    """File name of the index of capture name"""
+    return name + '.idx.npz'
+
+
+def chunk_stats(samples, chunk_size):
+    """Returns STATS_DTYPE records for consecutive chunks of samples, the
+    last one possibly shorter"""
+    count = -(-len(samples) // chunk_size)
+    stats = np.zeros(count, dtype=STATS_DTYPE)
+    full = len(samples) // chunk_size
+    parts = [(slice(0, full), samples[:full * chunk_size].reshape(-1, chunk_size))]
+    if full < count:
+        parts.append((slice(full, count), samples[full * chunk_size:].reshape(1, -1)))
+
+    for rows, chunks in parts:
+        squares = (np.square(chunks.real, dtype=np.float64)
+                   + np.square(chunks.imag, dtype=np.float64))
+        stats['sum'][rows] = chunks.sum(axis=1, dtype=np.complex128)
+        stats['sumsq'][rows] = squares.sum(axis=1)
+        stats['peak'][rows] = np.sqrt(squares.max(axis=1))
+        stats['power'][rows] = stats['sumsq'][rows] / chunks.shape[1]
+    return stats
+
+
+class ChunkIndex(object):
+    """Per-chunk statistics of a capture. updated is the number of chunks
+    computed by the last update()"""
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.updated = 0
+        self.frames = 0
+        self.size = -1
+        self.mtime = -1.0
+        self.stats = np.zeros(0, dtype=STATS_DTYPE)
+
+    @classmethod
+    def load(cls, name):
+        """Loads the sidecar index of capture name, None if there is none"""
+        try:
+            with np.load(sidecar_name(name)) as stored:
+                index = cls(int(stored['chunk_size']))
+                index.frames = int(stored['frames'])
+                index.size = int(stored['size'])
+                index.mtime = float(stored['mtime'])
+                index.stats = stored['stats']
+        except (IOError, KeyError, ValueError):
+            return None
+        return index
+
+    def save(self, name):
+        """Writes the sidecar index of capture name"""
+        target = sidecar_name(name)
+        temporary = target + '.tmp'
+        with open(temporary, 'wb') as fh:
+            np.savez(fh, chunk_size=self.chunk_size, frames=self.frames,
+                     size=self.size, mtime=self.mtime, stats=self.stats)
+        os.rename(temporary, target)
+
+    def isvalid(self, iq_file):
+        """True if the index is up to date with the capture"""
+        status = os.stat(iq_file.name)
+        return (self.size == status.st_size and self.mtime == status.st_mtime
+                and self.frames == iq_file.getnframes())
+
+    def matches(self, iq_file, chunk):
+        """True if the stored statistics of a complete chunk still match"""
+        first = chunk * self.chunk_size
+        stats = chunk_stats(iq_file.iq(first, self.chunk_size, np.complex128),
+                            self.chunk_size)
+        return (len(stats) == 1 and stats['sum'][0] == self.stats['sum'][chunk]
+                and stats['sumsq'][0] == self.stats['sumsq'][chunk])
+
+    def update(self, iq_file):
+        """Brings the index up to date with the capture and returns the
+        number of chunks that had to be computed"""
+        if self.isvalid(iq_file):
+            self.updated = 0
+            return 0
+
+        frames = iq_file.getnframes()
+        complete = self.frames // self.chunk_size
+        keep = 0
+        # frames written in place leave the length as it is
+        if (frames > self.frames and complete > 0
+                and self.matches(iq_file, 0)
+                and self.matches(iq_file, complete - 1)):
+            keep = complete
+
+        parts = [self.stats[:keep]]
+        batch = self.chunk_size * CHUNK_BATCH
+        for first in range(keep * self.chunk_size, frames, batch):
+            samples = iq_file.iq(first, min(batch, frames - first),
+                                 np.complex128)
+            parts.append(chunk_stats(samples, self.chunk_size))
+
+        status = os.stat(iq_file.name)
+        self.stats = np.concatenate(parts)
+        self.frames = frames
+        self.size = status.st_size
+        self.mtime = status.st_mtime
+        self.updated = len(self.stats) - keep
+        return self.updated
+
+    def active_ranges(self, start, count, length, min_power=0.0):
+        """Splits the haystack range of count frames from start into the
+        (start, count) ranges that have to be searched for needles of up
+        to length frames: windows lying entirely in chunks with a mean
+        power at or below min_power are left out"""
+        end = min(start + count, self.frames)
+        loud = np.nonzero(self.stats['power'] > min_power)[0]
+
+        ranges = []
+        for chunk in loud:
+            first = max(start, chunk * self.chunk_size - length + 1)
+            last = min(end - length + 1,
+                       (chunk + 1) * self.chunk_size)
+            if first >= last:
+                continue
+            # ranges closer than a needle length are merged, so the tail
+            # offsets of shorter needles are never searched twice
+            if ranges and first <= ranges[-1][1] + length:
+                ranges[-1][1] = max(ranges[-1][1], last)
+            else:
+                ranges.append([first, last])
+        return [(first, last - first + length - 1) for first, last in ranges]
+
+    def totals(self):
+        """Mean, standard deviation and peak magnitude of the whole
+        capture, computed from the chunk statistics"""
+        if not self.frames:
+            return 0j, 0.0, 0.0
+        mean = self.stats['sum'].sum() / self.frames
+        power = self.stats['sumsq'].sum() / self.frames
+        std = np.sqrt(max(0.0, power - abs(mean) ** 2))
+        return mean, std, float(self.stats['peak'].max())
+
+
+def open_index(iq_file, chunk_size=CHUNK_SIZE):
+    """Returns the up to date index of an iqfile.IQFile, building or
+    extending its sidecar file as needed"""
+    index = ChunkIndex.load(iq_file.name)
+    if index is None or index.chunk_size != chunk_size:
+        index = ChunkIndex(chunk_size)
+    if index.update(iq_file):
+        index.save(iq_file.name)
+    return index
@@ -0,0 +1,163 @@
+from iqserver import Captures, MemoryPatternCache, Server, prepare, claim
+from iqclient import Client
+import iqfile
+import iqdump
+import synthiq
+import unittest as ut
+import numpy as np
+import multiprocessing
+import threading
+import StringIO
+import tempfile
+import shutil
+import sys
+import os
+
+SETTINGS = {'--cache': None, '--cache-size': '0', '--memory': '16',
+            '--files': '4'}
+
+class CaptureFixture(ut.TestCase):
+    """Test fixture with a directory holding a cs16 capture that contains
+    a burst, and the burst as pattern"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.burst = synthiq.pattern(128, 1)
+        samples, self.offsets = synthiq.capture(20000, self.burst, bursts=2,
+                                                snr=10, seed=5)
+        self.capture = os.path.join(self.directory, 'capture.cs16')
+        synthiq.write_cs16(self.capture, samples)
+        self.pattern = os.path.join(self.directory, 'burst.npy')
+        np.save(self.pattern, self.burst.astype(np.complex64))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+class CapturesStayMappedUntilTheyChange(CaptureFixture):
+    def runTest(self):
+        captures = Captures(capacity=1)
+        first = captures(self.capture)
+        assert captures(self.capture) is first
+        with open(self.capture, 'ab') as fh:
+            fh.write('\0' * 400)
+        grown = captures(self.capture)
+        assert grown is not first
+        assert grown.getnframes() == 20100
+        captures(self.pattern)
+        assert first.data is not None and grown.data is None
+        assert (captures.hits, captures.misses) == (1, 3)
+
+class PreparedPatternsAreKeptInMemory(CaptureFixture):
+    def runTest(self):
+        cache = MemoryPatternCache(capacity=4000)
+        burst = iqfile.IQFile(self.pattern)
+        pattern = cache.pattern(burst, 'burst', np.complex64)
+        pattern.spectrum(256)
+        assert cache.pattern(burst, 'burst', np.complex64) is pattern
+        assert cache.pattern(burst, 'other', np.complex64) is not pattern
+        # the spectrum does not fit next to a second pattern
+        assert cache.pattern(burst, 'burst', np.complex64) is not pattern
+        assert (cache.hits, cache.misses) == (1, 3)
+
+class ServerFixture(CaptureFixture):
+    """Daemon with one worker listening on a socket in the fixture
+    directory"""
+    def setUp(self):
+        CaptureFixture.setUp(self)
+        self.socket = os.path.join(self.directory, 'daemon.sock')
+        self.pool = multiprocessing.Pool(1, prepare, (SETTINGS,))
+        self.server = Server(self.socket, self.pool)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        self.pool.terminate()
+        self.pool.join()
+        CaptureFixture.tearDown(self)
+
+class RequestsRunLikeParseiq(ServerFixture):
+    def runTest(self):
+        client = Client(self.socket)
+        try:
+            for _ in range(2):
+                status, out, err, latency = client.request(
+                    ['search', '-t', '0.5', 'capture.cs16', 'burst.npy'],
+                    self.directory)
+                assert status == 0
+                lines = out.splitlines()
+                assert lines[0] == 'pattern,offset,position,score,real,imag'
+                assert [int(line.split(',')[1]) for line in lines[1:]] == \
+                    list(self.offsets)
+                assert 'done, 2 peaks' in err
+                assert latency['seconds'] >= latency['run_seconds'] > 0
+            # the second request found the pattern prepared by the first
+            assert 'pattern cache: 1 hits, 1 misses' in err
+
+            status, out, err, _ = client.request(
+                ['dump', '-f', '2', '--format', 'raw', self.capture])
+            assert status == 0
+            assert out == open(self.capture, 'rb').read(8)
+
+            stats = client.stats()
+            assert stats['search']['requests'] == 2
+            assert stats['dump']['requests'] == 1
+        finally:
+            client.close()
+
+class Recorder(object):
+    """Output file that keeps every write"""
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def flush(self):
+        pass
+
+class OutputIsStreamedInChunks(ServerFixture):
+    def runTest(self):
+        client = Client(self.socket)
+        try:
+            # longer than one block of a text dump
+            capture = os.path.join(self.directory, 'long.cs16')
+            synthiq.write_cs16(capture, np.tile(
+                synthiq.capture(20000, self.burst, seed=5)[0], 4))
+            recorder = Recorder()
+            status, out, err, _ = client.request(
+                ['dump', capture], out=recorder)
+            assert status == 0 and out is None
+            expected = StringIO.StringIO()
+            iqdump.dump(iqfile.IQFile(capture), expected)
+            # the blocks are sent as messages of their own
+            assert len(recorder.writes) > 1
+            assert ''.join(recorder.writes) == expected.getvalue()
+        finally:
+            client.close()
+
+class InvalidRequestsFail(ServerFixture):
+    def runTest(self):
+        client = Client(self.socket)
+        try:
+            status, out, err, _ = client.request(['index', self.capture])
+            assert status == 1 and 'search, peaksearch, dump' in err
+            status, out, err, _ = client.request(['search', '--bogus'])
+            assert status == 2 and err.startswith('Usage:')
+            status, out, err, _ = client.request(
+                ['search', self.capture, 'missing.npy'], self.directory)
+            assert status == 1 and 'missing.npy' in err
+        finally:
+            client.close()
+
+class ARunningDaemonIsNotReplaced(ServerFixture):
+    def runTest(self):
+        self.assertRaises(ValueError, claim, self.socket)
+        stale = os.path.join(self.directory, 'stale.sock')
+        Server(stale, None).server_close()
+        claim(stale)
+        assert not os.path.exists(stale)
+
+if __name__ == '__main__':
+    ut.main()
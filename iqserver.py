@@ -0,0 +1,400 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""\
+Usage:  iqserver.py [-j WORKERS] [--socket PATH] [--cache DIR] [--cache-size MB]
+                    [--memory MB] [--files N]
+
+Long running search daemon for parseiq.py requests
+
+Every parseiq.py invocation pays for starting the interpreter, importing
+numpy, mapping the capture, loading the patterns and transforming them.
+The daemon pays that once. It listens on a Unix domain socket for the
+search, peaksearch and dump commands of parseiq.py, which iqclient.py
+sends with their command line and working directory, and runs them on a
+pool of worker processes forked at startup. Concurrent requests are
+queued for the next idle worker.
+
+Every worker keeps what its requests used warm:
+
+    captures    the mappings of captures and pattern files, which are
+                mapped again when a file grows or changes
+    patterns    prepared patterns (samples, statistics and spectra, FFT
+                sizes are only ever planned once), kept in memory in
+                front of the on-disk pattern cache (see patcache)
+
+Requests run in a worker process each, so -j of a request is ignored:
+the daemon's workers correlate requests in parallel instead. The
+connection of the client is handed to the worker running its request,
+which streams standard output and log messages straight to the client
+in chunks while the command runs: a dump is never held in memory as a
+whole. The latency of every request (time queued for a worker and time
+run) is logged, sent to the client, and summed up per command by the
+stats request.
+
+The socket is only accessible by the user running the daemon.
+
+Options:
+        -h --help       Show this help message and exit
+        -j WORKERS      Number of worker processes, 0 for one per core [default: 0]
+        --socket PATH   Unix domain socket to listen on, $PARSEIQ_SOCKET or
+                        parseiq.sock in $XDG_RUNTIME_DIR (/tmp/parseiq-UID.sock
+                        without one) if not given
+        --cache DIR     Directory of the on-disk pattern cache
+                        (see parseiq.py)
+        --cache-size MB  Size limit of the on-disk pattern cache, 0 to
+                        disable it [default: 256]
+        --memory MB     Size of the prepared patterns every worker keeps in
+                        memory, least recently used ones are dropped [default: 256]
+        --files N       Number of captures every worker keeps mapped [default: 64]
+"""
+
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+import logging
+import threading
+import traceback
+import SocketServer
+import multiprocessing
+from multiprocessing import reduction
+from collections import OrderedDict
+
+from docopt import docopt
+
+import iqfile
+import xcorr
+import patcache
+import parseiq
+from iqclient import default_socket, send_message, receive_message
+
+# parseiq.py commands the daemon runs
+COMMANDS = ('search', 'peaksearch', 'dump')
+
+# bytes of output collected into one message to the client
+CHUNK = 1 << 16
+
+log = logging.getLogger('iqserver')
+
+
+class Captures(object):
+    """iqfile.IQFile opener that keeps up to capacity files mapped.
+    Files are mapped again when their size or modification time changed"""
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.files = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, name):
+        path = os.path.abspath(name)
+        stat = os.stat(path)
+        version = (stat.st_size, stat.st_mtime, stat.st_ino)
+        entry = self.files.pop(path, None)
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+        else:
+            self.misses += 1
+            entry = (version, iqfile.IQFile(name))
+        self.files[path] = entry
+        while len(self.files) > self.capacity:
+            self.files.popitem(last=False)[1][1].close()
+        return entry[1]
+
+
+class MemoryPatternCache(object):
+    """Prepared xcorr.Patterns kept in memory, in front of an optional
+    patcache.PatternCache. Holds at most capacity bytes of samples and
+    spectra, least recently used patterns are dropped first"""
+    def __init__(self, capacity=256 << 20, backing=None):
+        self.capacity = capacity
+        self.backing = backing
+        self.patterns = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def pattern(self, iq_file, name=None, dtype=None):
+        """Prepared pattern of an iqfile.IQFile, see
+        patcache.PatternCache.pattern"""
+        stat = os.stat(iq_file.name)
+        key = (os.path.abspath(iq_file.name), stat.st_size, stat.st_mtime,
+               stat.st_ino, name, str(dtype))
+        pattern = self.patterns.pop(key, None)
+        if pattern is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            if self.backing is not None:
+                pattern = self.backing.pattern(iq_file, name, dtype)
+            else:
+                pattern = xcorr.Pattern(iq_file.iq(dtype=dtype), name)
+        self.patterns[key] = pattern
+        self.evict()
+        return pattern
+
+    def size(self):
+        """Bytes of samples and spectra held"""
+        return sum(pattern.samples.nbytes +
+                   sum(spectrum.nbytes for spectrum in pattern.spectra.values())
+                   for pattern in self.patterns.values())
+
+    def evict(self):
+        """Drops least recently used patterns until the cache fits its
+        capacity, but keeps the most recent one"""
+        while len(self.patterns) > 1 and self.size() > self.capacity:
+            self.patterns.popitem(last=False)
+
+
+# warm state of a worker process, set up by prepare()
+state = {}
+
+
+def prepare(settings):
+    """Worker process initializer"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # log messages of requests are sent to the clients
+    logging.getLogger('').setLevel(logging.INFO)
+    backing = patcache.from_options(settings['--cache'],
+                                    settings['--cache-size'])
+    state['captures'] = Captures(int(settings['--files']))
+    state['patterns'] = MemoryPatternCache(
+        int(float(settings['--memory']) * (1 << 20)), backing)
+
+
+class Stream(object):
+    """File object that sends what is written to it over a connection as
+    messages of the named stream, in chunks of about size bytes. Once
+    sending failed (the client is gone) the stream drops all output"""
+    def __init__(self, connection, name, size=CHUNK):
+        self.connection = connection
+        self.name = name
+        self.size = size
+        self.pending = []
+        self.buffered = 0
+        self.broken = False
+
+    def send(self, data):
+        """Send data as one message"""
+        try:
+            send_message(self.connection, {'stream': self.name}, data)
+        except socket.error:
+            self.broken = True
+            raise
+
+    def write(self, data):
+        """Queue data, sending the queue once it holds size bytes"""
+        if self.broken:
+            return
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if len(data) >= self.size:
+            # large blocks (of dumps) are sent as they are
+            self.flush()
+            self.send(data)
+            return
+        self.pending.append(str(data))
+        self.buffered += len(data)
+        if self.buffered >= self.size:
+            self.flush()
+
+    def flush(self):
+        """Send what is queued"""
+        if self.pending and not self.broken:
+            data = ''.join(self.pending)
+            self.pending = []
+            self.buffered = 0
+            self.send(data)
+
+
+def execute(request):
+    """Runs a request in a worker, streaming its output and log messages
+    to the connection handed over with it. Returns (status, start time,
+    end time)"""
+    started = time.time()
+    connection = reduction.rebuild_socket(*request['connection'])
+    out = Stream(connection, 'out')
+    err = Stream(connection, 'err')
+    console = logging.StreamHandler(err)
+    console.setLevel(logging.INFO)
+    console.setFormatter(logging.Formatter(
+        '%(name)-12s: %(levelname)-8s %(message)s'))
+    root = logging.getLogger('')
+    root.addHandler(console)
+    stdout, sys.stdout = sys.stdout, out
+    status = 0
+    try:
+        # JSON decodes to unicode, command lines are byte strings
+        os.chdir(request['cwd'].encode('utf-8'))
+        arguments = docopt(parseiq.__doc__, [word.encode('utf-8')
+                                             for word in request['argv']])
+        if parseiq.command(arguments) not in COMMANDS:
+            raise ValueError('the daemon runs {} requests only'.format(
+                ', '.join(COMMANDS)))
+        # requests are correlated in parallel, not their blocks
+        arguments['-j'] = '1'
+        parseiq.execute(arguments, state['captures'], state['patterns'])
+    except SystemExit, e:
+        # usage errors and --help
+        if e.code not in (None, 0):
+            err.write('{}\n'.format(e.code))
+            status = 2
+    except Exception, e:
+        # also when the client went away, then nothing is sent
+        err.write(traceback.format_exc())
+        status = 1
+    finally:
+        sys.stdout = stdout
+        root.removeHandler(console)
+        try:
+            out.flush()
+            err.flush()
+        except socket.error:
+            status = status or 1
+        connection.close()
+    return status, started, time.time()
+
+
+class Latency(object):
+    """Per command count, total, maximum and recent latencies of
+    requests"""
+    recent = 1000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = {}
+
+    def add(self, command, queued, seconds):
+        """Record a request of command"""
+        with self.lock:
+            entry = self.commands.setdefault(command, {
+                'requests': 0, 'queued_seconds': 0.0, 'seconds': 0.0,
+                'max_seconds': 0.0, 'latencies': []})
+            entry['requests'] += 1
+            entry['queued_seconds'] += queued
+            entry['seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            entry['latencies'] = (entry['latencies'] + [seconds])[-self.recent:]
+
+    def report(self):
+        """Dict with the statistics of every command, latencies are
+        total times from receiving a request to its result"""
+        with self.lock:
+            report = {}
+            for command, entry in self.commands.items():
+                recent = sorted(entry['latencies'])
+                report[command] = {
+                    'requests': entry['requests'],
+                    'mean_seconds': entry['seconds'] / entry['requests'],
+                    'mean_queued_seconds':
+                        entry['queued_seconds'] / entry['requests'],
+                    'median_seconds': recent[len(recent) // 2],
+                    'p95_seconds': recent[int(0.95 * (len(recent) - 1))],
+                    'max_seconds': entry['max_seconds']}
+            return report
+
+
+class Handler(SocketServer.StreamRequestHandler):
+    """Runs the requests of one connection on the worker pool"""
+    def handle(self):
+        while True:
+            try:
+                request, _ = receive_message(self.rfile)
+            except EOFError:
+                return
+            received = time.time()
+            if request.get('stats'):
+                send_message(self.connection,
+                             {'status': 0,
+                              'stats': self.server.latency.report()})
+                continue
+
+            # the worker writes to the connection itself
+            request['connection'] = reduction.reduce_socket(self.connection)[1]
+            status, started, finished = \
+                self.server.pool.apply_async(execute, (request,)).get()
+            total = time.time() - received
+            latency = {'queued_seconds': max(0.0, started - received),
+                       'run_seconds': finished - started,
+                       'seconds': total}
+            command = next((word for word in request['argv']
+                            if word in COMMANDS), 'invalid')
+            self.server.latency.add(command, latency['queued_seconds'], total)
+            log.info("{} {} in {:.1f} ms ({:.1f} ms queued)".format(
+                command, 'done' if status == 0 else 'failed', 1000 * total,
+                1000 * latency['queued_seconds']))
+            try:
+                send_message(self.connection,
+                             {'status': status, 'latency': latency})
+            except socket.error:
+                return
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Unix domain socket server with a worker pool"""
+    daemon_threads = True
+
+    def __init__(self, path, pool):
+        self.pool = pool
+        self.latency = Latency()
+        # only the user may connect
+        umask = os.umask(0o077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path, Handler)
+        finally:
+            os.umask(umask)
+
+
+def claim(path):
+    """Removes a stale socket at path. Raises ValueError if a daemon is
+    listening on it"""
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error, e:
+        if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+            raise
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise ValueError('a daemon is already listening on {}'.format(path))
+
+
+def serve(settings):
+    """Runs the daemon until it is interrupted or terminated"""
+    path = settings['--socket'] or default_socket()
+    claim(path)
+    workers = int(settings['-j']) or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(workers, prepare, (settings,))
+    server = Server(path, pool)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    log.info("listening on {} with {} workers".format(path, workers))
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+        pool.terminate()
+        pool.join()
+        log.info("stopped")
+
+
+def main():
+    """entry point"""
+    settings = docopt(__doc__)
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(
+        '%(asctime)s %(name)-12s: %(levelname)-8s %(message)s'))
+    log.addHandler(console)
+    log.setLevel(logging.INFO)
+    # request logs are only sent back to the clients
+    log.propagate = False
+    serve(settings)
+
+if __name__ == '__main__':
+    main()
@@ -1,57 +1,190 @@
 # coding=utf-8
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
-"""Usage:   parseiq.py dump [-o OFFSET] [-f FRAMES] FILE
-            parseiq.py peaksearch [-b BLOCKSIZE] [-s SKIPFRAMES] [-f FRAMES] FILE
-            parseiq.py search [-t THRESHOLD] FILE PATTERN_FILE
+"""Usage:   parseiq.py dump [-o OFFSET] [-f FRAMES] [--format FORMAT] [--profile-out FILE]
+                               [--metrics-out FILE] [--cprofile FILE] FILE
+            parseiq.py peaksearch [-b BLOCKSIZE] [-s SKIPFRAMES] [-o OFFSET] [-f FRAMES] [-w SEGMENTS]
+                                  [--window NAME] [-j WORKERS] [--out FILE] [--profile-out FILE]
+                                  [--metrics-out FILE] [--cprofile FILE] FILE
+            parseiq.py search [-t THRESHOLD] [-o OFFSET] [-f FRAMES] [--block FRAMES] [-j WORKERS]
+                              [--separation FRAMES] [--top K] [--subsample] [--out FILE]
+                              [--index] [--min-power POWER] [--chunk FRAMES]
+                              [--pyramid FACTOR] [--coarse-threshold THRESHOLD] [--margin FRAMES]
+                              [--cfo RANGE] [--follow [--poll SECONDS] [--idle SECONDS]]
+                              [--prefetch DEPTH] [--cache DIR] [--cache-size MB]
+                              [--precision NAME] [--profile-out FILE] [--metrics-out FILE]
+                              [--cprofile FILE] FILE PATTERN_FILE...
+            parseiq.py index [--chunk FRAMES] [--profile-out FILE] [--metrics-out FILE]
+                             [--cprofile FILE] FILE
+            parseiq.py batch [-t THRESHOLD] [--block FRAMES] [-j WORKERS] [--separation FRAMES]
+                             [--top K] [--subsample] [--out FILE] [--checkpoint FILE]
+                             [--list FILE] [--cache DIR] [--cache-size MB] [--precision NAME]
+                             [--profile-out FILE] [--metrics-out FILE] [--cprofile FILE]
+                             PATTERN_FILE [HAYSTACK...]
+            parseiq.py plan [--shards N] [-t THRESHOLD] [-o OFFSET] [-f FRAMES] [--block FRAMES]
+                            [--separation FRAMES] [--top K] [--subsample] [--precision NAME]
+                            [--dir DIR] [--profile-out FILE] [--metrics-out FILE]
+                            [--cprofile FILE] FILE PATTERN_FILE...
+            parseiq.py run-shard [-j WORKERS] [--prefetch DEPTH] [--cache DIR] [--cache-size MB]
+                                 [--result FILE] [--profile-out FILE] [--metrics-out FILE]
+                                 [--cprofile FILE] SHARD
+            parseiq.py merge [--out FILE] [--profile-out FILE] [--metrics-out FILE]
+                             [--cprofile FILE] RESULT...
 
 Arguments:
-    FILE            input file (WAV, IQ data))
-    PATTERN_FILE    input file used as search pattern (WAV, IQ data)
+    FILE            input file (WAV, complex64 or cs16 NPY, IQ data))
+    PATTERN_FILE    input file used as search pattern (WAV, complex64 or cs16 NPY, IQ data),
+                    or a directory of such files. all patterns are searched
+                    in a single pass over FILE
+    HAYSTACK        capture to search in batch mode, or a glob pattern
+                    of captures (quote it to avoid the shell limits)
+    SHARD           shard descriptor (JSON) written by plan
+    RESULT          result of a shard (NPZ) written by run-shard. merge needs
+                    those of all shards of a plan
 
 Options:
     -h --help       show this help message and exit
     -b BLOCKSIZE    blocksize for FFT [default: 1024]
-    -s SKIPFRAMES   number of frames to skip between exacting FFT blocks [default: 1]
+    -s SKIPFRAMES   number of frames to skip between exacting FFT blocks [default: 0]
+    -w SEGMENTS     average the spectra of this many half overlapping blocks
+                    per reported block (Welch) [default: 1]
+    --window NAME   FFT window: hann, hamming, blackman or rect [default: hann]
     -o OFFSET       number of frames from the beginning of the file to skip [default: 0]
     -f FRAMES       limit search to at most this number of frames
     -t THRESHOLD    correlation threshold. between -1 and +1 [default: 0.5]
+    --block FRAMES  number of offsets correlated per haystack block [default: 1048576]
+    -j WORKERS      number of correlation worker processes (FFT threads for
+                    peaksearch), 0 for one per core [default: 0]
+    --separation FRAMES  minimum distance between two reported peaks,
+                    0 for the length of the pattern [default: 0]
+    --top K         only report the K highest peaks per pattern
+    --subsample     interpolate peak position and score between frames
+    --out FILE      write (spectral) peaks to FILE: a structured array if FILE ends
+                    in .npy, CSV otherwise, JSON lines in batch mode.
+                    - for stdout [default: -]
+    --index         skip silent parts of FILE using its chunk statistics
+                    index (FILE.idx.npz), which is built or updated as needed
+    --min-power POWER  mean power per frame at or below which an indexed
+                    chunk counts as silent [default: 0]
+    --chunk FRAMES  number of frames per index chunk [default: 65536]
+    --pyramid FACTOR  search coarse to fine: correlate at a rate decimated
+                    by FACTOR first and refine candidates at full rate.
+                    0 or 1 for a full rate search [default: 0]
+    --coarse-threshold THRESHOLD  correlation threshold of the decimated
+                    search, half of -t if not given
+    --margin FRAMES  number of full rate offsets searched on both sides of
+                    a coarse candidate, 0 for FACTOR [default: 0]
+    --cfo RANGE     search every pattern at the frequency offsets LOW:HIGH:STEP
+                    (in Hz, in cycles per frame if FILE has no sampling
+                    rate) in one pass and report the best one of each
+                    peak, e.g. --cfo=-300:300:25. cannot be combined
+                    with --pyramid
+    --follow        keep searching FILE while it is recorded: new frames are
+                    searched as they are written and peaks are reported as
+                    soon as they are final. cannot be combined with an
+                    index, a pyramid or a frequency offset search
+    --poll SECONDS  how often a followed FILE is checked for new frames,
+                    which bounds the delay of a detection [default: 1]
+    --idle SECONDS  stop following FILE when it did not grow for this long,
+                    0 to follow it until interrupted [default: 0]
+    --checkpoint FILE  batch mode: append the names of completed captures
+                    to FILE and skip the captures it lists
+    --list FILE     batch mode: also search the captures listed in FILE,
+                    one per line
+    --shards N      split the search into up to N shards that can be run by
+                    separate processes or machines. shards span whole
+                    blocks, smaller searches get fewer of them [default: 4]
+    --dir DIR       directory the shard descriptors are written to [default: .]
+    --result FILE   file the result of a shard is written to, the
+                    descriptor name with .npz for .json if not given
+    --prefetch DEPTH  number of haystack blocks read ahead by a background
+                    thread while the current one is correlated, 0 to read
+                    in turns with correlating [default: 2]
+    --cache DIR     directory of the cache of prepared patterns (decoded
+                    samples, statistics and spectra). $PARSEIQ_CACHE or
+                    ~/.cache/parseiq/patterns if not given
+    --cache-size MB  size limit of the pattern cache, the least recently
+                    used entries are evicted. 0 to disable it [default: 256]
+    --precision NAME  precision samples, spectra and correlation values are
+                    kept in: single (complex64) or double (complex128).
+                    sums are always accumulated in double precision, see
+                    xcorr for the accuracy of single [default: single]
+    --profile-out FILE  sample the memory of parseiq and its workers in the
+                    background and write a JSON report with time and peak
+                    RSS per stage to FILE
+    --metrics-out FILE  collect counters (frames and bytes read, decoding,
+                    pool wait, worker busy and idle time), wall clock and
+                    CPU time per stage and section and the correlation rate,
+                    and write them to FILE: in the Prometheus text format
+                    if FILE ends in .prom (node_exporter textfile
+                    collector), as JSON otherwise
+    --cprofile FILE  run the command under cProfile and dump its statistics
+                    to FILE (pstats format, main process only)
+    --format FORMAT  dump format: complex, text (I Q columns), csv, raw (as
+                    stored), cf32 or cs16 [default: complex]
 """
 
-# https://docs.python.org/2/library/wave.html
-import wave
-
 # http://stackoverflow.com/questions/3694918/how-to-extract-frequency-associated-with-fft-values-in-python
-# https://docs.python.org/2/library/struct.html
-import struct
 import numpy as np
 
-from multiprocessing import Process, Queue
-
 # https://github.com/docopt/docopt
 from docopt import docopt
 
 import logging
-
-def read_n_iq_frames(wav_file, n_frames=None, offset=None):
-    """Reads n_frames or all frame starting from offset and
-    returns an numpy array of complex numbers"""
+import sys
+import os
+import functools
+
+import iqfile
+import xcorr
+import corrpool
+import peaks
+import iqindex
+import iqdump
+import spectrum
+import pyramid
+import prefetch
+import batch
+import cfo
+import follow
+import patcache
+import shard
+from hpmc import profiler
+from hpmc import instrument
+
+def read_n_iq_frames(wav_file, n_frames=None, offset=None, dtype=np.complex64):
+    """Reads n_frames or all frame starting from offset of an
+    iqfile.IQFile and returns an numpy array of complex numbers of dtype.
+    Only the requested range of the file is read"""
     if n_frames is None:
         n_frames = wav_file.getnframes()
 
-    if offset is not None:
-        wav_file.setpos(offset)
-    else:
+    if offset is None:
         offset = 0
 
     n_frames = min(n_frames, wav_file.getnframes()-offset)
 
-    data = np.array(struct.unpack(
-                    '<{n}h'.format(n=n_frames*wav_file.getnchannels()),
-                    wav_file.readframes(n_frames)))
+    return wav_file.iq(offset, n_frames, dtype)
 
-    result = data[0:][::2] + 1j * data[1:][::2]
 
-    return result
+def load_patterns(needles, cache=None, dtype=np.complex64):
+    """xcorr.Patterns of needles, a list of (name, wav_file) tuples,
+    decoded to dtype and prepared by a patcache.PatternCache if one is
+    given"""
+    if cache is None:
+        return [xcorr.Pattern(read_n_iq_frames(needle, dtype=dtype), name)
+                for name, needle in needles]
+    patterns = [cache.pattern(needle, name, dtype)
+                for name, needle in needles]
+    logging.info("pattern cache: {} hits, {} misses".format(cache.hits,
+                                                           cache.misses))
+    return patterns
+
+
+def open_cache(arguments):
+    """patcache.PatternCache of the command line options, None if it
+    is disabled"""
+    return patcache.from_options(arguments['--cache'],
+                                 arguments['--cache-size'])
 
 
 def correlate(first, second):
@@ -72,107 +205,322 @@ def correlate(first, second):
 
     return corr
 
-#def do_fft(data,frate):
-#    w = np.fft.fft(data)
-#    freqs = np.fft.fftfreq(len(w))
-#
-#    # Find the peak in the coefficients
-#    idx=np.argmax(np.abs(w)**2)
-#    freq=freqs[idx]
-#    freq_in_hertz=abs(freq*frate)
-#    return (freqs.min(), freqs.max(), freq_in_hertz
-#           , math.sqrt(np.sum(np.abs(w)**2))/len(w))
-
-
-def output_dump(wav_file, n_frames=None, offset=None):
-    """Dumps the provided wave file as text formatted complex numbers"""
+def output_dump(wav_file, n_frames=None, offset=None, fmt='complex'):
+    """Dumps the provided wave file to stdout in format fmt (see iqdump),
+    by default as text formatted complex numbers"""
     if not n_frames:
         n_frames = wav_file.getnframes()
 
     if not offset:
         offset = 0
 
-    iq_data = read_n_iq_frames(wav_file, n_frames, offset)
-
-    for i in range(len(iq_data)):
-        print '{iq}'.format(iq=iq_data[i])
-
-
-def worker(haystack, needle, work_queue, done_queue):
-    """Worker thread funktion to calculate correlation"""
-    needle_length = len(needle)
-
-    for task in iter(work_queue.get, 'STOP'):
-        correlation_values = []
-        for i in task:
-            correlated = correlate(haystack[i:needle_length], needle)
-            correlation_values.append(correlated)
-
-        done_queue.put([task, correlation_values])
+    iqdump.dump(wav_file, sys.stdout, fmt, offset, n_frames)
 
 
-def correlation_index(haystack, needle):
-    """Calculate correlation for all offsets of needle inside haystack"""
-    workers = 5
-    workload_size = 1000000
-    work_queue = Queue()
-    done_queue = Queue()
-    processes = []
+def correlation_index(haystack, needle, workers=None):
+    """Calculate correlation for all offsets of needle inside haystack.
+    The work is shared by a pool of workers (default: one per core) that
+    read haystack without copying it and write into a shared result"""
+    haystack = np.asarray(haystack)
+    length = max(1, len(haystack) - len(needle) + 1)
 
-    length = 1+max(0, len(haystack)-len(needle))
-
-    logging.info("generating tasks")
-    for i in range(0, length, workload_size):
-        work_queue.put(range(i, max(length, i+workload_size)))
-
-    logging.info("generated " + str(work_queue.qsize()) + " jobs")
     logging.info("setting up workers")
-    for w in xrange(workers):
-        process = Process(target=worker
-                          , args=(haystack, needle, work_queue, done_queue))
-        process.start()
-        processes.append(process)
-        work_queue.put('STOP')
-
-    logging.info("crunching...")
-    for process in processes:
-        process.join()
-
-    done_queue.put('STOP')
-
-    logging.info("consolidating...")
-    correlation_values = []
-    for result in sorted(iter(done_queue.get, 'STOP')):
-        correlation_values += result[1]
+    profiler.stage('setup workers')
+    with corrpool.CorrelationPool(needle, workers, source=haystack,
+                                  capacity=length) as pool:
+        logging.info("crunching...")
+        profiler.stage('correlate')
+        correlation_values = pool.correlations(haystack)[0]
 
     logging.info("done")
     return correlation_values
 
 
-def output_correlation_find(haystack, needle, peak_threshold, haystack_n=None, haystack_offset=None):
-    """Calculates correlation of needle with every possible
-    offset in haystack and reports location of all values that have
-    higher correlation than peak_threshold"""
+def check_follow(poll, index, pyramid_factor, frequencies):
+    """Raises ValueError if a followed search (poll) is not a plain one"""
+    if poll and (index or pyramid_factor > 1 or frequencies is not None):
+        raise ValueError('only plain searches can follow a capture')
+
+
+def output_correlation_find(haystack, needles, peak_threshold, haystack_n=None, haystack_offset=None, block_size=xcorr.BLOCK_SIZE, workers=None, out='-', separation=None, top=None, subsample=False, index=None, min_power=0.0, pyramid_factor=0, coarse_threshold=None, margin=None, prefetch_depth=0, cache=None, dtype=np.complex64, frequencies=None, poll=0, idle=0):
+    """Calculates correlation of all needles with every possible
+    offset in haystack and reports the peaks of all values that have
+    higher correlation than peak_threshold to the sink for out.
+    needles is a list of (name, wav_file) tuples. The haystack is streamed
+    in blocks of block_size offsets, every block is read once for all
+    needles and peaks are reported as soon as they are final. Blocks are
+    correlated by a pool of workers (default: one per core) unless
+    workers is 1. With a chunk index, windows in chunks whose mean power
+    is at or below min_power are skipped. With a pyramid_factor above 1
+    the search runs coarse to fine (see pyramid.search) and reports both
+    scores. Otherwise prefetch_depth blocks are read ahead in the
+    background. Prepared patterns are taken from and added to cache, a
+    patcache.PatternCache. Haystack and patterns are decoded to dtype,
+    the precision of the correlation (see xcorr). With trial
+    frequencies every pattern is searched at all of these frequency
+    offsets at once (see cfo.search) and peaks report the best one. With
+    poll seconds the haystack is followed while it is recorded (see
+    follow), until it did not grow for idle seconds"""
     if not haystack_n:
         haystack_n = haystack.getnframes()
 
     if not haystack_offset:
         haystack_offset = 0
 
-    logging.info("loading pattern...")
-    needle_iq = read_n_iq_frames(needle)
-    logging.info("loading haystack...")
-    hay_iq = read_n_iq_frames(haystack, haystack_n, haystack_offset)
-
-    logging.info("correlating...")
-    correlation_values = correlation_index(hay_iq, needle_iq)
-
-    logging.info("peak extraction...")
-    peak_idxs = np.where(correlation_values > peak_threshold)[0]
+    check_follow(poll, index, pyramid_factor, frequencies)
+
+    logging.info("loading patterns...")
+    profiler.stage('load patterns')
+    patterns = load_patterns(needles, cache, dtype)
+
+    ranges = None
+    if index:
+        ranges = index.active_ranges(haystack_offset, haystack_n,
+                                     max(pattern.length for pattern in patterns),
+                                     min_power)
+        logging.info("searching {} of {} frames".format(
+            sum(n for _, n in ranges), min(haystack_n, index.frames)))
+
+    search = peaks.search
+    open_sink = peaks.open_sink
+    correlated, source = patterns, haystack
+    if pyramid_factor > 1:
+        logging.info("decimating patterns by {}...".format(pyramid_factor))
+        # the pool correlates decimated blocks, not views of the haystack
+        correlated, source = pyramid.coarse_patterns(patterns, pyramid_factor), None
+        search = functools.partial(pyramid.search, factor=pyramid_factor,
+                                   coarse_threshold=coarse_threshold,
+                                   margin=margin or None, coarse=correlated)
+        open_sink = pyramid.open_sink
+    if frequencies is not None:
+        if pyramid_factor > 1:
+            raise ValueError('a frequency offset search cannot be decimated')
+        logging.info("shifting patterns to {} frequency offsets...".format(
+            len(frequencies)))
+        bank = cfo.Bank(patterns, frequencies, haystack.getframerate())
+        correlated = bank.members
+        search = functools.partial(cfo.search, bank=bank)
+        open_sink = cfo.open_sink
+    if poll:
+        logging.info("following haystack, checking for new frames every "
+                     "{}s...".format(poll))
+        # workers would not see the frames appended after the fork
+        source = None
+        search = functools.partial(follow.search, iq_file=haystack,
+                                   poll=poll, idle=idle, dtype=dtype)
+
+    correlate = xcorr.correlations
+    pool = None
+    if workers != 1:
+        logging.info("setting up workers...")
+        profiler.stage('setup workers')
+        pool = corrpool.CorrelationPool(correlated, workers, source=source,
+                                        capacity=block_size)
+        correlate = pool.correlations
+
+    logging.info("searching haystack...")
+    profiler.stage('search')
+    # correlation time is accounted separately from the peak extraction
+    # (and reading) time that makes up the rest of the search
+    correlate = profiler.section('correlate', correlate)
+    search = profiler.section('peak extraction', search)
+    # blocks are widened to dtype only where they are correlated
+    read_block = lambda offset, n: iqfile.IQArray(haystack, offset, n, dtype)
+    reader = None
+    if prefetch_depth and pyramid_factor <= 1 and not poll:
+        read_block = reader = prefetch.PrefetchReader(
+            read_block, prefetch.plan(haystack_offset, haystack_n, patterns,
+                                      block_size, ranges),
+            prefetch_depth, haystack)
+    sink = open_sink(out, [pattern.name for pattern in patterns])
+    try:
+        found = search(read_block, haystack_offset, haystack_n,
+                       patterns, peak_threshold, sink, block_size,
+                       correlate, separation, top, subsample, ranges)
+    finally:
+        sink.close()
+        if pool:
+            pool.close()
+        if reader:
+            reader.close()
+            logging.info("read {blocks} blocks ahead in {read_seconds:.3f}s, "
+                         "stalled {stall_seconds:.3f}s waiting for reads"
+                         .format(**reader.stats()))
+
+    logging.info("done, {} peaks".format(found))
+
+
+def output_peaksearch(wav_file, block_size, skip_frames, n_frames=None,
+                      offset=None, segments=1, window='hann', workers=None,
+                      out='-'):
+    """Reports frequency and power of the strongest FFT bin of every
+    block of block_size frames (Welch averaged over segments half
+    overlapping blocks) to the sink for out. Frequencies are in Hz if
+    the file records its sampling rate, in cycles per frame otherwise"""
+    if not offset:
+        offset = 0
 
-    logging.info("done")
-    logging.info(peak_idxs + haystack_offset)
-    logging.info(correlation_values[peak_idxs])
+    available = max(0, wav_file.getnframes() - offset)
+    if not n_frames:
+        n_frames = available
+    n_frames = min(n_frames, available)
+
+    logging.info("analyzing {} frames...".format(n_frames))
+    profiler.stage('analyze')
+    # batches are widened to complex64 only when they are transformed
+    read_batch = lambda start, n: wav_file.iq(start, n, np.complex64)
+    sink = spectrum.open_sink(out)
+    blocks = 0
+    try:
+        for records in spectrum.peaksearch(read_batch, offset, n_frames,
+                                           block_size, skip_frames, segments,
+                                           window, wav_file.getframerate(),
+                                           workers):
+            sink.write(records)
+            blocks += len(records)
+    finally:
+        sink.close()
+
+    logging.info("done, {} blocks".format(blocks))
+
+
+def output_batch(needles, haystacks, peak_threshold, out='-', checkpoint=None,
+                 block_size=xcorr.BLOCK_SIZE, workers=None, separation=None,
+                 top=None, subsample=False, cache=None, dtype=np.complex64):
+    """Searches all needles, a list of (name, wav_file) tuples, in every
+    capture of haystacks with a pool of workers (default: one per core)
+    working on one capture each, and writes the peaks as JSON lines to
+    out. Completed captures are recorded in and skipped by the
+    checkpoint file. Prepared patterns are taken from and added to
+    cache. Captures and patterns are decoded to dtype"""
+    logging.info("loading patterns...")
+    profiler.stage('load patterns')
+    patterns = load_patterns(needles, cache, dtype)
+
+    logging.info("searching {} captures...".format(len(haystacks)))
+    profiler.stage('search')
+    if out == '-':
+        sink = sys.stdout
+    else:
+        # a resumed run adds to the results of the interrupted one
+        resumed = checkpoint and os.path.exists(checkpoint)
+        sink = open(out, 'a' if resumed else 'w')
+    try:
+        searched, found, failed = batch.run(
+            patterns, haystacks, sink, checkpoint, workers, peak_threshold,
+            block_size, separation, top, subsample, dtype)
+    finally:
+        if sink is not sys.stdout:
+            sink.close()
+
+    logging.info("done, {} peaks in {} captures, {} failed".format(
+        found, searched, failed))
+
+
+def output_plan(haystack, needles, shards, peak_threshold, haystack_n=None,
+                haystack_offset=None, block_size=xcorr.BLOCK_SIZE,
+                separation=None, top=None, subsample=False,
+                precision='single', directory='.'):
+    """Splits the search of needles, a list of (name, wav_file) tuples,
+    in haystack into up to shards shards (see shard.plan), writes their
+    descriptors to directory and prints their names"""
+    logging.info("planning...")
+    profiler.stage('plan')
+    descriptors = shard.plan(haystack, needles, shards, haystack_offset or 0,
+                             haystack_n or None, peak_threshold, block_size,
+                             separation, top, subsample, precision)
+    prefix = os.path.splitext(os.path.basename(haystack.name))[0]
+    for name in shard.write_plan(descriptors, directory, prefix):
+        print name
+
+    logging.info("done, {} shards of {} frames".format(
+        len(descriptors), descriptors[0]['frames']))
+
+
+def output_shard(descriptor_file, result_file=None, workers=None,
+                 prefetch_depth=0, cache=None):
+    """Runs the shard of the descriptor in descriptor_file and writes
+    its result to result_file. Blocks are correlated by a pool of
+    workers (default: one per core) unless workers is 1, prefetch_depth
+    blocks are read ahead and prepared patterns are taken from and added
+    to cache"""
+    descriptor = shard.load_descriptor(descriptor_file)
+    if not result_file:
+        result_file = os.path.splitext(descriptor_file)[0] + '.npz'
+    haystack = iqfile.IQFile(descriptor['file'])
+    shard.check_capture(descriptor, haystack)
+    dtype = xcorr.precision(descriptor['precision'])
+
+    logging.info("loading patterns...")
+    profiler.stage('load patterns')
+    patterns = load_patterns([(name, iqfile.IQFile(path)) for name, path
+                              in shard.needles(descriptor)], cache, dtype)
+
+    correlate = xcorr.correlations
+    pool = None
+    if workers != 1:
+        logging.info("setting up workers...")
+        profiler.stage('setup workers')
+        pool = corrpool.CorrelationPool(patterns, workers, source=haystack,
+                                        capacity=descriptor['block'])
+        correlate = pool.correlations
+
+    logging.info("searching shard {} of {}...".format(
+        descriptor['shard'] + 1, descriptor['shards']))
+    profiler.stage('search')
+    correlate = profiler.section('correlate', correlate)
+    read_block = lambda offset, n: iqfile.IQArray(haystack, offset, n, dtype)
+    reader = None
+    if prefetch_depth:
+        last = descriptor['last']
+        end = descriptor['start'] + descriptor['frames'] if last is None \
+            else last + max(pattern.length for pattern in patterns) - 1
+        read_block = reader = prefetch.PrefetchReader(
+            read_block, prefetch.plan(descriptor['first'],
+                                      end - descriptor['first'], patterns,
+                                      descriptor['block']),
+            prefetch_depth, haystack)
+    try:
+        result = shard.run(descriptor, patterns, read_block, correlate)
+    finally:
+        if pool:
+            pool.close()
+        if reader:
+            reader.close()
+    shard.save(result_file, descriptor, result)
+
+    logging.info("done, {} peaks written to {}".format(
+        len(result['peaks']), result_file))
+
+
+def output_merge(result_files, out='-'):
+    """Merges the results of all shards of a plan into the peaks a single
+    search reports, and writes them to the sink for out"""
+    logging.info("merging {} shards...".format(len(result_files)))
+    profiler.stage('merge')
+    results = [shard.load(name) for name in result_files]
+    found = shard.merge(results)
+    sink = peaks.open_sink(out, [name for name, _, _ in
+                                 results[0][0]['patterns']])
+    try:
+        sink.write(found)
+    finally:
+        sink.close()
+
+    logging.info("done, {} peaks".format(len(found)))
+
+
+def output_index(iq_file, chunk_size):
+    """Builds or updates the chunk statistics index of iq_file and
+    reports a summary"""
+    logging.info("indexing...")
+    profiler.stage('index')
+    index = iqindex.open_index(iq_file, chunk_size)
+
+    mean, std, peak = index.totals()
+    logging.info("{} chunks of {} frames, {} updated".format(
+        len(index.stats), chunk_size, index.updated))
+    logging.info("mean {}, std {}, peak {}".format(mean, std, peak))
 
 def main():
     """entry point"""
@@ -194,22 +542,122 @@ def main():
     # add the handler to the root logger
     logging.getLogger('').addHandler(console)
 
-    #block_size = int(arguments['-b'])
-    #skip_frames = int(arguments['-s'])
-    #offset_frames = int(arguments['-o'])
-
-    #if arguments['peaksearch']:
-    #    output_analysis(wav_file)
+    execute(arguments)
+
+def execute(arguments, open_file=iqfile.IQFile, cache=None):
+    """runs the selected command (see run) with the profiling, metrics
+    and cProfile options"""
+    instrument.run(run, (arguments, open_file, cache)
+                   , arguments['--profile-out']
+                   , arguments['--metrics-out']
+                   , arguments['--cprofile']
+                   , labels={'command': command(arguments)})
+
+def command(arguments):
+    """Name of the selected command"""
+    for name in ('dump', 'peaksearch', 'search', 'index', 'batch', 'plan',
+                 'run-shard', 'merge'):
+        if arguments[name]:
+            return name
+
+def run(arguments, open_file=iqfile.IQFile, cache=None):
+    """runs the selected command. Captures and patterns are opened with
+    open_file, prepared patterns are taken from cache (default: the one
+    of the command line options)"""
+    if arguments['peaksearch']:
+        output_peaksearch(open_file(arguments['FILE'])
+                          , int(arguments['-b'])
+                          , int(arguments['-s'])
+                          , int(arguments['-f'] or 0)
+                          , int(arguments['-o'])
+                          , int(arguments['-w'])
+                          , arguments['--window']
+                          , int(arguments['-j'])
+                          , arguments['--out'])
 
     if arguments['dump']:
-        output_dump(wave.open(arguments['FILE'], 'r')
-                    , int(arguments['-f'])
-                    , int(arguments['-o']))
+        output_dump(open_file(arguments['FILE'])
+                    , int(arguments['-f'] or 0)
+                    , int(arguments['-o'])
+                    , arguments['--format'])
+
+    if arguments['index']:
+        output_index(open_file(arguments['FILE']), int(arguments['--chunk']))
+
+    if arguments['batch']:
+        output_batch([(name, open_file(name)) for name in
+                      xcorr.pattern_paths([arguments['PATTERN_FILE'][0]], '*.wav')]
+                     , batch.haystack_paths(arguments['HAYSTACK'], arguments['--list'])
+                     , float(arguments['-t'])
+                     , arguments['--out']
+                     , arguments['--checkpoint']
+                     , int(arguments['--block'])
+                     , int(arguments['-j'])
+                     , int(arguments['--separation'])
+                     , int(arguments['--top'] or 0) or None
+                     , arguments['--subsample']
+                     , cache or open_cache(arguments)
+                     , xcorr.precision(arguments['--precision']))
 
     if arguments['search']:
-        output_correlation_find(wave.open(arguments['FILE'], 'r')
-                                , wave.open(arguments['PATTERN_FILE'], 'r')
-                                , float(arguments['-t']))
+        # before the index of a capture that is recorded is built
+        check_follow(arguments['--follow'], arguments['--index'],
+                     int(arguments['--pyramid']), arguments['--cfo'])
+        profiler.stage('load haystack')
+        haystack = open_file(arguments['FILE'])
+        index = None
+        if arguments['--index']:
+            index = iqindex.open_index(haystack, int(arguments['--chunk']))
+        output_correlation_find(haystack
+                                , [(name, open_file(name)) for name in
+                                   xcorr.pattern_paths(arguments['PATTERN_FILE'], '*.wav')]
+                                , float(arguments['-t'])
+                                , int(arguments['-f'] or 0)
+                                , int(arguments['-o'])
+                                , int(arguments['--block'])
+                                , int(arguments['-j'])
+                                , arguments['--out']
+                                , int(arguments['--separation'])
+                                , int(arguments['--top'] or 0) or None
+                                , arguments['--subsample']
+                                , index=index
+                                , min_power=float(arguments['--min-power'])
+                                , pyramid_factor=int(arguments['--pyramid'])
+                                , coarse_threshold=(float(arguments['--coarse-threshold'])
+                                                    if arguments['--coarse-threshold'] else None)
+                                , margin=int(arguments['--margin'])
+                                , prefetch_depth=int(arguments['--prefetch'])
+                                , cache=cache or open_cache(arguments)
+                                , dtype=xcorr.precision(arguments['--precision'])
+                                , frequencies=(cfo.parse_range(arguments['--cfo'])
+                                               if arguments['--cfo'] else None)
+                                , poll=float(arguments['--poll']) if arguments['--follow'] else 0
+                                , idle=float(arguments['--idle']))
+
+    if arguments['plan']:
+        output_plan(open_file(arguments['FILE'])
+                    , [(name, open_file(name)) for name in
+                       xcorr.pattern_paths(arguments['PATTERN_FILE'], '*.wav')]
+                    , int(arguments['--shards'])
+                    , float(arguments['-t'])
+                    , int(arguments['-f'] or 0)
+                    , int(arguments['-o'])
+                    , int(arguments['--block'])
+                    , int(arguments['--separation'])
+                    , int(arguments['--top'] or 0) or None
+                    , arguments['--subsample']
+                    , arguments['--precision']
+                    , arguments['--dir'])
+
+    if arguments['run-shard']:
+        output_shard(arguments['SHARD']
+                     , arguments['--result']
+                     , int(arguments['-j'])
+                     , int(arguments['--prefetch'])
+                     , cache or open_cache(arguments))
+
+    if arguments['merge']:
+        output_merge(arguments['RESULT'], arguments['--out'])
 
 if __name__ == '__main__':
     main()
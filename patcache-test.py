@@ -0,0 +1,122 @@
+from patcache import PatternCache, CachedPattern, content_hash, from_options
+import iqfile
+import xcorr
+import synthiq
+import unittest as ut
+import numpy as np
+import tempfile
+import shutil
+import os
+
+class CacheFixture(ut.TestCase):
+    """Test fixture with a pattern WAV file, a copy of it under another
+    name and an empty cache directory"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.directory, 'cache')
+        self.name = os.path.join(self.directory, 'pattern.wav')
+        synthiq.write_wav(self.name, 1000 * synthiq.pattern(300, 7))
+        self.copy = os.path.join(self.directory, 'copy.wav')
+        shutil.copy(self.name, self.copy)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+class ContentHashIgnoresNames(CacheFixture):
+    def runTest(self):
+        assert content_hash(self.name) == content_hash(self.copy)
+        with open(self.copy, 'ab') as fh:
+            fh.write('\0')
+        assert content_hash(self.name) != content_hash(self.copy)
+
+class FormatsOfTheSameBytesHaveOwnEntries(CacheFixture):
+    def runTest(self):
+        frames = np.random.RandomState(3).randint(
+            -1000, 1000, (128, 2)).astype('<i2')
+        cs16 = os.path.join(self.directory, 'pattern.cs16')
+        cf32 = os.path.join(self.directory, 'pattern.cf32')
+        frames.tofile(cs16)
+        shutil.copy(cs16, cf32)
+        cache = PatternCache(self.cache_dir)
+        for name, length in ((cs16, 128), (cf32, 64), (cs16, 128)):
+            # searches decode both in the same precision
+            pattern = cache.pattern(iqfile.IQFile(name), dtype=np.complex64)
+            assert pattern.length == length
+            np.testing.assert_array_equal(
+                pattern.samples, iqfile.IQFile(name).iq(dtype=np.complex64))
+        assert cache.hits == 2
+
+class CachedPatternMatchesPattern(CacheFixture):
+    def runTest(self):
+        expected = xcorr.Pattern(iqfile.IQFile(self.name).iq(), 'p')
+        for _ in range(2):
+            cache = PatternCache(self.cache_dir)
+            pattern = cache.pattern(iqfile.IQFile(self.name), 'p')
+            assert isinstance(pattern, CachedPattern)
+            assert pattern.name == 'p' and pattern.length == 300
+            np.testing.assert_array_equal(pattern.samples, expected.samples)
+            assert pattern.mean == expected.mean
+            assert pattern.std == expected.std
+            assert type(pattern.std) == type(expected.std)
+            np.testing.assert_array_equal(pattern.spectrum(2048),
+                                          expected.spectrum(2048))
+        # the second round was served entirely from the cache
+        assert (cache.hits, cache.misses) == (3, 0)
+
+class CopiesShareEntries(CacheFixture):
+    def runTest(self):
+        cache = PatternCache(self.cache_dir)
+        cache.pattern(iqfile.IQFile(self.name)).spectrum(1024)
+        files = sorted(os.listdir(self.cache_dir))
+        cache.pattern(iqfile.IQFile(self.copy)).spectrum(1024)
+        assert sorted(os.listdir(self.cache_dir)) == files
+        assert len(files) == 3
+        # another precision is another entry
+        cache.pattern(iqfile.IQFile(self.copy), dtype=np.complex64)
+        assert len(os.listdir(self.cache_dir)) == 5
+
+class LeastRecentlyUsedFilesAreEvicted(CacheFixture):
+    def runTest(self):
+        cache = PatternCache(self.cache_dir)
+        pattern = cache.pattern(iqfile.IQFile(self.name))
+        for nfft in (1024, 2048):
+            pattern.spectrum(nfft)
+        sizes = dict((name, size) for _, size, name in cache.entries())
+        old = [name for name in sizes if name.endswith('fft1024.npy')][0]
+        for i, name in enumerate(sorted(sizes)):
+            os.utime(os.path.join(self.cache_dir, name),
+                     (0, 0 if name == old else 1000 + i))
+
+        cache.capacity = sum(sizes.values()) - 1
+        cache.evict()
+        assert sorted(name for _, _, name in cache.entries()) == \
+            sorted(name for name in sizes if name != old)
+        assert cache.size() <= cache.capacity
+
+        # a hit makes a file the most recently used one
+        cache.fetch(pattern.key, 'samples')
+        cache.capacity = sizes[old.replace('fft1024', 'samples')]
+        cache.evict()
+        assert [name for _, _, name in cache.entries()] == \
+            [old.replace('fft1024', 'samples')]
+
+class OptionsSizeTheCache(CacheFixture):
+    def runTest(self):
+        cache = from_options(self.cache_dir, '0.5')
+        assert cache.directory == self.cache_dir
+        assert cache.capacity == 1 << 19
+        assert from_options(self.cache_dir, '0') is None
+
+class UnwritableCacheIsReadOnly(CacheFixture):
+    def runTest(self):
+        blocked = os.path.join(self.directory, 'file')
+        open(blocked, 'w').close()
+        cache = PatternCache(os.path.join(blocked, 'cache'))
+        pattern = cache.pattern(iqfile.IQFile(self.name))
+        assert not cache.writable
+        np.testing.assert_array_equal(pattern.samples,
+                                      iqfile.IQFile(self.name).iq())
+        assert len(pattern.spectrum(1024)) == 1024
+
+if __name__ == '__main__':
+    ut.main()
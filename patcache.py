@@ -0,0 +1,200 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""\
+On-disk cache of prepared patterns
+
+Patterns rarely change between searches, yet every search decodes them,
+computes their mean and standard deviation and transforms them once per
+FFT size. The cache keeps all of that in a directory, as NPY files that
+are loaded memory mapped:
+
+    <key>.<dtype>.samples.npy   decoded samples
+    <key>.<dtype>.stats.npy     mean and standard deviation
+    <key>.<dtype>.fft<N>.npy    conjugate spectrum zero padded to N
+
+The key is the SHA-1 of the pattern file's content and of the layout it
+is decoded with (dtype and shape of its frames, which depend on the
+format), so renamed or copied patterns hit, while modified ones and
+byte-identical files of another format miss. Files are written to a
+temporary name and renamed, concurrent searches never see partial
+entries.
+
+Every hit touches the file it loads. When the files in the directory
+grow beyond the capacity, the least recently used ones are removed; an
+entry that lost some of its files is simply prepared again. A cache that
+cannot be written to is used read-only, a search never fails because of
+it.
+"""
+
+import os
+import errno
+import hashlib
+import logging
+import tempfile
+import numpy as np
+
+import xcorr
+
+# default size limit of the cache directory, in bytes
+CAPACITY = 256 << 20
+
+# changes whenever the layout of the entries changes
+VERSION = 2
+
+STATS_DTYPE = np.dtype([('mean', np.complex128), ('std', np.float64)])
+
+
+def default_directory():
+    """$PARSEIQ_CACHE, else parseiq/patterns in $XDG_CACHE_HOME or ~/.cache"""
+    if os.environ.get('PARSEIQ_CACHE'):
+        return os.environ['PARSEIQ_CACHE']
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'parseiq', 'patterns')
+
+
+def content_hash(name, layout='', chunk_size=1 << 20):
+    """Hex SHA-1 of the content of file name, the cache version and an
+    optional layout string"""
+    digest = hashlib.sha1('parseiq-pattern-{}\n{}\n'.format(VERSION, layout))
+    with open(name, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CachedPattern(xcorr.Pattern):
+    """xcorr.Pattern whose statistics come from the cache and whose
+    spectra are loaded from or stored in it"""
+    def __init__(self, samples, name, mean, std, cache, key):
+        self.samples = samples
+        self.name = name
+        self.length = len(samples)
+        self.mean = mean
+        self.std = std
+        self.spectra = {}
+        self.cache = cache
+        self.key = key
+
+    def spectrum(self, nfft):
+        """conj(fft(samples)) zero padded to nfft"""
+        if nfft not in self.spectra:
+            part = 'fft{}'.format(nfft)
+            spectrum = self.cache.fetch(self.key, part)
+            if spectrum is None:
+                spectrum = xcorr.Pattern.spectrum(self, nfft)
+                self.cache.store(self.key, part, spectrum)
+            self.spectra[nfft] = spectrum
+        return self.spectra[nfft]
+
+
+class PatternCache(object):
+    """Prepared patterns in directory (default: default_directory()),
+    holding at most capacity bytes"""
+    def __init__(self, directory=None, capacity=CAPACITY):
+        self.directory = directory or default_directory()
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.writable = True
+
+    def path(self, key, part):
+        """File name of one part of an entry"""
+        return os.path.join(self.directory, '{}.{}.npy'.format(key, part))
+
+    def fetch(self, key, part):
+        """Memory mapped part of an entry, None if it is not cached"""
+        name = self.path(key, part)
+        try:
+            array = np.load(name, mmap_mode='r')
+            os.utime(name, None)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return array
+
+    def store(self, key, part, array):
+        """Adds part of an entry, then evicts to capacity"""
+        if not self.writable or array.nbytes > self.capacity:
+            return
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, temporary = tempfile.mkstemp('.tmp', '.', self.directory)
+            try:
+                with os.fdopen(fd, 'wb') as fh:
+                    np.save(fh, array)
+                os.rename(temporary, self.path(key, part))
+            except:
+                os.unlink(temporary)
+                raise
+            self.evict()
+        except (IOError, OSError), e:
+            logging.warning("pattern cache {} is not writable: {}".format(
+                self.directory, e))
+            self.writable = False
+
+    def entries(self):
+        """(last use, size, name) of all cached files, oldest first"""
+        result = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            result.append((stat.st_mtime, stat.st_size, name))
+        return sorted(result)
+
+    def size(self):
+        """Bytes used by the cached files"""
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """Removes least recently used files until the cache fits its
+        capacity"""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.capacity:
+                break
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError, e:
+                # another search evicted it first
+                if e.errno != errno.ENOENT:
+                    raise
+            total -= size
+
+    def pattern(self, iq_file, name=None, dtype=None):
+        """CachedPattern of the samples of an iqfile.IQFile, decoded to
+        dtype like iq_file.iq() does"""
+        if dtype is None:
+            dtype = iq_file.data.dtype if iq_file.iscomplex() \
+                else np.complex128
+        dtype = np.dtype(dtype)
+        layout = '{} {}'.format(iq_file.data.dtype.str, iq_file.data.shape)
+        key = '{}.{}'.format(content_hash(iq_file.name, layout),
+                             dtype.str[1:])
+
+        samples = self.fetch(key, 'samples')
+        stats = self.fetch(key, 'stats') if samples is not None else None
+        if stats is None:
+            prepared = xcorr.Pattern(iq_file.iq(dtype=dtype))
+            samples = prepared.samples
+            stats = np.array([(prepared.mean, prepared.std)],
+                             dtype=STATS_DTYPE)
+            self.store(key, 'samples', samples)
+            self.store(key, 'stats', stats)
+        return CachedPattern(samples, name, stats['mean'][0],
+                             stats['std'][0], self, key)
+
+
+def from_options(directory, size_mb):
+    """PatternCache of the --cache and --cache-size options of the
+    command line tools, None if the size (in MB) disables it"""
+    capacity = int(float(size_mb) * (1 << 20))
+    if capacity <= 0:
+        return None
+    return PatternCache(directory, capacity)
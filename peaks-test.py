@@ -0,0 +1,91 @@
+from peaks import PeakDetector, window_max, extract, NpySink, PEAK_DTYPE
+import xcorr
+import unittest as ut
+import numpy as np
+import os
+import tempfile
+
+def feed_blocks(detector, values, size):
+    found = [detector.feed(i, values[i:i+size])
+             for i in range(0, len(values), size)]
+    return np.concatenate(found + [detector.flush()])
+
+class ScoresFixture(ut.TestCase):
+    """Test fixture with a smooth score curve containing a few bumps"""
+    def setUp(self):
+        x = np.arange(2000)
+        self.values = (0.9 * np.exp(-((x - 300) / 20.0) ** 2)
+                       + 0.7 * np.exp(-((x - 360) / 20.0) ** 2)
+                       + 0.8 * np.exp(-((x - 1200.3) / 30.0) ** 2)
+                       + 0.6 * np.exp(-((x - 1999) / 5.0) ** 2)
+                       + 0j)
+
+class WindowMaxMatchesBruteForce(ut.TestCase):
+    def runTest(self):
+        data = np.random.RandomState(3).randn(101)
+        for width in (1, 2, 7, 101):
+            expected = [data[i:i+width].max()
+                        for i in range(len(data) - width + 1)]
+            np.testing.assert_array_equal(window_max(data, width), expected)
+
+class DetectorSuppressesNeighboursOfAPeak(ScoresFixture):
+    def runTest(self):
+        peaks = feed_blocks(PeakDetector(0.5, separation=100),
+                            self.values, 2000)
+        assert list(peaks['offset']) == [300, 1200, 1999]
+
+class DetectorResultDoesNotDependOnBlockSize(ScoresFixture):
+    def runTest(self):
+        reference = feed_blocks(PeakDetector(0.5, 50), self.values, 2000)
+        for size in (1, 7, 49, 333):
+            peaks = feed_blocks(PeakDetector(0.5, 50), self.values, size)
+            np.testing.assert_array_equal(peaks, reference)
+
+class DetectorKeepsOnlyTopPeaks(ScoresFixture):
+    def runTest(self):
+        detector = PeakDetector(0.5, separation=10, top=2)
+        peaks = feed_blocks(detector, self.values, 128)
+        assert list(peaks['offset']) == [300, 1200]
+
+class DetectorInterpolatesSubsamplePosition(ScoresFixture):
+    def runTest(self):
+        detector = PeakDetector(0.5, separation=100, subsample=True)
+        peaks = feed_blocks(detector, self.values, 500)
+        assert abs(peaks['position'][1] - 1200.3) < 0.05
+        assert peaks['position'][2] == 1999
+
+class DetectorIgnoresUndefinedValues(ut.TestCase):
+    def runTest(self):
+        values = np.array([np.nan, 0.9, np.nan, 0.2]) + 0j
+        peaks = feed_blocks(PeakDetector(0.5), values, 3)
+        assert list(peaks['offset']) == [1]
+
+class ExtractTagsPeaksWithPatternIndex(ScoresFixture):
+    def runTest(self):
+        patterns = [xcorr.Pattern(np.ones(100)), xcorr.Pattern(np.ones(10))]
+        blocks = [(0, patterns[0], self.values[:1000]),
+                  (0, patterns[1], self.values[:1000]),
+                  (1000, patterns[0], self.values[1000:]),
+                  (1000, patterns[1], self.values[1000:])]
+        peaks = np.concatenate(list(extract(blocks, patterns, 0.5)))
+        assert sorted(zip(peaks['pattern'], peaks['offset'])) == [
+            (0, 300), (0, 1200), (0, 1999), (1, 300), (1, 360), (1, 1200),
+            (1, 1999)]
+
+class NpySinkWritesLoadableArray(ScoresFixture):
+    def runTest(self):
+        name = tempfile.mktemp(suffix='.npy')
+        try:
+            sink = NpySink(name)
+            peaks = feed_blocks(PeakDetector(0.5, 10), self.values, 100)
+            sink.write(peaks[:2])
+            sink.write(peaks[2:])
+            sink.close()
+            loaded = np.load(name, mmap_mode='r')
+            assert loaded.dtype == PEAK_DTYPE
+            np.testing.assert_array_equal(loaded, peaks)
+        finally:
+            os.unlink(name)
+
+if __name__ == '__main__':
+    ut.main()
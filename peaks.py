@@ -0,0 +1,328 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""\
+Streaming peak extraction from correlation blocks
+
+A PeakDetector is fed consecutive blocks of correlation values and
+returns the peaks that can no longer change: local maxima of the score
+above a threshold that are at least `separation` offsets away from any
+higher score (non-maximum suppression). Only `separation` values of
+context are carried from one block to the next, so the full correlation
+vector never has to exist. Peaks are compact structured arrays that can
+be streamed to CSV or NPY sinks.
+"""
+
+import sys
+import struct
+import itertools
+import numpy as np
+
+import xcorr
+
+PEAK_DTYPE = np.dtype([('pattern', np.int32),
+                       ('offset', np.int64),
+                       ('position', np.float64),
+                       ('score', np.float64),
+                       ('value', np.complex128)])
+
+
+def score(values):
+    """Detection score of correlation values: the real part, which is
+    what comparing the complex values with a threshold orders by"""
+    scores = np.array(values.real, dtype=np.float64)
+    scores[np.isnan(scores)] = -np.inf
+    return scores
+
+
+def window_max(data, width):
+    """Returns max(data[i:i+width]) for every i at which the window fits,
+    in O(len(data)) using prefix and suffix maxima of width sized blocks"""
+    count = len(data) - width + 1
+    padded = np.empty(-(-len(data) // width) * width, dtype=data.dtype)
+    padded[:len(data)] = data
+    padded[len(data):] = -np.inf
+    blocks = padded.reshape(-1, width)
+    prefix = np.maximum.accumulate(blocks, axis=1).ravel()
+    suffix = np.maximum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    return np.maximum(suffix[:count], prefix[width - 1:width - 1 + count])
+
+
+def interpolate(scores, idxs):
+    """Parabolic sub-sample peak position and height around idxs"""
+    left = np.where(idxs > 0, scores[np.maximum(idxs - 1, 0)], -np.inf)
+    right = np.where(idxs < len(scores) - 1,
+                     scores[np.minimum(idxs + 1, len(scores) - 1)], -np.inf)
+    centre = scores[idxs]
+    curvature = left - 2 * centre + right
+    usable = np.isfinite(curvature) & (curvature < 0)
+    delta = np.zeros(len(idxs))
+    delta[usable] = 0.5 * (left - right)[usable] / curvature[usable]
+    height = centre.copy()
+    height[usable] -= 0.25 * (left - right)[usable] * delta[usable]
+    return delta, height
+
+
+class PeakDetector(object):
+    """Non-maximum suppressing peak detector over a stream of blocks.
+    top keeps only the top highest peaks, which are then returned by
+    flush(). Peaks are tagged with pattern, unless the blocks come with
+    the pattern of every value"""
+    def __init__(self, threshold, separation=1, top=None,
+                 subsample=False, pattern=0):
+        self.threshold = threshold
+        self.separation = max(1, int(separation))
+        self.top = top
+        self.subsample = subsample
+        self.pattern = pattern
+        self.best = np.zeros(0, dtype=PEAK_DTYPE)
+        self.reset()
+
+    def reset(self):
+        """Forget the carried context"""
+        self.offset = None
+        self.scores = np.zeros(0)
+        self.values = np.zeros(0, dtype=np.complex128)
+        self.patterns = np.zeros(0, dtype=np.int32)
+        self.undecided = 0
+
+    def feed(self, offset, values, patterns=None):
+        """Adds a block of correlation values starting at offset and
+        returns the peaks that are final. patterns optionally holds the
+        pattern index of every value"""
+        if self.offset is not None and offset != self.offset + len(self.scores):
+            found = self.flush(keep_best=True)
+        else:
+            found = np.zeros(0, dtype=PEAK_DTYPE)
+        if self.offset is None:
+            self.offset = offset
+
+        self.scores = np.concatenate((self.scores, score(values)))
+        self.values = np.concatenate((self.values, values))
+        if patterns is None:
+            patterns = np.empty(len(values), dtype=np.int32)
+            patterns.fill(self.pattern)
+        self.patterns = np.concatenate((self.patterns, patterns))
+        return self.collect(np.concatenate(
+            (found, self.decide(len(self.scores) - self.separation))))
+
+    def flush(self, keep_best=False):
+        """Decides the carried values as end of stream and returns the
+        remaining peaks (all top peaks if top is set)"""
+        found = self.decide(len(self.scores))
+        self.reset()
+        if self.top is None or keep_best:
+            return self.collect(found)
+        self.collect(found)
+        best, self.best = self.best, np.zeros(0, dtype=PEAK_DTYPE)
+        return np.sort(best, order='offset')
+
+    def collect(self, found):
+        """Passes found peaks through, or keeps the top ones"""
+        if self.top is None:
+            return found
+        merged = np.concatenate((self.best, found))
+        if len(merged) > self.top:
+            merged = merged[np.argsort(-merged['score'],
+                                       kind='mergesort')[:self.top]]
+        self.best = merged
+        return np.zeros(0, dtype=PEAK_DTYPE)
+
+    def decide(self, stop):
+        """Finds the peaks among the undecided values before stop and
+        drops everything that is no longer needed as context"""
+        start = self.undecided
+        stop = max(start, stop)
+        sep = self.separation
+        found = np.zeros(0, dtype=PEAK_DTYPE)
+
+        idxs = start + np.nonzero(self.scores[start:stop] > self.threshold)[0]
+        if len(idxs):
+            padded = np.empty(len(self.scores) + 2 * sep)
+            padded[:sep] = -np.inf
+            padded[sep:sep + len(self.scores)] = self.scores
+            padded[sep + len(self.scores):] = -np.inf
+            maxima = window_max(padded, sep)
+            peak = self.scores[idxs]
+            idxs = idxs[(peak > maxima[idxs])
+                        & (peak >= maxima[idxs + sep + 1])]
+
+            found = np.zeros(len(idxs), dtype=PEAK_DTYPE)
+            found['pattern'] = self.patterns[idxs]
+            found['offset'] = self.offset + idxs
+            found['position'] = found['offset']
+            found['score'] = self.scores[idxs]
+            found['value'] = self.values[idxs]
+            if self.subsample and len(idxs):
+                delta, height = interpolate(self.scores, idxs)
+                found['position'] += delta
+                found['score'] = height
+
+        drop = max(0, stop - sep)
+        self.scores = self.scores[drop:]
+        self.values = self.values[drop:]
+        self.patterns = self.patterns[drop:]
+        self.offset += drop
+        self.undecided = stop - drop
+        return found
+
+
+def extract(blocks, patterns, threshold, separation=None, top=None,
+            subsample=False):
+    """Runs one PeakDetector per pattern over (offset, pattern, values)
+    blocks as produced by xcorr.correlation_blocks. Yields arrays of
+    peaks as soon as they are final. separation defaults to the length
+    of each pattern"""
+    detectors = {}
+    for k, pattern in enumerate(patterns):
+        detectors[pattern] = PeakDetector(threshold,
+                                          separation or pattern.length,
+                                          top, subsample, k)
+
+    for offset, pattern, values in blocks:
+        found = detectors[pattern].feed(offset, values)
+        if len(found):
+            yield found
+
+    for pattern in patterns:
+        found = detectors[pattern].flush()
+        if len(found):
+            yield found
+
+
+def search(read, start, count, patterns, threshold, sink,
+           block_size=xcorr.BLOCK_SIZE, correlate=xcorr.correlations,
+           separation=None, top=None, subsample=False, ranges=None):
+    """Correlates patterns with the haystack behind read() block by block
+    (see xcorr.correlation_blocks) and writes the peaks to sink as soon
+    as they are final. ranges optionally restricts the search to a list
+    of (start, count) haystack ranges. Returns the number of peaks found"""
+    if ranges is None:
+        ranges = [(start, count)]
+    blocks = itertools.chain.from_iterable(
+        xcorr.correlation_blocks(read, first, frames, patterns, block_size,
+                                 correlate)
+        for first, frames in ranges)
+    total = 0
+    for found in extract(blocks, patterns, threshold, separation, top,
+                         subsample):
+        sink.write(found)
+        total += len(found)
+    return total
+
+
+class ArraySink(object):
+    """Collects peaks into a single structured array"""
+    def __init__(self):
+        self.parts = []
+
+    def write(self, found):
+        """Add peaks"""
+        self.parts.append(found)
+
+    def close(self):
+        """Nothing to release"""
+        pass
+
+    def result(self):
+        """All peaks written so far"""
+        if not self.parts:
+            return np.zeros(0, dtype=PEAK_DTYPE)
+        return np.concatenate(self.parts)
+
+
+class CsvSink(object):
+    """Writes peaks as CSV lines, patterns are written by name"""
+    header = 'pattern,offset,position,score,real,imag\n'
+
+    def __init__(self, out, names):
+        self.out = out
+        self.names = names
+        self.out.write(self.header)
+
+    def line(self, peak):
+        """CSV line of a peak"""
+        return '{},{},{:.3f},{:.6f},{:.6g},{:.6g}\n'.format(
+            self.names[peak['pattern']], peak['offset'],
+            peak['position'], peak['score'],
+            peak['value'].real, peak['value'].imag)
+
+    def write(self, found):
+        """Add peaks"""
+        self.out.write(''.join(self.line(peak) for peak in found))
+        self.out.flush()
+
+    def close(self):
+        """Close the output unless it is stdout"""
+        if self.out is not sys.stdout:
+            self.out.close()
+
+
+class NpySink(object):
+    """Appends records (by default peaks) to an NPY file of dtype records.
+    The header reserves room for the final shape, which is filled in by
+    close()"""
+    header_size = 256
+
+    def __init__(self, name, dtype=PEAK_DTYPE):
+        self.out = open(name, 'wb')
+        self.dtype = dtype
+        self.count = 0
+        self.out.write(self.header())
+
+    def header(self):
+        """NPY version 1.0 header of fixed size for the current count"""
+        text = repr({'descr': np.lib.format.dtype_to_descr(self.dtype),
+                     'fortran_order': False,
+                     'shape': (self.count,)})
+        text = text.ljust(self.header_size - 11) + '\n'
+        return np.lib.format.magic(1, 0) + struct.pack('<H', len(text)) + text
+
+    def write(self, found):
+        """Add records"""
+        self.out.write(found.astype(self.dtype).tostring())
+        self.count += len(found)
+
+    def close(self):
+        """Write the final header and close the file"""
+        self.out.seek(0)
+        self.out.write(self.header())
+        self.out.close()
+
+
+class RecordCsvSink(object):
+    """Writes structured records as CSV lines with one column per field,
+    formatted by line"""
+    def __init__(self, out, dtype, line):
+        self.out = out
+        self.line = line
+        self.out.write(','.join(dtype.names) + '\n')
+
+    def write(self, records):
+        """Add records"""
+        self.out.write(''.join(self.line.format(*record)
+                               for record in records))
+        self.out.flush()
+
+    def close(self):
+        """Close the output unless it is stdout"""
+        if self.out is not sys.stdout:
+            self.out.close()
+
+
+def open_record_sink(name, dtype, line):
+    """Sink for records of dtype: NPY for names ending in .npy, CSV with
+    lines formatted by line otherwise, CSV on stdout for '-'"""
+    if name == '-':
+        return RecordCsvSink(sys.stdout, dtype, line)
+    if name.endswith('.npy'):
+        return NpySink(name, dtype)
+    return RecordCsvSink(open(name, 'w'), dtype, line)
+
+
+def open_sink(name, names):
+    """Sink for the given output file name: NPY for names ending in .npy,
+    CSV otherwise, CSV on stdout for '-'"""
+    if name == '-':
+        return CsvSink(sys.stdout, names)
+    if name.endswith('.npy'):
+        return NpySink(name)
+    return CsvSink(open(name, 'w'), names)
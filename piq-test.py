@@ -1,8 +1,16 @@
 from piq import Piq
+from docopt import docopt
+from iqfile import IQFile
 import unittest as ut
 from mock import Mock
 import struct
 import numpy as np
+import tempfile
+import cStringIO
+import json
+import sys
+import os
+import piq
 
 #def populatewavfile(wav):
 #    """Generates 16 bit stereo file with 440 Hz on left and 730 Hz
@@ -183,6 +191,83 @@ class AdvanceDeletesAsManyItemsAsItFetches(MockReadiqFixture):
         assert self.piq.haystack['offset'] == 8
         assert len(self.piq.haystack['data']) == len(reference);
 
+class AdvanceSlidesWindowOverFile(ut.TestCase):
+    def runTest(self):
+        name = tempfile.mktemp(suffix='.cs16')
+        frames = np.arange(200, dtype='<i2').reshape(-1, 2)
+        frames.tofile(name)
+        samples = frames[:, 0] + 1j * frames[:, 1]
+
+        piq = Piq({})
+        piq.haystack['fh'] = IQFile(name)
+        window = piq.advance(piq.haystack, 7)
+        np.testing.assert_array_equal(window, samples[:7])
+        ring = piq.haystack['ring']
+        for end in range(10, 101, 3):
+            window = piq.advance(piq.haystack, 3)
+            assert piq.haystack['ring'] is ring
+            assert piq.haystack['offset'] == end
+            np.testing.assert_array_equal(window, samples[end - 7:end])
+        os.unlink(name)
+
+class BlocksAreReadIntoOneBuffer(ut.TestCase):
+    def runTest(self):
+        name = tempfile.mktemp(suffix='.cs16')
+        frames = np.arange(200, dtype='<i2').reshape(-1, 2)
+        frames.tofile(name)
+        samples = frames[:, 0] + 1j * frames[:, 1]
+
+        piq = Piq({})
+        piq.haystack['fh'] = IQFile(name)
+        # frames are widened straight from the mapping
+        piq.haystack['fh'].readframes = Mock()
+        read = []
+        rings = set()
+        for offset, block in piq.blocks(piq.haystack, 5, 90, 16):
+            assert offset == 5 + len(read)
+            assert np.may_share_memory(block, piq.haystack['ring'])
+            rings.add(id(piq.haystack['ring']))
+            read.extend(block)
+        np.testing.assert_array_equal(read, samples[5:95])
+        assert len(rings) == 1
+        assert not piq.haystack['fh'].readframes.called
+        os.unlink(name)
+
+class RunWritesMetricsAndCprofile(ut.TestCase):
+    def runTest(self):
+        name = tempfile.mktemp(suffix='.cs16')
+        np.arange(200, dtype='<i2').tofile(name)
+        report = tempfile.mktemp(suffix='.json')
+        profile = tempfile.mktemp(suffix='.prof')
+        stdout, sys.stdout = sys.stdout, cStringIO.StringIO()
+        try:
+            Piq(docopt(piq.__doc__, ['dump', '-f', '10', '--format', 'raw',
+                                     '--metrics-out', report,
+                                     '--cprofile', profile, name])).run()
+            out = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        assert out == open(name, 'rb').read(40)
+        metrics = json.load(open(report))
+        assert metrics['labels'] == {'command': 'dump'}
+        assert metrics['counters']['read_frames'] == 10
+        assert os.path.getsize(profile) > 0
+        for path in (name, report, profile):
+            os.unlink(path)
+
+class AdvanceStopsAtEndOfFile(MockWaveReaderFixture):
+    def runTest(self):
+        self.piq.haystack['fh'].getnframes.return_value = 5
+        self.piq.haystack['fh'].readframes.return_value = struct.pack('<4h', 1, 2, 3, 4)
+        self.piq.haystack['offset'] = 3
+
+        window = self.piq.advance(self.piq.haystack, 4)
+
+        self.piq.haystack['fh'].setpos.assert_called_with(3)
+        self.piq.haystack['fh'].readframes.assert_called_with(2)
+        np.testing.assert_array_equal(window, [1+2j, 3+4j])
+        assert self.piq.haystack['offset'] == 5
+
 
 if __name__ == '__main__':
     ut.main()
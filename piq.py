@@ -1,63 +1,402 @@
 """\
-Usage:  piq.py dump [-o OFFSET] [-f FRAMES] FILE
-        piq.py findreftick  [-o OFFSET] [-f FRAMES] FILE
-        piq.py findpattern [-o OFFSET] [-f FRAMES] PATTERN FILE
+Usage:  piq.py dump [-o OFFSET] [-f FRAMES] [--format FORMAT] [--metrics-out FILE]
+                   [--cprofile FILE] FILE
+        piq.py findreftick  [-o OFFSET] [-f FRAMES] [--width FRAMES] [--level FACTOR]
+                            [--period FRAMES] [--rate HZ] [--block FRAMES] [--out FILE]
+                            [--follow [--poll SECONDS] [--idle SECONDS]]
+                            [--metrics-out FILE] [--cprofile FILE] FILE
+        piq.py findpattern [-o OFFSET] [-f FRAMES] [-t THRESHOLD] [--block FRAMES] [-j WORKERS]
+                           [--separation FRAMES] [--top K] [--subsample] [--out FILE]
+                           [--index] [--min-power POWER] [--pyramid FACTOR]
+                           [--coarse-threshold THRESHOLD] [--margin FRAMES] [--cfo RANGE]
+                           [--prefetch DEPTH] [--cache DIR] [--cache-size MB]
+                           [--precision NAME] [--follow [--poll SECONDS] [--idle SECONDS]]
+                           [--metrics-out FILE] [--cprofile FILE]
+                           PATTERN FILE [PATTERN...]
 
 Arguments:
-        FILE        Input file in complex64 NPY format
-        PATTERN     Pattern in complex64 NPY format to be searched in FILE
+        FILE        Input file in complex64 or cs16 NPY format (or 16 bit I/Q WAV)
+        PATTERN     Pattern in complex64 or cs16 NPY format (or 16 bit I/Q WAV)
+                    to be searched in FILE,
+                    or a directory of such files. All patterns are
+                    searched in a single pass over FILE
 
 Options:
         -h --help   Show this help message and exit
         -o OFFSET   Number of frames to skip before processing [default: 0]
         -f FRAMES   Limit number of frames to process (at most)
+        -t THRESHOLD    Correlation threshold, between -1 and +1 [default: 0.5]
+        --block FRAMES  Number of offsets correlated per block [default: 1048576]
+        -j WORKERS      Number of correlation worker processes,
+                        0 for one per core [default: 0]
+        --separation FRAMES  Minimum distance between two reported peaks,
+                        0 for the length of the pattern [default: 0]
+        --top K         Only report the K highest peaks per pattern
+        --subsample     Interpolate peak position and score between frames
+        --out FILE      Write peaks (ticks) to FILE: a structured array if FILE
+                        ends in .npy, CSV otherwise. - for stdout [default: -]
+        --index         Skip silent parts of FILE using its chunk statistics
+                        index (FILE.idx.npz), built or updated as needed
+        --min-power POWER  Mean power per frame at or below which an indexed
+                        chunk counts as silent [default: 0]
+        --pyramid FACTOR  Search coarse to fine: correlate at a rate decimated
+                        by FACTOR first, then refine the candidates at full
+                        rate. 0 or 1 for a full rate search [default: 0]
+        --coarse-threshold THRESHOLD  Correlation threshold of the decimated
+                        search, half of -t if not given
+        --margin FRAMES  Full rate offsets searched on both sides of a coarse
+                        candidate, 0 for FACTOR [default: 0]
+        --cfo RANGE     Search every pattern at the frequency offsets
+                        LOW:HIGH:STEP (in Hz, in cycles per frame if FILE
+                        has no sampling rate) in one pass and report the
+                        best one of each peak, e.g. --cfo=-300:300:25.
+                        Not with --pyramid
+        --prefetch DEPTH  Number of haystack blocks read ahead by a background
+                        thread, 0 to read in turns with correlating [default: 2]
+        --cache DIR     Directory of the cache of prepared patterns,
+                        $PARSEIQ_CACHE or ~/.cache/parseiq/patterns if not given
+        --cache-size MB  Size limit of the pattern cache, 0 to disable
+                        it [default: 256]
+        --precision NAME  Precision of samples, spectra and correlation
+                        values: single (complex64) or double (complex128),
+                        sums are accumulated in double precision [default: single]
+        --follow        Keep processing FILE while it is recorded: new frames
+                        are processed as they are written and results are
+                        reported as soon as they are final. A pattern search
+                        cannot also use an index, pyramid or frequency offsets
+        --poll SECONDS  How often a followed FILE is checked for new frames,
+                        which bounds the delay of a detection [default: 1]
+        --idle SECONDS  Stop following FILE when it did not grow for this
+                        long, 0 to follow it until interrupted [default: 0]
+        --width FRAMES  Length of a reference tick [default: 64]
+        --level FACTOR  Tick energy threshold, as multiple of the noise
+                        floor [default: 10]
+        --period FRAMES  Nominal tick period, drift is measured against it.
+                        0 to use the mean measured period [default: 0]
+        --rate HZ       Sampling rate for tick times, 0 to take it from
+                        FILE [default: 0]
+        --format FORMAT  Dump format: complex, text (I Q columns), csv, raw
+                        (as stored), cf32 or cs16 [default: complex]
+        --metrics-out FILE  Collect counters (frames and bytes read, decoding,
+                        pool wait, worker busy and idle time), wall clock and
+                        CPU time per stage and section, and write them to
+                        FILE: in the Prometheus text format if FILE ends in
+                        .prom, as JSON otherwise
+        --cprofile FILE  Run the command under cProfile and dump its
+                        statistics to FILE (pstats format, main process only)
 """
 
 from docopt import docopt
-import wave
-import struct
+import sys
+import functools
 import numpy as np
 
+import iqfile
+import xcorr
+import corrpool
+import peaks
+import iqindex
+import iqdump
+import reftick
+import pyramid
+import prefetch
+import patcache
+import cfo
+import follow
+from hpmc import metrics
+from hpmc import profiler
+from hpmc import instrument
+
+# numpy type of one I or Q value by sample width
+SAMPLE_TYPES = {2: '<i2', 4: '<f4', 8: '<f8'}
+
 class Piq(object):
     """Application class for piq"""
     def __init__(self, arguments):
         self.arguments = arguments
         self.haystack = {}
         self.needle = {}
-        self.haystack['data'] = None
+        self.haystack['data'] = np.zeros(0, dtype=np.complex64)
         self.haystack['offset'] = 0
-        self.needle['data'] = None
+        self.needle['data'] = np.zeros(0, dtype=np.complex64)
         self.needle['offset'] = 0
 
+    @staticmethod
+    def verifyfileformat(haystack_fh, needle_fh=None):
+        """Verify that a file holds uncompressed 16 bit I/Q frames, and
+        that a needle file is sampled at the same rate"""
+        for fh in (haystack_fh, needle_fh):
+            if fh is None:
+                continue
+            if fh.getnchannels() != 2:
+                raise TypeError('Input file must be stereo')
+            if fh.getsampwidth() != 2:
+                raise TypeError('Input file must be 16 bit')
+            if fh.getcomptype() != 'NONE':
+                raise TypeError('Input file must not be compressed')
+        if (needle_fh is not None
+                and haystack_fh.getframerate() != needle_fh.getframerate()):
+            raise TypeError('Input files must have the same framerate')
+
+    @staticmethod
+    def readiq(buf, offset, n_frames, out=None):
+        """Reads up to n_frames complex samples of the file of buf starting
+        at offset, into out if given (which must hold n_frames). Frames
+        of mapped files are widened straight from the mapping"""
+        fh = buf['fh']
+        n_frames = max(0, min(n_frames, fh.getnframes() - offset))
+        if out is None:
+            out = np.empty(n_frames, dtype=np.complex64)
+        data = getattr(fh, 'data', None)
+        if isinstance(data, np.ndarray):
+            frames = data[offset:offset + n_frames]
+            metrics.add('read_frames', len(frames))
+            metrics.add('read_bytes', frames.nbytes)
+        else:
+            # files opened with the wave module only offer their bytes
+            fh.setpos(offset)
+            frames = np.frombuffer(fh.readframes(n_frames),
+                                   dtype=SAMPLE_TYPES[fh.getsampwidth()])
+            frames = frames.reshape(-1, 2)
+
+        out = out[:len(frames)]
+        if np.iscomplexobj(frames):
+            out[:] = frames
+        else:
+            out.real = frames[:, 0]
+            out.imag = frames[:, 1]
+        return out
+
+    def advance(self, buf, n_frames, keep=None):
+        """Slides the window of buf n_frames further into its file. The
+        window keeps its length (or grows to n_frames), or keeps just the
+        last keep frames in front of the new ones. It is always a
+        contiguous view of a preallocated double buffer: frames are read
+        into the free part behind the window, and only when that is used
+        up the window is moved back to the front. Returns the window"""
+        window = buf['data']
+        if keep is not None and len(window) > keep:
+            trimmed = window[len(window) - keep:]
+            if buf.get('window') is window:
+                buf['start'] += len(window) - keep
+                buf['window'] = trimmed
+            window = trimmed
+        length = max(len(window), n_frames)
+        ring = buf.get('ring')
+        if ring is None or buf.get('window') is not window \
+                or len(ring) < length + n_frames:
+            # (re)allocate only if the buffer is new, too small or was
+            # replaced from outside
+            ring = np.empty(2 * max(length, n_frames, 1), dtype=window.dtype)
+            ring[:len(window)] = window
+            buf['ring'] = ring
+            buf['start'] = 0
+
+        start = buf['start']
+        stop = start + len(window)
+        if stop + n_frames > len(ring):
+            ring[:len(window)] = ring[start:stop]
+            start, stop = 0, len(window)
+
+        fetched = self.readiq(buf, buf['offset'], n_frames,
+                              out=ring[stop:stop + n_frames])
+        if not np.may_share_memory(fetched, ring):
+            ring[stop:stop + len(fetched)] = fetched
+        stop += len(fetched)
+        buf['offset'] += len(fetched)
+
+        start = max(start, stop - length)
+        buf['start'] = start
+        buf['data'] = buf['window'] = ring[start:stop]
+        return buf['data']
+
+    def blocks(self, buf, offset, n_frames, block_size):
+        """Yields (offset, samples) for consecutive blocks of up to
+        block_size of the n_frames frames of buf from offset. All blocks
+        are read by advance() into the same buffer, a block is only valid
+        until the next one is read"""
+        end = offset + n_frames
+        buf['offset'] = offset
+        while buf['offset'] < end:
+            first = buf['offset']
+            samples = self.advance(buf, min(block_size, end - first), keep=0)
+            if not len(samples):
+                return
+            yield first, samples
+
     def do_dump(self):
         """Dump a file to stdout"""
-        for v in self.haystack['data']:
-            print v
+        fh = self.haystack['fh']
+        offset, frames = self.framerange()
+        fmt = self.arguments['--format']
+        if fh.iscomplex():
+            # blocks keep the precision of the stored samples
+            self.haystack['data'] = np.zeros(0, dtype=fh.data.dtype)
+        elif fmt == 'raw':
+            # blocks hold widened frames, which encode to the stored ones
+            fmt = 'cs16'
+        blocks = self.blocks(self.haystack, offset, frames,
+                             iqdump.frames_per_write(fmt))
+        iqdump.write((samples for _, samples in blocks), sys.stdout, fmt)
+
+    def framerange(self):
+        """Returns (offset, frames) of the haystack range selected by -o/-f"""
+        offset = int(self.arguments['-o'])
+        frames = self.haystack['fh'].getnframes() - offset
+        if self.arguments['-f']:
+            frames = min(frames, int(self.arguments['-f']))
+        return offset, max(0, frames)
+
+    def check_follow(self):
+        """Raises ValueError if a followed search is not a plain one"""
+        if self.arguments['--follow'] and (
+                int(self.arguments['--pyramid']) > 1 or self.arguments['--cfo']
+                or self.arguments['--index']):
+            raise ValueError('only plain searches can follow a capture')
 
     def do_findpattern(self):
         """Find a pattern within another file"""
-        pass
+        haystack = self.haystack['fh']
+        offset, frames = self.framerange()
+        # blocks are widened only where they are correlated, to the
+        # precision of the patterns
+        dtype = xcorr.result_dtype(self.needle['data'])
+        read_block = lambda start, n: iqfile.IQArray(haystack, start, n, dtype)
+        block_size = int(self.arguments['--block'])
+        workers = int(self.arguments['-j'])
+
+        search = peaks.search
+        open_sink = peaks.open_sink
+        correlated, source = self.needle['data'], haystack
+        factor = int(self.arguments['--pyramid'])
+        if factor > 1:
+            # the pool correlates decimated blocks, not views of the haystack
+            correlated = pyramid.coarse_patterns(self.needle['data'], factor)
+            source = None
+            coarse_threshold = self.arguments['--coarse-threshold']
+            search = functools.partial(
+                pyramid.search, factor=factor, coarse=correlated,
+                coarse_threshold=float(coarse_threshold) if coarse_threshold else None,
+                margin=int(self.arguments['--margin']) or None)
+            open_sink = pyramid.open_sink
+        if self.arguments['--cfo']:
+            if factor > 1:
+                raise ValueError('a frequency offset search cannot be decimated')
+            bank = cfo.Bank(self.needle['data'],
+                            cfo.parse_range(self.arguments['--cfo']),
+                            haystack.getframerate())
+            correlated = bank.members
+            search = functools.partial(cfo.search, bank=bank)
+            open_sink = cfo.open_sink
+        following = self.arguments['--follow']
+        if following:
+            # workers would not see the frames appended after the fork
+            source = None
+            search = functools.partial(
+                follow.search, iq_file=haystack, dtype=dtype,
+                poll=float(self.arguments['--poll']),
+                idle=float(self.arguments['--idle']))
+
+        correlate = xcorr.correlations
+        pool = None
+        if workers != 1:
+            profiler.stage('setup workers')
+            # workers read (and widen) their part of each block themselves
+            pool = corrpool.CorrelationPool(correlated, workers,
+                                            source=source,
+                                            capacity=block_size)
+            correlate = pool.correlations
+
+        ranges = None
+        if self.arguments['--index']:
+            ranges = iqindex.open_index(haystack).active_ranges(
+                offset, frames,
+                max(pattern.length for pattern in self.needle['data']),
+                float(self.arguments['--min-power']))
+
+        reader = None
+        depth = int(self.arguments['--prefetch'])
+        if depth and factor <= 1 and not following:
+            read_block = reader = prefetch.PrefetchReader(
+                read_block, prefetch.plan(offset, frames, self.needle['data'],
+                                          block_size, ranges),
+                depth, haystack)
+
+        profiler.stage('search')
+        correlate = profiler.section('correlate', correlate)
+        search = profiler.section('peak extraction', search)
+        sink = open_sink(self.arguments['--out'],
+                         [pattern.name for pattern in self.needle['data']])
+        try:
+            search(read_block, offset, frames, self.needle['data'],
+                   float(self.arguments['-t']), sink, block_size,
+                   correlate, int(self.arguments['--separation']),
+                   int(self.arguments['--top'] or 0) or None,
+                   self.arguments['--subsample'], ranges)
+        finally:
+            sink.close()
+            if pool:
+                pool.close()
+            if reader:
+                reader.close()
 
     def do_findreftick(self):
         """Find occurences of reference timer ticks"""
-        pass
+        haystack = self.haystack['fh']
+        offset, frames = self.framerange()
+        settings = (int(self.arguments['--width']),
+                    float(self.arguments['--level']),
+                    int(self.arguments['--period']) or None,
+                    float(self.arguments['--rate']) or haystack.getframerate())
+        if self.arguments['--follow']:
+            found = reftick.track_ticks(follow.sample_blocks(
+                haystack, offset, int(self.arguments['--block']),
+                float(self.arguments['--poll']),
+                float(self.arguments['--idle']), np.complex64), *settings)
+        else:
+            found = reftick.track_ticks(self.blocks(
+                self.haystack, offset, frames, int(self.arguments['--block'])),
+                *settings)
+        sink = reftick.open_sink(self.arguments['--out'])
+        try:
+            for ticks in found:
+                sink.write(ticks)
+        finally:
+            sink.close()
 
     def dispatch(self):
         """Dispatcher for the command interface"""
         if self.arguments['dump']:
-            self.haystack['data'] = np.memmap(self.arguments['FILE'], mode='r', dtype=np.complex64)
+            self.haystack['fh'] = iqfile.IQFile(self.arguments['FILE'])
             self.do_dump()
         elif self.arguments['findreftick']:
-            self.haystack['data'] = np.memmap(self.arguments['FILE'], mode='r', dtype=np.complex64)
+            self.haystack['fh'] = iqfile.IQFile(self.arguments['FILE'])
             self.do_findreftick()
         elif self.arguments['findpattern']:
-            self.needle['data'] = np.memmap(self.arguments['PATTERN'], mode='r', dtype=np.complex64)
-            self.haystack['data'] = np.memmap(self.arguments['FILE'], mode='r', dtype=np.complex64)
+            self.check_follow()
+            profiler.stage('load patterns')
+            cache = patcache.from_options(self.arguments['--cache'],
+                                          self.arguments['--cache-size'])
+            dtype = xcorr.precision(self.arguments['--precision'])
+            self.needle['data'] = [
+                cache.pattern(iqfile.IQFile(name), name, dtype) if cache else
+                xcorr.Pattern(iqfile.IQFile(name).iq(dtype=dtype), name)
+                for name in xcorr.pattern_paths(self.arguments['PATTERN'])]
+            self.haystack['fh'] = iqfile.IQFile(self.arguments['FILE'])
             self.do_findpattern()
 
+    def command(self):
+        """Name of the selected command"""
+        for name in ('dump', 'findreftick', 'findpattern'):
+            if self.arguments[name]:
+                return name
+
     def run(self):
         """Entry point of the application"""
-        self.dispatch()
+        instrument.run(self.dispatch,
+                       metrics_out=self.arguments['--metrics-out'],
+                       cprofile_out=self.arguments['--cprofile'],
+                       namespace='piq', labels={'command': self.command()})
 
 if __name__ == '__main__':
     Piq(docopt(__doc__)).run()
@@ -0,0 +1,77 @@
+from prefetch import PrefetchReader, plan, touch
+from iqfile import IQFile, IQArray
+import peaks
+import xcorr
+import unittest as ut
+import numpy as np
+import tempfile
+import time
+import os
+
+class PlanMatchesSearchReads(ut.TestCase):
+    def runTest(self):
+        samples = np.arange(5000) * (1 + 1j)
+        patterns = [xcorr.Pattern(samples[:50]), xcorr.Pattern(samples[:20])]
+        reads = []
+        def read(offset, n):
+            reads.append((offset, n))
+            return samples[offset:offset + n]
+        for ranges in (None, [(10, 1000), (3000, 1999)]):
+            del reads[:]
+            peaks.search(read, 7, 4900, patterns, 2, peaks.ArraySink(),
+                         block_size=300, ranges=ranges)
+            assert list(plan(7, 4900, patterns, 300, ranges)) == reads
+
+class PrefetchedBlocksAreTheReadBlocks(ut.TestCase):
+    def runTest(self):
+        samples = np.arange(1000) * (1 + 1j)
+        read = lambda offset, n: samples[offset:offset + n]
+        reader = PrefetchReader(read, [(0, 100), (100, 100), (200, 50)], 1)
+        np.testing.assert_array_equal(reader(0, 100), samples[:100])
+        # an unplanned read does not lose the prefetched block
+        np.testing.assert_array_equal(reader(500, 10), samples[500:510])
+        np.testing.assert_array_equal(reader(100, 100), samples[100:200])
+        np.testing.assert_array_equal(reader(200, 50), samples[200:250])
+        np.testing.assert_array_equal(reader(250, 5), samples[250:255])
+        reader.close()
+        stats = reader.stats()
+        assert stats['blocks'] == 3 and stats['frames'] == 250
+        assert stats['misses'] == 2
+
+class PrefetchOverlapsReadsWithComputation(ut.TestCase):
+    def runTest(self):
+        def read(offset, n):
+            time.sleep(0.02)
+            return np.zeros(n)
+        reader = PrefetchReader(read, [(k, 1) for k in range(5)], 2)
+        began = time.time()
+        for k in range(5):
+            reader(k, 1)
+            time.sleep(0.02)
+        reader.close()
+        assert time.time() - began < 0.18
+        assert reader.stats()['stall_seconds'] < 0.06
+
+class PrefetchReportsReadErrors(ut.TestCase):
+    def runTest(self):
+        def read(offset, n):
+            raise IOError('disk on fire')
+        reader = PrefetchReader(read, [(0, 1)])
+        self.assertRaises(IOError, reader, 0, 1)
+        reader.close()
+
+class PrefetchPassesLazyRangesOn(ut.TestCase):
+    def runTest(self):
+        name = tempfile.mktemp(suffix='.cs16')
+        np.arange(20000, dtype='<i2').tofile(name)
+        capture = IQFile(name)
+        read = lambda offset, n: IQArray(capture, offset, n)
+        reader = PrefetchReader(read, [(0, 4000), (4000, 6000)], 2, capture)
+        block = reader(0, 4000)
+        assert isinstance(block, IQArray) and block.offset == 0
+        assert isinstance(touch(reader(4000, 6000)), IQArray)
+        reader.close()
+        os.unlink(name)
+
+if __name__ == '__main__':
+    ut.main()
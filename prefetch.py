@@ -0,0 +1,208 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""\
+Pipelined reading of haystack blocks
+
+A PrefetchReader knows the planned sequence of (offset, frames) reads of
+a search (see xcorr.block_ranges) and performs them in a background
+thread up to `depth` blocks ahead of the consumer: with a depth of 1 the
+next block is read while the current one is correlated (double
+buffering), with 2 the two next ones (triple buffering). numpy releases
+the GIL while it copies, so page faults of the reading thread do not
+block the computation.
+
+Lazy iqfile.IQArray blocks, which the correlation pool reads itself, are
+not copied: the thread touches every page of their range once, so they
+are in the page cache by the time they are used.
+
+The mapping of the capture is marked for sequential access, and every
+block is announced with WILLNEED before it is read, via madvise() and
+posix_fadvise(). Both are called through ctypes, where they are not
+available the hints are silently skipped.
+
+stats() reports how long the consumer stalled waiting for reads, and
+close() adds both times to the metrics, if they are collected.
+"""
+
+import os
+import time
+import ctypes
+import ctypes.util
+import threading
+import itertools
+import Queue
+import numpy as np
+
+import iqfile
+import xcorr
+from hpmc import metrics
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+MADV_SEQUENTIAL = 2
+MADV_WILLNEED = 3
+
+PAGESIZE = os.sysconf('SC_PAGE_SIZE')
+
+# default number of blocks read ahead
+DEPTH = 2
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+    libc.posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64,
+                                   ctypes.c_int64, ctypes.c_int]
+except (OSError, AttributeError, TypeError):
+    libc = None
+
+
+def madvise(array, advice):
+    """madvise() the pages of a memory mapped array"""
+    if libc is None or not array.size:
+        return
+    address = array.ctypes.data
+    first = address - address % PAGESIZE
+    libc.madvise(first, address + array.nbytes - first, advice)
+
+
+def fadvise(name, offset, length, advice):
+    """posix_fadvise() a byte range of the file name"""
+    if libc is None:
+        return
+    fd = os.open(name, os.O_RDONLY)
+    try:
+        libc.posix_fadvise(fd, offset, length, advice)
+    finally:
+        os.close(fd)
+
+
+class Advisor(object):
+    """Passes access pattern hints for frame ranges of an IQFile on"""
+    def __init__(self, iq_file):
+        self.data = iq_file.data
+        self.frame_size = self.data.itemsize * (
+            self.data.shape[1] if self.data.ndim > 1 else 1)
+        self.name = iq_file.name
+        self.offset = getattr(self.data, 'offset', None)
+        if not isinstance(self.data, np.memmap):
+            self.data = None
+
+    def advise(self, first, frames, advice):
+        """Hint that frames from first will be accessed as advice says
+        (MADV_* / POSIX_FADV_* share their values for these two)"""
+        if self.data is None or frames <= 0:
+            return
+        madvise(self.data[first:first + frames], advice)
+        if self.offset is not None:
+            fadvise(self.name, self.offset + first * self.frame_size,
+                    frames * self.frame_size, advice)
+
+
+def touch(block):
+    """Faults in the pages of the range of a lazy IQArray"""
+    # rows of the mapping are contiguous, so is any range of them
+    data = block.file.data[block.offset:block.offset + len(block)]
+    if data.size:
+        raw = data.view(np.uint8).reshape(-1)
+        np.add.reduce(raw[::PAGESIZE], dtype=np.uint64)
+    return block
+
+
+def plan(start, count, patterns, block_size=xcorr.BLOCK_SIZE, ranges=None):
+    """The reads of peaks.search() with the same arguments"""
+    if ranges is None:
+        ranges = [(start, count)]
+    return itertools.chain.from_iterable(
+        xcorr.block_ranges(first, frames, patterns, block_size)
+        for first, frames in ranges)
+
+
+class PrefetchReader(object):
+    """read(offset, n) that returns the blocks of plan, an iterable of
+    (offset, frames), read ahead by a background thread. Reads that are
+    not the next planned one are served directly"""
+    def __init__(self, read, plan, depth=DEPTH, iq_file=None):
+        self.read = read
+        self.queue = Queue.Queue(max(1, depth))
+        self.advisor = Advisor(iq_file) if iq_file is not None else None
+        self.stalled = 0.0
+        self.reading = 0.0
+        self.blocks = 0
+        self.frames = 0
+        self.misses = 0
+        self.stopped = False
+        self.exhausted = False
+        self.pending = None
+        if self.advisor:
+            self.advisor.advise(0, len(iq_file.data), MADV_SEQUENTIAL)
+        self.thread = threading.Thread(target=self.run, args=(iter(plan),))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, plan):
+        """Reads the planned blocks into the queue"""
+        try:
+            for offset, frames in plan:
+                if self.stopped:
+                    return
+                began = time.time()
+                if self.advisor:
+                    self.advisor.advise(offset, frames, MADV_WILLNEED)
+                block = self.read(offset, frames)
+                if isinstance(block, iqfile.IQArray):
+                    block = touch(block)
+                else:
+                    block = np.asarray(block)
+                self.reading += time.time() - began
+                self.put((offset, frames, block, None))
+        except Exception, e:
+            self.put((None, None, None, e))
+        self.put(None)
+
+    def put(self, item):
+        """Queue item unless the reader was closed"""
+        while not self.stopped:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def next(self):
+        """Next prefetched item, None at the end of the plan"""
+        if self.pending is not None:
+            item, self.pending = self.pending, None
+            return item
+        if self.exhausted:
+            return None
+        began = time.time()
+        item = self.queue.get()
+        self.stalled += time.time() - began
+        self.exhausted = item is None
+        return item
+
+    def __call__(self, offset, frames):
+        item = self.next()
+        if item is not None and item[3] is not None:
+            raise item[3]
+        if item is None or item[:2] != (offset, frames):
+            # unplanned read: keep the prefetched block for later
+            self.pending = item
+            self.misses += 1
+            return self.read(offset, frames)
+        self.blocks += 1
+        self.frames += frames
+        return item[2]
+
+    def close(self):
+        """Stop reading ahead"""
+        self.stopped = True
+        self.thread.join()
+        metrics.add('prefetch_read_seconds', self.reading)
+        metrics.add('prefetch_stall_seconds', self.stalled)
+
+    def stats(self):
+        """Blocks and frames served, time spent reading ahead and time
+        the consumer stalled waiting for a block, in seconds"""
+        return {'blocks': self.blocks, 'frames': self.frames,
+                'misses': self.misses, 'read_seconds': self.reading,
+                'stall_seconds': self.stalled}
@@ -0,0 +1,75 @@
+from pyramid import lowpass, coarse_patterns, CoarseReader, search, PYRAMID_DTYPE
+import peaks
+import xcorr
+import synthiq
+import unittest as ut
+import numpy as np
+
+class LowpassHasUnitGainAndZeroPhase(ut.TestCase):
+    def runTest(self):
+        taps = lowpass(4)
+        assert len(taps) == 65
+        assert abs(taps.sum() - 1) < 1e-12
+        np.testing.assert_allclose(taps, taps[::-1])
+        # a tone above the coarse Nyquist frequency is suppressed
+        tone = synthiq.tone(1000, 0.3)
+        assert abs(np.convolve(tone, taps, 'valid')).max() < 0.01
+
+class CoarseReaderMatchesDecimatedWhole(ut.TestCase):
+    def runTest(self):
+        samples = synthiq.pattern(1000, 3)
+        read = lambda offset, n: samples[offset:offset + n]
+        reader = CoarseReader(read, 100, 900, 4)
+        assert reader.length == 200
+        whole = reader(0, 200)
+        np.testing.assert_allclose(np.concatenate((reader(0, 77), reader(77, 500))),
+                                   whole)
+        padded = np.zeros(800 + 64, dtype=np.complex128)
+        padded[32:832] = samples[100:900]
+        np.testing.assert_allclose(whole[10], np.dot(padded[40:105], lowpass(4)))
+
+class CoarsePatternsAreDecimated(ut.TestCase):
+    def runTest(self):
+        pattern = xcorr.Pattern(synthiq.pattern(100), 'p')
+        coarse = coarse_patterns([pattern], 8)[0]
+        assert coarse.length == 12 and coarse.name == 'p'
+        self.assertRaises(ValueError, coarse_patterns, [pattern], 64)
+
+class PyramidFindsWhatFullSearchFinds(ut.TestCase):
+    def runTest(self):
+        burst = synthiq.pattern(256, 1)
+        samples, offsets = synthiq.capture(50000, burst, bursts=4, snr=4, seed=5)
+        read = lambda offset, n: samples[offset:offset + n]
+        pattern = xcorr.Pattern(burst, 'p')
+
+        full = peaks.ArraySink()
+        peaks.search(read, 0, len(samples), [pattern], 0.5, full)
+        for factor in (2, 4):
+            sink = peaks.ArraySink()
+            found = search(read, 0, len(samples), [pattern], 0.5, sink,
+                           block_size=1000, factor=factor)
+            result = sink.result()
+            assert found == 4 and result.dtype == PYRAMID_DTYPE
+            np.testing.assert_array_equal(result['offset'], offsets)
+            np.testing.assert_array_equal(result['offset'], full.result()['offset'])
+            np.testing.assert_allclose(result['score'], full.result()['score'])
+            assert (result['coarse'] > 0.25).all()
+
+class PyramidHonoursRangesAndTop(ut.TestCase):
+    def runTest(self):
+        burst = synthiq.pattern(256, 1)
+        samples, offsets = synthiq.capture(50000, burst, bursts=4, snr=4, seed=5)
+        read = lambda offset, n: samples[offset:offset + n]
+        pattern = xcorr.Pattern(burst, 'p')
+
+        sink = peaks.ArraySink()
+        search(read, 0, len(samples), [pattern], 0.5, sink, factor=4,
+               ranges=[(offsets[1] - 100, 600), (offsets[3] - 10, 300)])
+        np.testing.assert_array_equal(sink.result()['offset'], offsets[[1, 3]])
+
+        sink = peaks.ArraySink()
+        search(read, 0, len(samples), [pattern], 0.5, sink, factor=4, top=2)
+        assert len(sink.result()) == 2
+
+if __name__ == '__main__':
+    ut.main()
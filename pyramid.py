@@ -0,0 +1,218 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""\
+Coarse-to-fine pattern search
+
+The haystack and the patterns are low pass filtered and decimated by
+`factor`, and correlated at the coarse rate with a relaxed threshold.
+This costs about 1/factor of a full rate search. Every coarse peak is a
+candidate: the full rate offsets within `margin` frames of it are
+correlated with the exact metric of parseiq.correlate() and the best of
+them is reported if it reaches the threshold.
+
+Coarse sample k stands for the full rate offset start + k * factor: the
+anti-alias filter is a zero phase windowed sinc centred on that frame.
+Peaks carry both scores, so the coarse threshold can be tuned for
+recall (no refined peak is found that the coarse pass missed).
+"""
+
+import sys
+import numpy as np
+
+import xcorr
+import peaks
+
+# filter half length per decimation factor, in frames
+FILTER_WIDTH = 8
+
+PYRAMID_DTYPE = np.dtype(peaks.PEAK_DTYPE.descr + [('coarse', np.float64)])
+
+
+def lowpass(factor, width=FILTER_WIDTH):
+    """Zero phase anti-alias filter for decimation by factor: a Hamming
+    windowed sinc of 2 * width * factor + 1 taps with unit DC gain"""
+    half = width * factor
+    t = np.arange(-half, half + 1)
+    taps = np.sinc(t / float(factor)) * np.hamming(2 * half + 1)
+    return taps / taps.sum()
+
+
+def decimate(padded, factor, taps, count):
+    """Filters and decimates padded, which holds len(taps) // 2 extra
+    frames on both sides, into count coarse samples"""
+    result = np.zeros(count, dtype=np.complex128)
+    span = factor * (count - 1) + 1
+    for j, tap in enumerate(taps):
+        result += tap * padded[j:j + span:factor]
+    return result
+
+
+def coarse_patterns(patterns, factor, width=FILTER_WIDTH):
+    """Decimated copies of xcorr.Patterns, named like the originals"""
+    taps = lowpass(factor, width)
+    half = len(taps) // 2
+    result = []
+    for pattern in patterns:
+        count = pattern.length // factor
+        if count < 2:
+            raise ValueError('pattern {} is too short for decimation by {}'
+                             .format(pattern.name, factor))
+        padded = np.zeros(pattern.length + 2 * half, dtype=np.complex128)
+        padded[half:half + pattern.length] = pattern.samples
+        result.append(xcorr.Pattern(decimate(padded, factor, taps, count)
+                                    .astype(pattern.dtype), pattern.name))
+    return result
+
+
+class CoarseReader(object):
+    """read(offset, n) of the decimated haystack range [start, end) of a
+    full rate read(offset, n). Frames outside of the range count as zero"""
+    def __init__(self, read, start, end, factor, width=FILTER_WIDTH):
+        self.read = read
+        self.start = start
+        self.end = end
+        self.factor = factor
+        self.taps = lowpass(factor, width)
+        self.length = -(-(end - start) // factor)
+
+    def __call__(self, offset, n_frames):
+        n_frames = max(0, min(n_frames, self.length - offset))
+        half = len(self.taps) // 2
+        first = self.start + offset * self.factor - half
+        span = self.factor * max(0, n_frames - 1) + 1 + 2 * half
+        padded = np.zeros(span, dtype=np.complex64)
+        lo = max(first, self.start)
+        hi = min(first + span, self.end)
+        if hi > lo:
+            padded[lo - first:hi - first] = np.asarray(self.read(lo, hi - lo))
+        return decimate(padded, self.factor, self.taps, n_frames) \
+            if n_frames else np.zeros(0, dtype=np.complex128)
+
+
+def refine(read, start, end, pattern, candidates, margin, threshold,
+           subsample=False):
+    """Correlates pattern exactly at the full rate offsets within margin
+    of every candidate (a PEAK_DTYPE record at full rate, score being the
+    coarse score) and returns PYRAMID_DTYPE records of the best offset
+    per candidate that reaches threshold"""
+    found = np.zeros(len(candidates), dtype=PYRAMID_DTYPE)
+    keep = np.zeros(len(candidates), dtype=bool)
+    for i, candidate in enumerate(candidates):
+        lo = max(start, candidate['offset'] - margin)
+        hi = min(end - pattern.length, candidate['offset'] + margin)
+        if hi < lo:
+            continue
+        window = np.asarray(read(lo, hi - lo + pattern.length))
+        values = next(xcorr.correlations(window, [pattern]))
+        scores = peaks.score(values)
+        best = int(np.argmax(scores))
+        if not scores[best] > threshold:
+            continue
+        keep[i] = True
+        found['pattern'][i] = candidate['pattern']
+        found['offset'][i] = found['position'][i] = lo + best
+        found['score'][i] = scores[best]
+        found['value'][i] = values[best]
+        found['coarse'][i] = candidate['score']
+        if subsample:
+            delta, height = peaks.interpolate(scores, np.array([best]))
+            found['position'][i] += delta[0]
+            found['score'][i] = height[0]
+
+    found = found[keep]
+    # neighbouring candidates may refine to the same offset
+    if len(found):
+        _, unique = np.unique(found['offset'], return_index=True)
+        found = found[np.sort(unique)]
+    return found
+
+
+def refined_peaks(read, start, count, patterns, coarse, threshold,
+                  coarse_threshold, factor, margin, block_size, correlate,
+                  separation, subsample):
+    """Yields arrays of refined PYRAMID_DTYPE peaks of one haystack range"""
+    end = start + count
+    reader = CoarseReader(read, start, end, factor)
+    blocks = xcorr.correlation_blocks(reader, 0, reader.length, coarse,
+                                      block_size, correlate)
+    detectors = {}
+    for k, pattern in enumerate(coarse):
+        detectors[pattern] = peaks.PeakDetector(
+            coarse_threshold,
+            max(1, (separation or patterns[k].length) // factor), pattern=k)
+
+    def candidates():
+        for offset, pattern, values in blocks:
+            yield detectors[pattern].feed(offset, values)
+        for pattern in coarse:
+            yield detectors[pattern].flush()
+
+    for found in candidates():
+        if len(found):
+            full = found.copy()
+            full['offset'] = start + found['offset'] * factor
+            yield refine(read, start, end, patterns[found['pattern'][0]],
+                         full, margin, threshold, subsample)
+
+
+def search(read, start, count, patterns, threshold, sink,
+           block_size=xcorr.BLOCK_SIZE, correlate=xcorr.correlations,
+           separation=None, top=None, subsample=False, ranges=None,
+           factor=8, coarse_threshold=None, margin=None, coarse=None):
+    """Coarse-to-fine drop-in for peaks.search. The coarse pass keeps
+    peaks above coarse_threshold (default: half the threshold) and
+    correlates with correlate(), which has to work with the coarse
+    patterns (default: coarse_patterns()). margin (default: factor)
+    bounds the full rate offsets searched around each candidate. Peaks
+    are written to sink as PYRAMID_DTYPE records, top keeps only the top
+    highest refined peaks per pattern. Returns the number of peaks"""
+    if coarse is None:
+        coarse = coarse_patterns(patterns, factor)
+    if coarse_threshold is None:
+        coarse_threshold = threshold / 2.0
+    if margin is None:
+        margin = factor
+    if ranges is None:
+        ranges = [(start, count)]
+
+    best = []
+    total = 0
+    for first, frames in ranges:
+        for refined in refined_peaks(read, first, frames, patterns, coarse,
+                                     threshold, coarse_threshold, factor,
+                                     margin, block_size, correlate,
+                                     separation, subsample):
+            if top:
+                best.append(refined)
+            elif len(refined):
+                sink.write(refined)
+                total += len(refined)
+
+    if top and best:
+        merged = np.concatenate(best)
+        for k in range(len(patterns)):
+            mine = merged[merged['pattern'] == k]
+            mine = mine[np.argsort(-mine['score'], kind='mergesort')[:top]]
+            if len(mine):
+                sink.write(np.sort(mine, order='offset'))
+                total += len(mine)
+    return total
+
+
+class CsvSink(peaks.CsvSink):
+    """Writes pyramid peaks as CSV lines with the coarse score"""
+    header = 'pattern,offset,position,score,real,imag,coarse\n'
+
+    def line(self, peak):
+        """CSV line of a peak"""
+        return peaks.CsvSink.line(self, peak)[:-1] + ',{:.6f}\n'.format(
+            peak['coarse'])
+
+
+def open_sink(name, names):
+    """Sink for pyramid peaks: NPY for names ending in .npy, CSV
+    otherwise, CSV on stdout for '-'"""
+    if name == '-':
+        return CsvSink(sys.stdout, names)
+    if name.endswith('.npy'):
+        return peaks.NpySink(name, PYRAMID_DTYPE)
+    return CsvSink(open(name, 'w'), names)
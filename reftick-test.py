@@ -0,0 +1,68 @@
+from reftick import envelopes, find_ticks, TickTracker, TICK_DTYPE
+import peaks
+import unittest as ut
+import numpy as np
+
+def tick_train(length, starts, width, rng):
+    """Noise with bursts of width frames starting at starts"""
+    samples = (rng.normal(size=length)
+               + 1j * rng.normal(size=length)).astype(np.complex64) * 0.1
+    for start in starts:
+        samples[start:start + width] += 3
+    return samples
+
+def blocks(samples, size):
+    for first in range(0, len(samples), size):
+        yield first, samples[first:first + size]
+
+class EnvelopeIsMovingAveragePower(ut.TestCase):
+    def runTest(self):
+        samples = np.arange(20) * (1 + 1j)
+        expected = np.convolve(2 * np.arange(20.0) ** 2, np.ones(4) / 4, 'valid')
+        for size in (20, 7, 3):
+            parts = list(envelopes(blocks(samples, size), 4))
+            assert parts[0][0] == 0
+            np.testing.assert_allclose(np.concatenate([e for _, e in parts]),
+                                       expected)
+
+class TicksAreFoundAcrossBlocks(ut.TestCase):
+    def runTest(self):
+        starts = [1000, 2001, 3003, 4002, 5000]
+        samples = tick_train(6000, starts, 32, np.random.RandomState(1))
+        read = lambda offset, n: samples[offset:offset + n]
+        for size in (6000, 1024, 777):
+            ticks = np.concatenate(list(find_ticks(read, 0, len(samples), 32,
+                                                   10, block_size=size)))
+            np.testing.assert_array_equal(ticks['offset'], starts)
+            assert (abs(ticks['position'] - starts) < 0.5).all()
+            np.testing.assert_allclose(ticks['interval'][1:],
+                                       np.diff(ticks['position']))
+
+class TicksHonourRange(ut.TestCase):
+    def runTest(self):
+        samples = tick_train(6000, [1000, 2000, 3000, 4000], 32,
+                             np.random.RandomState(2))
+        read = lambda offset, n: samples[offset:offset + n]
+        ticks = np.concatenate(list(find_ticks(read, 1500, 2000, 32, 10)))
+        np.testing.assert_array_equal(ticks['offset'], [2000, 3000])
+
+class TicksReportTimeIntervalAndDrift(ut.TestCase):
+    def runTest(self):
+        found = np.zeros(4, dtype=peaks.PEAK_DTYPE)
+        found['offset'] = found['position'] = [100, 200, 302, 400]
+        tracker = TickTracker(rate=100.0, period=100)
+        ticks = np.concatenate((tracker.annotate(found[:2]),
+                                tracker.annotate(found[2:])))
+        assert ticks.dtype == TICK_DTYPE
+        np.testing.assert_array_equal(ticks['time'], [1.0, 2.0, 3.02, 4.0])
+        np.testing.assert_array_equal(ticks['interval'][1:], [100, 102, 98])
+        np.testing.assert_array_equal(ticks['drift'][1:], [0, 2, -2])
+        assert np.isnan(ticks['drift'][0])
+
+        tracker = TickTracker()
+        ticks = tracker.annotate(found)
+        assert np.isnan(ticks['time']).all()
+        np.testing.assert_allclose(ticks['drift'][1:], [0, 1, -2])
+
+if __name__ == '__main__':
+    ut.main()
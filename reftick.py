@@ -0,0 +1,136 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""\
+Streaming detector for periodic reference timer ticks
+
+Ticks are short bursts of energy. Every block of the capture is turned
+into an energy envelope by a moving average over the tick width (the
+matched filter for a rectangular burst), normalized by the median
+envelope of the block as noise floor. Ticks are the non-maximum
+suppressed peaks of that ratio above a level, located with sub-sample
+precision. Only width-1 samples of context are carried between blocks.
+
+Every tick is reported with its interval to the previous tick and the
+drift of that interval against the nominal period (the given one, or
+the mean of all intervals so far).
+"""
+
+import numpy as np
+
+import peaks
+
+TICK_DTYPE = np.dtype([('offset', np.int64),
+                       ('position', np.float64),
+                       ('time', np.float64),
+                       ('level', np.float32),
+                       ('interval', np.float64),
+                       ('drift', np.float64)])
+
+
+def envelopes(blocks, width):
+    """Yields (offset, envelope) for (offset, samples) blocks: the mean
+    power over width samples starting at every offset for which width
+    samples are available so far"""
+    carry = np.zeros(0)
+    position = None
+    for offset, samples in blocks:
+        if position is not None and offset != position + len(carry):
+            carry = np.zeros(0)
+        if not len(carry):
+            position = offset
+
+        power = np.concatenate((carry, np.square(samples.real, dtype=np.float64)
+                                + np.square(samples.imag, dtype=np.float64)))
+        sums = np.zeros(len(power) + 1)
+        np.cumsum(power, out=sums[1:])
+        count = len(power) - width + 1
+        if count > 0:
+            yield position, (sums[width:] - sums[:count]) / width
+            position += count
+            carry = power[count:]
+        else:
+            carry = power
+
+
+class TickTracker(object):
+    """Annotates ticks with time, interval and drift"""
+    def __init__(self, rate=0, period=None):
+        self.rate = rate
+        self.period = period
+        self.previous = None
+        self.intervals = 0
+        self.total = 0.0
+
+    def annotate(self, found):
+        """Turns peaks.PEAK_DTYPE records into TICK_DTYPE records"""
+        ticks = np.zeros(len(found), dtype=TICK_DTYPE)
+        ticks['offset'] = found['offset']
+        ticks['position'] = found['position']
+        ticks['level'] = found['score']
+        ticks['time'] = found['position'] / self.rate if self.rate else np.nan
+        if not len(found):
+            return ticks
+
+        previous = np.concatenate(([np.nan if self.previous is None
+                                    else self.previous],
+                                   found['position'][:-1]))
+        ticks['interval'] = found['position'] - previous
+        measured = np.isfinite(ticks['interval'])
+        if self.period:
+            nominal = np.empty(len(ticks))
+            nominal[:] = self.period
+        else:
+            running = self.total + np.cumsum(np.where(measured,
+                                                      ticks['interval'], 0))
+            counts = self.intervals + np.cumsum(measured)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                nominal = running / counts
+        ticks['drift'] = ticks['interval'] - nominal
+
+        self.previous = found['position'][-1]
+        self.intervals += np.count_nonzero(measured)
+        self.total += ticks['interval'][measured].sum()
+        return ticks
+
+
+def track_ticks(blocks, width, level, period=None, rate=0):
+    """Yields arrays of TICK_DTYPE records for the ticks of width frames
+    whose energy exceeds level times the noise floor in the consecutive
+    (offset, samples) blocks. Ticks closer than half a period (or one
+    width) are suppressed"""
+    separation = period // 2 if period else width
+    detector = peaks.PeakDetector(level, separation, subsample=True)
+    tracker = TickTracker(rate, period)
+
+    for offset, envelope in envelopes(blocks, width):
+        floor = np.median(envelope)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = envelope / floor if floor > 0 else np.zeros(len(envelope))
+        found = detector.feed(offset, ratio)
+        if len(found):
+            yield tracker.annotate(found)
+
+    found = detector.flush()
+    if len(found):
+        yield tracker.annotate(found)
+
+
+def find_ticks(read, start, count, width, level, period=None, rate=0,
+               block_size=1 << 20):
+    """Yields arrays of TICK_DTYPE records of the ticks (see track_ticks)
+    in count frames of the capture behind read(offset, n) starting at
+    start"""
+    def blocks():
+        for first in range(start, start + count, block_size):
+            samples = read(first, min(block_size, start + count - first))
+            if not len(samples):
+                return
+            yield first, samples
+
+    return track_ticks(blocks(), width, level, period, rate)
+
+
+def open_sink(name):
+    """Sink for ticks: NPY for names ending in .npy, CSV otherwise, CSV on
+    stdout for '-'"""
+    return peaks.open_record_sink(name, TICK_DTYPE,
+                                  '{},{:.3f},{:.9f},{:.3f},{:.3f},{:.3f}\n')
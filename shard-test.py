@@ -0,0 +1,127 @@
+from shard import boundaries, plan, write_plan, load_descriptor, run, save, load, merge
+import parseiq
+import iqfile
+import peaks
+import xcorr
+import synthiq
+import unittest as ut
+import numpy as np
+import multiprocessing
+import tempfile
+import shutil
+import os
+
+class ShardFixture(ut.TestCase):
+    """Test fixture with a cs16 capture and a long and a short burst
+    pattern, both on disk. The low threshold finds peaks all over the
+    capture, also around shard boundaries"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        burst = synthiq.pattern(200, 1)
+        samples, _ = synthiq.capture(60000, burst, bursts=6, snr=10, seed=3)
+        self.name = os.path.join(self.directory, 'capture.cs16')
+        synthiq.write_cs16(self.name, samples)
+        self.needles = []
+        for length in (200, 64):
+            name = os.path.join(self.directory, 'burst{}.npy'.format(length))
+            np.save(name, burst[:length].astype(np.complex64))
+            self.needles.append((name, iqfile.IQFile(name)))
+        self.haystack = iqfile.IQFile(self.name)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def single(self, start=0, count=None, threshold=0.1, block_size=4096,
+               separation=None, top=None, subsample=False):
+        patterns = parseiq.load_patterns(self.needles)
+        read = lambda offset, n: iqfile.IQArray(self.haystack, offset, n)
+        sink = peaks.ArraySink()
+        peaks.search(read, start, count or self.haystack.getnframes() - start,
+                     patterns, threshold, sink, block_size,
+                     separation=separation, top=top, subsample=subsample)
+        return sink.result()
+
+    def sharded(self, shards, start=0, count=None, threshold=0.1,
+                block_size=4096, separation=None, top=None, subsample=False):
+        patterns = parseiq.load_patterns(self.needles)
+        read = lambda offset, n: iqfile.IQArray(self.haystack, offset, n)
+        descriptors = plan(self.haystack, self.needles, shards, start, count,
+                           threshold, block_size, separation, top, subsample)
+        # merge does not depend on the order of the results
+        return merge([(descriptor, run(descriptor, patterns, read))
+                      for descriptor in reversed(descriptors)])
+
+class BoundariesLieOnTheBlockGrid(ut.TestCase):
+    def runTest(self):
+        assert boundaries(100000, [200, 64], 4096, 4) == [0, 24576, 49152, 73728]
+        # every shard but the last spans 2 * separation offsets
+        firsts = boundaries(100000, [200], 4096, 10, 5000)
+        assert len(firsts) == 8
+        assert all(first % 4096 == 0 for first in firsts)
+        assert min(np.diff(firsts)) >= 10000
+        assert boundaries(1000, [200], 4096, 4) == [0]
+
+class MergedShardsMatchASingleSearch(ShardFixture):
+    def runTest(self):
+        for options in ({}, {'separation': 5, 'subsample': True},
+                        {'top': 3}, {'start': 1000, 'count': 40000,
+                                     'separation': 3}):
+            expected = self.single(**options)
+            assert len(expected) > 10 or options.get('top')
+            for shards in (1, 3, 7):
+                found = self.sharded(shards, **options)
+                assert found.dtype == expected.dtype
+                assert found.tostring() == expected.tostring(), options
+
+class ShardsRunInSeparateProcesses(ShardFixture):
+    def runTest(self):
+        names = write_plan(plan(self.haystack, self.needles, 4, threshold=0.1,
+                                block_size=4096, separation=9),
+                           self.directory)
+        processes = [multiprocessing.Process(target=parseiq.output_shard,
+                                             args=(name, None, 1))
+                     for name in names]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            assert process.exitcode == 0
+        results = [load(name[:-len('.json')] + '.npz') for name in names]
+        assert [d['shard'] for d, _ in results] == [0, 1, 2, 3]
+        assert merge(results).tostring() == \
+            self.single(separation=9).tostring()
+
+class MergeNeedsAllShardsOfOnePlan(ShardFixture):
+    def runTest(self):
+        patterns = parseiq.load_patterns(self.needles)
+        read = lambda offset, n: iqfile.IQArray(self.haystack, offset, n)
+        results = [(d, run(d, patterns, read)) for d in
+                   plan(self.haystack, self.needles, 3, block_size=4096)]
+        other = plan(self.haystack, self.needles, 3, threshold=0.9,
+                     block_size=4096)[2]
+        self.assertRaises(ValueError, merge, results[:2])
+        self.assertRaises(ValueError, merge, results[:2] +
+                          [(other, run(other, patterns, read))])
+
+class ResultsCarryTheirDescriptor(ShardFixture):
+    def runTest(self):
+        descriptor = plan(self.haystack, self.needles, 2, block_size=4096)[1]
+        [name] = write_plan([descriptor], self.directory)
+        assert load_descriptor(name) == descriptor
+        patterns = parseiq.load_patterns(self.needles)
+        result = run(descriptor, patterns,
+                     lambda offset, n: iqfile.IQArray(self.haystack, offset, n))
+        save(name + '.npz', descriptor, result)
+        loaded, stored = load(name + '.npz')
+        assert loaded == descriptor
+        assert sorted(stored) == sorted(result)
+        assert stored['peaks'].tostring() == result['peaks'].tostring()
+
+class ChangedPatternsAreRejected(ShardFixture):
+    def runTest(self):
+        [name] = write_plan(plan(self.haystack, self.needles, 1), self.directory)
+        np.save(self.needles[1][0], np.ones(64, dtype=np.complex64))
+        self.assertRaises(ValueError, parseiq.output_shard, name, None, 1)
+
+if __name__ == '__main__':
+    ut.main()
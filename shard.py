@@ -0,0 +1,281 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""\
+Split one search over a huge capture into shards
+
+plan() splits the offsets of a search into ranges that are searched
+independently, by local processes or on other machines, and merge()
+combines their results into exactly the peaks, in exactly the order,
+that a single peaks.search() with the same parameters writes.
+
+Shard boundaries lie on the block grid of the unsharded search: every
+shard correlates the same haystack blocks, the values are identical to
+the last bit. A shard reads the len(pattern) - 1 frames after its last
+offset that its last block overlaps into the next shard.
+
+Whether an offset is a peak depends on the scores `separation` offsets
+around it. A shard reports the peaks whose neighbourhood lies within
+its own offsets, and keeps the values of the 2 * separation offsets at
+either end. merge() decides the offsets around each boundary from the
+values of both neighbours. With top, shards report their K best peaks
+per pattern, a superset of their share of the K best ones overall.
+
+Descriptors are JSON objects; they refer to the capture and the pattern
+files by absolute path, the patterns are checked by content hash before
+a shard runs. Results are NPZ files that carry their descriptor. Only
+plain searches can be sharded (no index, pyramid, frequency offsets or
+following).
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+
+import xcorr
+import peaks
+import patcache
+
+# changes whenever the descriptors or results change incompatibly
+VERSION = 1
+
+
+def separations(lengths, separation=None):
+    """Peak separation of each pattern length, the length by default"""
+    return [separation or length for length in lengths]
+
+
+def layout(frames, lengths, block_size):
+    """Number of full blocks of a search over frames frames and whether
+    a final shorter block follows them (see xcorr.block_ranges)"""
+    wanted = block_size + max(lengths) - 1
+    full = (frames - wanted) // block_size + 1 if frames >= wanted else 0
+    return full, full * block_size + min(lengths) <= frames
+
+
+def boundaries(frames, lengths, block_size, shards, separation=None):
+    """Offsets, relative to the start of the search, at which shards
+    begin. They lie on the block grid, and every shard but the last one
+    spans at least 2 * separation offsets"""
+    full, final = layout(frames, lengths, block_size)
+    blocks = full + final
+    width = 2 * max(separations(lengths, separation))
+    needed = max(1, -(-width // block_size))
+    shards = max(1, min(shards, blocks // needed))
+    return [block_size * (i * blocks // shards) for i in range(shards)]
+
+
+def plan_id(common):
+    """Identifier of the search a descriptor belongs to"""
+    return hashlib.sha1(json.dumps(common, sort_keys=True)).hexdigest()
+
+
+def plan(iq_file, needles, shards, start=0, count=None, threshold=0.5,
+         block_size=xcorr.BLOCK_SIZE, separation=None, top=None,
+         subsample=False, precision='single'):
+    """Descriptors of up to shards shards of a search of needles, a list
+    of (name, iqfile.IQFile) tuples, in count frames (default: all) of
+    iq_file from start"""
+    available = max(0, iq_file.getnframes() - start)
+    frames = min(count, available) if count else available
+    lengths = [needle.getnframes() for _, needle in needles]
+    common = {'version': VERSION,
+              'file': os.path.abspath(iq_file.name),
+              'capture_frames': iq_file.getnframes(),
+              'patterns': [[name, os.path.abspath(needle.name),
+                            patcache.content_hash(needle.name)]
+                           for name, needle in needles],
+              'lengths': lengths,
+              'start': start,
+              'frames': frames,
+              'threshold': threshold,
+              'block': block_size,
+              'separation': separation or None,
+              'top': top or None,
+              'subsample': bool(subsample),
+              'precision': precision}
+    common['plan'] = plan_id(common)
+    firsts = boundaries(frames, lengths, block_size, shards, separation)
+    lasts = firsts[1:] + [None]
+    return [dict(common, shard=i, shards=len(firsts),
+                 first=start + first,
+                 last=start + last if last is not None else None)
+            for i, (first, last) in enumerate(zip(firsts, lasts))]
+
+
+def write_plan(descriptors, directory='.', prefix='shard'):
+    """Writes the descriptors to JSON files in directory. Returns their
+    names"""
+    names = []
+    for descriptor in descriptors:
+        name = os.path.join(directory, '{}-{:04d}-of-{:04d}.json'.format(
+            prefix, descriptor['shard'], descriptor['shards']))
+        with open(name, 'w') as out:
+            json.dump(descriptor, out, indent=1, sort_keys=True)
+            out.write('\n')
+        names.append(name)
+    return names
+
+
+def load_descriptor(name):
+    """Descriptor of a JSON file written by write_plan()"""
+    with open(name, 'r') as fh:
+        descriptor = json.load(fh)
+    if descriptor.get('version') != VERSION:
+        raise ValueError('{} is not a version {} shard descriptor'.format(
+            name, VERSION))
+    return descriptor
+
+
+def needles(descriptor):
+    """(name, path) of the patterns of a descriptor. Raises ValueError
+    if a pattern file changed since the plan was made"""
+    for name, path, digest in descriptor['patterns']:
+        if patcache.content_hash(path) != digest:
+            raise ValueError('pattern {} changed since the plan was '
+                             'made'.format(path))
+    return [(name, path) for name, path, _ in descriptor['patterns']]
+
+
+def check_capture(descriptor, iq_file):
+    """Raises ValueError unless iq_file is the capture that was planned"""
+    if iq_file.getnframes() != descriptor['capture_frames']:
+        raise ValueError('{} has {} frames, the plan was made for {}'.format(
+            iq_file.name, iq_file.getnframes(), descriptor['capture_frames']))
+
+
+def best(found, top):
+    """The top highest peaks of every pattern, earlier ones first among
+    equal scores, like PeakDetector(top=top) keeps them"""
+    kept = []
+    for k in np.unique(found['pattern']):
+        mine = found[found['pattern'] == k]
+        kept.append(mine[np.lexsort((mine['offset'], -mine['score']))[:top]])
+    return np.concatenate(kept) if kept else found
+
+
+def run(descriptor, patterns, read, correlate=xcorr.correlations):
+    """Searches the shard of descriptor for patterns, the xcorr.Patterns
+    of its needles, reading the haystack with read(offset, n). Returns a
+    dict with the peaks decided by the shard and the values at both of
+    its ends ('head<k>', 'tail<k>' per pattern)"""
+    lengths = [pattern.length for pattern in patterns]
+    seps = separations(lengths, descriptor['separation'])
+    first, last = descriptor['first'], descriptor['last']
+    end = descriptor['start'] + descriptor['frames']
+    final = last is None
+    # the offsets each pattern has in this shard end at ends[k]
+    ends = [end - length + 1 if final else last for length in lengths]
+    frames = (end if final else last + max(lengths) - 1) - first
+
+    index = dict((pattern, k) for k, pattern in enumerate(patterns))
+    detectors = [peaks.PeakDetector(descriptor['threshold'], sep, None,
+                                    descriptor['subsample'], k)
+                 for k, sep in enumerate(seps)]
+    dtype = xcorr.result_dtype(patterns)
+    heads = [np.zeros(0, dtype=dtype) for _ in patterns]
+    tails = [np.zeros(0, dtype=dtype) for _ in patterns]
+
+    def decided(found, k):
+        low = first + seps[k] if descriptor['shard'] else None
+        high = None if final else last - seps[k]
+        keep = np.ones(len(found), dtype=bool)
+        if low is not None:
+            keep &= found['offset'] >= low
+        if high is not None:
+            keep &= found['offset'] < high
+        return found[keep]
+
+    found = []
+    for offset, pattern, values in xcorr.correlation_blocks(
+            read, first, frames, patterns, descriptor['block'], correlate):
+        k = index[pattern]
+        values = values[:max(0, ends[k] - offset)]
+        width = 2 * seps[k]
+        if len(heads[k]) < width:
+            heads[k] = np.concatenate((heads[k],
+                                       values[:width - len(heads[k])]))
+        tails[k] = np.concatenate((tails[k], values[-width:]))[-width:]
+        found.append(decided(detectors[k].feed(offset, values), k))
+    for k, detector in enumerate(detectors):
+        found.append(decided(detector.flush(), k))
+
+    result = {'peaks': np.concatenate(found) if found
+              else np.zeros(0, dtype=peaks.PEAK_DTYPE)}
+    if descriptor['top']:
+        result['peaks'] = best(result['peaks'], descriptor['top'])
+    for k in range(len(patterns)):
+        result['head{}'.format(k)] = heads[k]
+        result['tail{}'.format(k)] = tails[k]
+    return result
+
+
+def save(name, descriptor, result):
+    """Writes the result of a shard with its descriptor to the NPZ file
+    name, atomically"""
+    temporary = '{}.{}.tmp'.format(name, os.getpid())
+    with open(temporary, 'wb') as out:
+        np.savez(out, descriptor=np.array(json.dumps(descriptor)), **result)
+    os.rename(temporary, name)
+
+
+def load(name):
+    """(descriptor, result) of a result file written by save()"""
+    with np.load(name) as data:
+        result = dict((key, data[key]) for key in data.files
+                      if key != 'descriptor')
+        return json.loads(str(data['descriptor'])), result
+
+
+def emission_order(found, descriptor):
+    """Indices that sort found peaks into the order peaks.search() writes
+    them: by the block after which they are final, then by pattern and
+    offset. Peaks that are only final at the end (all of them with top)
+    come last"""
+    lengths = descriptor['lengths']
+    seps = np.array(separations(lengths, descriptor['separation']))
+    length = np.array(lengths)[found['pattern']]
+    block_size = descriptor['block']
+    frames = descriptor['frames']
+    full, final = layout(frames, lengths, block_size)
+
+    # a peak is final once a block reaches separation offsets past it
+    needed = found['offset'] - descriptor['start'] + seps[found['pattern']] + 1
+    block = np.maximum(0, (needed - 1) // block_size)
+    last_block = needed <= frames - length + 1
+    block = np.where(block < full, block,
+                     np.where(final & last_block, full, full + 1))
+    if descriptor['top']:
+        block[:] = full + 1
+    return np.lexsort((found['offset'], found['pattern'], block))
+
+
+def merge(results):
+    """Peaks of a search from the (descriptor, result) of all its shards,
+    in the order a single peaks.search() would write them. Raises
+    ValueError if shards are missing or belong to different plans"""
+    results = sorted(results, key=lambda item: item[0]['shard'])
+    descriptor = results[0][0]
+    if [d['plan'] for d, _ in results] != [descriptor['plan']] * len(results) \
+            or [d['shard'] for d, _ in results] != range(descriptor['shards']):
+        raise ValueError('need the results of all {} shards of one plan'
+                         .format(descriptor['shards']))
+
+    seps = separations(descriptor['lengths'], descriptor['separation'])
+    found = [result['peaks'] for _, result in results]
+    for (_, before), (shard, after) in zip(results, results[1:]):
+        boundary = shard['first']
+        for k, sep in enumerate(seps):
+            tail, head = before['tail{}'.format(k)], after['head{}'.format(k)]
+            detector = peaks.PeakDetector(descriptor['threshold'], sep, None,
+                                          descriptor['subsample'], k)
+            near = np.concatenate((
+                detector.feed(boundary - len(tail),
+                              np.concatenate((tail, head))),
+                detector.flush()))
+            found.append(near[(near['offset'] >= boundary - sep)
+                              & (near['offset'] < boundary + sep)])
+
+    found = np.concatenate(found)
+    if descriptor['top']:
+        found = best(found, descriptor['top'])
+    return found[emission_order(found, descriptor)]
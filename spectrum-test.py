@@ -0,0 +1,47 @@
+from spectrum import Layout, analyze, peaksearch, SPECTRUM_DTYPE
+import unittest as ut
+import numpy as np
+
+def tone(length, frequency, amplitude=1.0):
+    return (amplitude * np.exp(2j * np.pi * frequency * np.arange(length))
+            ).astype(np.complex64)
+
+class LayoutPlacesBlocksAndSegments(ut.TestCase):
+    def runTest(self):
+        layout = Layout(8, skip=2)
+        assert layout.count(27) == 2 and layout.count(28) == 3
+        assert layout.frames(3) == 28
+        view = layout.view(np.arange(28), 3)
+        np.testing.assert_array_equal(view[:, 0, 0], [0, 10, 20])
+
+        layout = Layout(8, segments=3)
+        assert layout.span == 16
+        view = layout.view(np.arange(32), 2)
+        np.testing.assert_array_equal(view[1, :, 0], [16, 20, 24])
+
+class AnalyzeFindsToneFrequencyAndPower(ut.TestCase):
+    def runTest(self):
+        samples = tone(4096, 0.125, 2.0) + tone(4096, -0.25, 0.5)
+        for segments in (1, 3):
+            records = analyze(samples, Layout(256, segments=segments),
+                              np.hanning(256), rate=1000)
+            assert records.dtype == SPECTRUM_DTYPE
+            np.testing.assert_allclose(records['frequency'], 125)
+            np.testing.assert_allclose(records['power'], 4, rtol=1e-4)
+            np.testing.assert_allclose(records['mean'], 4.25, rtol=1e-2)
+
+class PeaksearchIsIndependentOfBatchingAndThreads(ut.TestCase):
+    def runTest(self):
+        samples = np.concatenate((tone(3000, 0.1), tone(3000, -0.2)))
+        read = lambda offset, n: samples[offset:offset + n]
+        expected = np.concatenate(list(peaksearch(read, 100, 5000, 128, 3)))
+        assert len(expected) == 5000 // 131
+        assert expected['offset'][0] == 100 and expected['offset'][1] == 231
+        for batch_size, workers in ((300, 1), (1000, 3), (1, 0)):
+            records = np.concatenate(list(peaksearch(
+                read, 100, 5000, 128, 3, workers=workers,
+                batch_size=batch_size)))
+            np.testing.assert_array_equal(records, expected)
+
+if __name__ == '__main__':
+    ut.main()
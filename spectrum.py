@@ -0,0 +1,136 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""\
+Batched spectral peak search
+
+A capture is cut into blocks of `size` frames with `skip` frames left out
+between consecutive blocks. Every block yields the frequency and power
+of its strongest FFT bin and the mean power of the block.
+
+With Welch averaging a block consists of `segments` half overlapping
+segments of `size` frames whose power spectra are averaged, which lowers
+the variance of the noise floor at the same resolution.
+
+Blocks are never sliced out one by one: a batch of consecutive blocks is
+read at once and viewed as a (blocks, segments, size) array by striding
+over the samples, windowed and transformed in a single FFT call. Batches
+can be processed by a pool of threads, numpy releases the GIL in the
+heavy parts.
+"""
+
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+import peaks
+
+# number of frames read per batch of blocks
+BATCH_SIZE = 1 << 18
+
+SPECTRUM_DTYPE = np.dtype([('offset', np.int64),
+                           ('frequency', np.float64),
+                           ('power', np.float64),
+                           ('mean', np.float64)])
+
+WINDOWS = {
+    'rect': np.ones,
+    'hann': np.hanning,
+    'hamming': np.hamming,
+    'blackman': np.blackman,
+}
+
+
+class Layout(object):
+    """Placement of blocks and their Welch segments in the capture"""
+    def __init__(self, size, skip=0, segments=1):
+        self.size = size
+        self.segments = segments
+        self.hop = max(1, size // 2) if segments > 1 else size
+        self.span = size + (segments - 1) * self.hop
+        self.step = self.span + skip
+
+    def count(self, frames):
+        """Number of complete blocks in frames"""
+        if frames < self.span:
+            return 0
+        return (frames - self.span) // self.step + 1
+
+    def frames(self, blocks):
+        """Number of frames covered by consecutive blocks"""
+        return (blocks - 1) * self.step + self.span if blocks else 0
+
+    def view(self, samples, blocks):
+        """(blocks, segments, size) view of the first blocks in samples"""
+        samples = np.ascontiguousarray(samples)
+        item = samples.strides[0]
+        return as_strided(samples, (blocks, self.segments, self.size),
+                          (self.step * item, self.hop * item, item))
+
+
+def power_spectra(view, window):
+    """Welch averaged power spectra of a (blocks, segments, size) view,
+    scaled so a full scale tone at a bin frequency reads its power"""
+    spectra = np.fft.fft(view * window, axis=-1)
+    power = np.square(spectra.real) + np.square(spectra.imag)
+    return power.mean(axis=1) / np.square(window.sum())
+
+
+def analyze(samples, layout, window, rate=0):
+    """SPECTRUM_DTYPE records, offsets relative to samples, of all
+    complete blocks in samples"""
+    blocks = layout.count(len(samples))
+    records = np.zeros(blocks, dtype=SPECTRUM_DTYPE)
+    if not blocks:
+        return records
+
+    power = power_spectra(layout.view(samples, blocks), window)
+    peak = power.argmax(axis=1)
+    rows = np.arange(blocks)
+    frequencies = np.fft.fftfreq(layout.size)
+    records['offset'] = rows * layout.step
+    records['frequency'] = frequencies[peak] * (rate or 1)
+    records['power'] = power[rows, peak]
+    # Parseval: the bins sum up to the mean power of the windowed signal
+    records['mean'] = (power.sum(axis=1) * np.square(window.sum())
+                       / (layout.size * np.square(window).sum()))
+    return records
+
+
+def peaksearch(read, start, count, size, skip=0, segments=1, window='hann',
+               rate=0, workers=1, batch_size=BATCH_SIZE):
+    """Yields arrays of SPECTRUM_DTYPE records for the blocks in count
+    frames of the capture behind read(offset, n), starting at start.
+    Batches of blocks are analyzed by workers threads (0 for one per
+    core) and yielded in order"""
+    layout = Layout(size, skip, segments)
+    taper = WINDOWS[window](size)
+    per_batch = max(1, layout.count(batch_size))
+    total = layout.count(count)
+    firsts = range(0, total, per_batch)
+
+    def batch(first):
+        blocks = min(per_batch, total - first)
+        offset = start + first * layout.step
+        records = analyze(read(offset, layout.frames(blocks)), layout, taper,
+                          rate)
+        records['offset'] += offset
+        return records
+
+    if workers == 1:
+        for first in firsts:
+            yield batch(first)
+        return
+
+    pool = ThreadPool(workers or None)
+    try:
+        for records in pool.imap(batch, firsts):
+            yield records
+    finally:
+        pool.terminate()
+
+
+def open_sink(name):
+    """Sink for spectral peaks: NPY for names ending in .npy, CSV
+    otherwise, CSV on stdout for '-'"""
+    return peaks.open_record_sink(name, SPECTRUM_DTYPE,
+                                  '{},{:.6f},{:.6g},{:.6g}\n')
@@ -0,0 +1,39 @@
+from synthiq import capture, pattern, write_wav, write_cs16, frames, FULL_SCALE
+from iqfile import IQFile
+import unittest as ut
+import numpy as np
+import tempfile
+import os
+
+class CapturesAreDeterministic(ut.TestCase):
+    def runTest(self):
+        first, offsets = capture(5000, pattern(64), seed=3)
+        second, again = capture(5000, pattern(64), seed=3)
+        np.testing.assert_array_equal(first, second)
+        np.testing.assert_array_equal(offsets, again)
+        other, _ = capture(5000, pattern(64), seed=4)
+        assert (first != other).any()
+
+class CapturesHoldBurstsAtOffsets(ut.TestCase):
+    def runTest(self):
+        burst = pattern(128)
+        samples, offsets = capture(20000, burst, bursts=3, tones=(), snr=100)
+        assert len(offsets) == 3
+        for offset in offsets:
+            window = samples[offset:offset + 128]
+            corr = np.vdot(burst, window) / np.linalg.norm(burst) / np.linalg.norm(window)
+            assert abs(corr) > 0.95
+        assert np.abs(samples).max() <= FULL_SCALE / 4 + 1e-6
+
+class WrittenCapturesReadBack(ut.TestCase):
+    def runTest(self):
+        samples, _ = capture(1000)
+        for suffix, write in (('.wav', write_wav), ('.cs16', write_cs16)):
+            name = tempfile.mktemp(suffix=suffix)
+            write(name, samples)
+            np.testing.assert_array_equal(IQFile(name).data, frames(samples))
+            os.unlink(name)
+        assert frames(np.array([1e6 - 1e6j]))[0].tolist() == [32767, -32768]
+
+if __name__ == '__main__':
+    ut.main()
@@ -0,0 +1,76 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""\
+Deterministic synthetic IQ captures
+
+Captures are built from a seeded random generator, so the same arguments
+always produce the same samples: complex gaussian noise, a few carriers
+(tones) and copies of a pattern (bursts) at known offsets. Samples are
+scaled to the 16 bit range so they survive being written as WAV or cs16.
+"""
+
+import wave
+import numpy as np
+
+# full scale of 16 bit samples
+FULL_SCALE = 32767
+
+
+def noise(rng, length, power=1.0):
+    """Complex gaussian noise of mean power"""
+    scale = np.sqrt(power / 2)
+    return scale * (rng.normal(size=length) + 1j * rng.normal(size=length))
+
+
+def tone(length, frequency, amplitude=1.0, phase=0.0):
+    """Complex carrier at frequency in cycles per frame"""
+    return amplitude * np.exp(1j * (2 * np.pi * frequency * np.arange(length)
+                                    + phase))
+
+
+def pattern(length, seed=0):
+    """A noise like pattern of unit power"""
+    return noise(np.random.RandomState(seed), length)
+
+
+def capture(length, burst=None, bursts=4, tones=((0.05, 0.5), (-0.21, 0.25)),
+            snr=10.0, seed=0):
+    """Returns (samples, offsets): length complex128 samples of noise
+    plus the (frequency, amplitude) tones and, if a burst pattern is
+    given, that many copies of it at the returned offsets, with a power
+    snr times the noise. Samples are scaled to a quarter of full scale"""
+    rng = np.random.RandomState(seed)
+    samples = noise(rng, length)
+    for frequency, amplitude in tones:
+        samples += tone(length, frequency, amplitude, rng.uniform(0, 2 * np.pi))
+
+    offsets = np.zeros(0, dtype=np.int64)
+    if burst is not None and bursts and length >= len(burst):
+        offsets = np.sort(rng.choice(length - len(burst) + 1, bursts,
+                                     replace=False))
+        gain = np.sqrt(snr)
+        for offset in offsets:
+            samples[offset:offset + len(burst)] += gain * burst
+
+    peak = np.abs(samples).max() or 1.0
+    return samples * (FULL_SCALE / 4 / peak), offsets
+
+
+def frames(samples):
+    """(n, 2) int16 I/Q frames of samples, rounded and clipped"""
+    iq = np.empty((len(samples), 2))
+    iq[:, 0] = samples.real
+    iq[:, 1] = samples.imag
+    return np.clip(np.rint(iq), -FULL_SCALE - 1, FULL_SCALE).astype('<i2')
+
+
+def write_wav(name, samples, framerate=44100):
+    """Writes samples as 16 bit stereo I/Q WAV file"""
+    wav = wave.open(name, 'wb')
+    wav.setparams((2, 2, framerate, len(samples), 'NONE', 'not compressed'))
+    wav.writeframes(frames(samples).tostring())
+    wav.close()
+
+
+def write_cs16(name, samples):
+    """Writes samples as raw interleaved int16 I/Q frames"""
+    frames(samples).tofile(name)
@@ -0,0 +1,152 @@
+from parseiq import correlate
+import xcorr
+import unittest as ut
+import numpy as np
+
+def randomiq(rng, n):
+    """Complex samples with integer I/Q like a 16 bit capture"""
+    return (rng.randint(-2000, 2000, n) + 1j * rng.randint(-2000, 2000, n))
+
+def bruteforce(haystack, needle):
+    return np.array([correlate(haystack[i:i+len(needle)], needle)
+                     for i in range(len(haystack) - len(needle) + 1)])
+
+class RandomIQFixture(ut.TestCase):
+    """Test fixture with a random haystack containing the needle"""
+    def setUp(self):
+        rng = np.random.RandomState(1234)
+        self.needle = randomiq(rng, 37)
+        self.haystack = randomiq(rng, 3000)
+        self.haystack[1234:1234+len(self.needle)] = 3 * self.needle + 5j
+
+class NormalizedCorrelationMatchesCorrelate(RandomIQFixture):
+    def runTest(self):
+        np.testing.assert_allclose(
+            xcorr.normalized_correlation(self.haystack, self.needle),
+            bruteforce(self.haystack, self.needle), rtol=1e-9, atol=1e-9)
+
+class NormalizedCorrelationSpansManySegments(RandomIQFixture):
+    def runTest(self):
+        values = xcorr.normalized_correlation(self.haystack, self.needle,
+                                              nfft=64)
+        np.testing.assert_allclose(values,
+                                   bruteforce(self.haystack, self.needle),
+                                   rtol=1e-9, atol=1e-9)
+
+class NormalizedCorrelationFindsEmbeddedNeedle(RandomIQFixture):
+    def runTest(self):
+        values = xcorr.normalized_correlation(self.haystack, self.needle)
+        assert np.argmax(values.real) == 1234
+        assert abs(values[1234] - 37.0/36) < 1e-9
+
+class NormalizedCorrelationHasOneValuePerOffset(RandomIQFixture):
+    def runTest(self):
+        values = xcorr.normalized_correlation(self.haystack, self.needle)
+        assert len(values) == len(self.haystack) - len(self.needle) + 1
+
+class NormalizedCorrelationOfShortHaystackIsEmpty(RandomIQFixture):
+    def runTest(self):
+        values = xcorr.normalized_correlation(self.needle[:10], self.needle)
+        assert len(values) == 0
+
+class ConstantWindowsAreUndefined(RandomIQFixture):
+    def runTest(self):
+        self.haystack[500:600] = 0
+        self.haystack[700:800] = 3 - 4j
+        values = xcorr.normalized_correlation(self.haystack, self.needle)
+        assert np.isnan(values[500:564]).all()
+        assert np.isnan(values[700:764]).all()
+        assert np.isfinite(values[:464]).all()
+
+class WindowStatsMatchNumpy(RandomIQFixture):
+    def runTest(self):
+        mean, std = xcorr.window_stats(self.haystack[:200], 37)
+        for i in (0, 17, 163):
+            window = self.haystack[i:i+37]
+            assert abs(mean[i] - np.mean(window)) < 1e-9
+            assert abs(std[i] - np.std(window)) < 1e-6
+
+class PatternCachesSpectrumPerFFTSize(RandomIQFixture):
+    def runTest(self):
+        pattern = xcorr.Pattern(self.needle)
+        assert pattern.spectrum(128) is pattern.spectrum(128)
+        assert len(pattern.spectrum(256)) == 256
+
+class CorrelationBlocksMatchSinglePass(RandomIQFixture):
+    def runTest(self):
+        read = lambda offset, n: self.haystack[offset:offset + n]
+        blocks = list(xcorr.correlation_blocks(read, 100, 2500, self.needle,
+                                               block_size=333))
+        assert blocks[0][0] == 100
+        assert blocks[1][0] == 433
+        np.testing.assert_allclose(
+            np.concatenate([values for _, _, values in blocks]),
+            xcorr.normalized_correlation(self.haystack[100:2600], self.needle),
+            rtol=1e-9, atol=1e-9)
+
+class FindReportsOffsetsAboveThreshold(RandomIQFixture):
+    def runTest(self):
+        read = lambda offset, n: self.haystack[offset:offset + n]
+        hits = list(xcorr.find(read, 0, len(self.haystack), self.needle,
+                               0.9, block_size=500))
+        assert len(hits) == 1
+        np.testing.assert_array_equal(hits[0][1], [1234])
+
+class CorrelationBlocksHandleNeedlesOfDifferentLength(RandomIQFixture):
+    def runTest(self):
+        short = xcorr.Pattern(self.haystack[2000:2010], name='short')
+        needles = [xcorr.Pattern(self.needle, name='long'), short]
+        read = lambda offset, n: self.haystack[offset:offset + n]
+        results = {'long': [], 'short': []}
+        for offset, pattern, values in xcorr.correlation_blocks(
+                read, 0, len(self.haystack), needles, block_size=400):
+            assert offset == 400 * len(results[pattern.name])
+            results[pattern.name].append(values)
+        np.testing.assert_allclose(
+            np.concatenate(results['long']),
+            xcorr.normalized_correlation(self.haystack, self.needle),
+            rtol=1e-9, atol=1e-9)
+        np.testing.assert_allclose(
+            np.concatenate(results['short']),
+            xcorr.normalized_correlation(self.haystack, short),
+            rtol=1e-9, atol=1e-9)
+
+class FindTagsHitsWithMatchingPattern(RandomIQFixture):
+    def runTest(self):
+        needles = [xcorr.Pattern(self.haystack[2000:2050], name='a'),
+                   xcorr.Pattern(self.needle, name='b')]
+        read = lambda offset, n: self.haystack[offset:offset + n]
+        hits = sorted((pattern.name, list(offsets)) for pattern, offsets, _
+                      in xcorr.find(read, 0, len(self.haystack), needles,
+                                    0.9, block_size=500))
+        assert hits == [('a', [2000]), ('b', [1234])]
+
+class SinglePrecisionStaysWithinBound(ut.TestCase):
+    def runTest(self):
+        rng = np.random.RandomState(99)
+        noise = randomiq(rng, 50000)
+        # without and with a DC offset of three standard deviations
+        for offset, bound in ((0, 2e-7), (3 * np.std(noise), 2e-6)):
+            haystack = noise + offset
+            needle = haystack[20000:21024]
+            double = xcorr.normalized_correlation(haystack, needle)
+            single = xcorr.normalized_correlation(
+                haystack.astype(np.complex64), needle.astype(np.complex64))
+            assert single.dtype == np.complex64
+            assert np.max(np.abs(single - double)) < bound
+
+class PatternStatisticsAreDoublePrecision(ut.TestCase):
+    def runTest(self):
+        samples = randomiq(np.random.RandomState(5), 1000)
+        single = xcorr.Pattern(samples.astype(np.complex64))
+        double = xcorr.Pattern(samples)
+        assert single.dtype == np.complex64 and double.dtype == np.complex128
+        assert single.mean == double.mean and single.std == double.std
+        assert single.spectrum(2048).dtype == np.complex64
+        assert xcorr.result_dtype([single, double]) == np.complex128
+        assert xcorr.precision('single') == np.complex64
+        with self.assertRaises(ValueError):
+            xcorr.precision('half')
+
+if __name__ == '__main__':
+    ut.main()
@@ -0,0 +1,288 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+"""\
+FFT based normalized cross-correlation
+
+Computes the same metric as parseiq.correlate() for every offset of a
+needle inside a haystack in a single pass. The complex numerator comes
+from overlap-save FFT convolution, the per-window mean and standard
+deviation from sliding prefix sums.
+
+Haystacks are processed in blocks that overlap by len(needle)-1 samples
+so memory use is bounded by the block size, not by the haystack size.
+Any number of needles can be searched in one pass: each haystack block
+is read and transformed once and multiplied with every needle spectrum.
+
+Precision: samples, spectra and correlation values are kept in the
+complex type of the patterns (see PRECISIONS), complex64 unless a
+pattern is complex128. Every FFT and every reduction - pattern mean and
+standard deviation, the prefix sums of the window statistics - is
+computed in double precision, so single precision only rounds the
+stored operands and results to 24 bits. The subtraction of the means
+scales the error by 1 + |mean|**2 / variance of the haystack. On 16 bit
+captures the values stay within 2e-7 * (1 + |mean|**2 / variance) of the
+complex128 ones: 2e-7 without a DC offset, 2e-6 with one of three
+standard deviations (see xcorr-test.py).
+"""
+
+import os
+import glob
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from hpmc import metrics
+
+# number of overlap-save segments transformed per FFT call
+SEGMENT_BATCH = 64
+
+# number of correlation offsets computed per haystack block
+BLOCK_SIZE = 1 << 20
+
+# complex type of samples, spectra and values per precision name
+PRECISIONS = {'single': np.complex64, 'double': np.complex128}
+
+
+def precision(name):
+    """Complex type of the precision name (see PRECISIONS)"""
+    if name not in PRECISIONS:
+        raise ValueError('unknown precision {}, use one of {}'.format(
+            name, ', '.join(sorted(PRECISIONS))))
+    return PRECISIONS[name]
+
+
+def next_pow2(n):
+    """Smallest power of two that is not less than n"""
+    return 1 << max(0, int(n) - 1).bit_length()
+
+
+def fft_length(needle_length):
+    """FFT size used for overlap-save with a needle of the given length"""
+    return max(1024, next_pow2(4 * needle_length))
+
+
+class Pattern(object):
+    """A needle prepared for repeated correlation: length, mean,
+    standard deviation (in double precision) and conjugate spectra per
+    FFT size (in the precision of the samples)"""
+    def __init__(self, samples, name=None):
+        self.samples = np.asarray(samples)
+        self.name = name
+        self.length = len(self.samples)
+        wide = self.samples.astype(np.complex128, copy=False)
+        self.mean = np.mean(wide)
+        self.std = np.std(wide)
+        self.spectra = {}
+
+    @property
+    def dtype(self):
+        """Complex type correlations with the pattern are computed in"""
+        return np.result_type(self.samples.dtype, np.complex64)
+
+    def spectrum(self, nfft):
+        """conj(fft(samples)) zero padded to nfft"""
+        if nfft not in self.spectra:
+            self.spectra[nfft] = np.fft.fft(self.samples, nfft).conjugate(
+                ).astype(self.dtype, copy=False)
+        return self.spectra[nfft]
+
+
+def result_dtype(patterns):
+    """Complex type of the correlations with all of patterns"""
+    return np.result_type(*[pattern.dtype for pattern in patterns])
+
+
+def prefix_sums(data):
+    """Returns prefix sums of data and of its squared magnitude,
+    accumulated in double precision"""
+    sums = np.zeros(len(data) + 1, dtype=np.complex128)
+    np.cumsum(data, dtype=np.complex128, out=sums[1:])
+    squares = np.zeros(len(data) + 1, dtype=np.float64)
+    np.cumsum(np.square(data.real, dtype=np.float64)
+              + np.square(data.imag, dtype=np.float64), out=squares[1:])
+    return sums, squares
+
+
+def window_stats(data, length, sums=None):
+    """Returns mean and standard deviation of every window of the given
+    length in data, computed from prefix sums"""
+    count = len(data) - length + 1
+    if count <= 0:
+        return np.zeros(0, dtype=np.complex128), np.zeros(0)
+
+    if sums is None:
+        sums = prefix_sums(data)
+    sums, squares = sums
+
+    mean = (sums[length:length + count] - sums[:count]) / length
+    power = (squares[length:length + count] - squares[:count]) / length
+    variance = power - np.square(np.abs(mean))
+    # differences of prefix sums carry rounding errors relative to the
+    # running total, windows with less variance than that are constant
+    noise = 64 * np.finfo(np.float64).eps * squares[length:length + count] / length
+    return mean, np.sqrt(np.where(variance > noise, variance, 0.0))
+
+
+def segment_spectra(data, length, nfft, count=None, dtype=np.complex128):
+    """Splits data into overlap-save segments of nfft samples for needles
+    of up to length samples and returns their spectra as dtype, one row
+    per segment. count limits the number of offsets the segments cover"""
+    if count is None:
+        count = len(data) - length + 1
+    step = nfft - length + 1
+    segments = -(-count // step)
+    padded = np.zeros((segments - 1) * step + nfft, dtype=dtype)
+    used = min(len(data), len(padded))
+    padded[:used] = data[:used]
+    frames = as_strided(padded, shape=(segments, nfft),
+                        strides=(step * padded.itemsize, padded.itemsize))
+
+    spectra = np.empty((segments, nfft), dtype=dtype)
+    for first in range(0, segments, SEGMENT_BATCH):
+        last = min(segments, first + SEGMENT_BATCH)
+        spectra[first:last] = np.fft.fft(frames[first:last], axis=1)
+    return spectra
+
+
+def overlap_save(segments, spectrum, step, count):
+    """Returns sum(data[i:i+length] * conj(needle)) for the first count
+    offsets i, given the segment spectra of data (see segment_spectra)
+    and the conjugate needle spectrum. step is nfft - length + 1 for the
+    longest needle the segments were built for. The result has the type
+    of the segments"""
+    result = np.empty((len(segments), step), dtype=segments.dtype)
+    for first in range(0, len(segments), SEGMENT_BATCH):
+        last = min(len(segments), first + SEGMENT_BATCH)
+        result[first:last] = np.fft.ifft(segments[first:last] * spectrum,
+                                         axis=1)[:, :step]
+    return result.reshape(-1)[:count]
+
+
+def correlations(haystack, patterns, nfft=None, count=None):
+    """Yields the normalized correlation of haystack with each of the
+    patterns in turn. The haystack is transformed only once. Each array
+    holds count values (default: every offset at which the pattern fits
+    completely into haystack) of the result_dtype() of the patterns"""
+    haystack = np.asarray(haystack)
+    dtype = result_dtype(patterns)
+    longest = max(pattern.length for pattern in patterns)
+    if nfft is None:
+        nfft = fft_length(longest)
+
+    counts = [max(0, len(haystack) - pattern.length + 1)
+              for pattern in patterns]
+    if count is not None:
+        counts = [min(count, n) for n in counts]
+    if max(counts) == 0:
+        for pattern in patterns:
+            yield np.zeros(0, dtype=dtype)
+        return
+
+    step = nfft - longest + 1
+    segments = segment_spectra(haystack, longest, nfft, max(counts), dtype)
+    sums = prefix_sums(haystack)
+    # window statistics are shared by consecutive patterns of the same
+    # length, like the members of a frequency bank (see cfo)
+    shared, stats = None, None
+
+    for pattern, n in zip(patterns, counts):
+        length = pattern.length
+        numerator = overlap_save(segments, pattern.spectrum(nfft), step, n)
+        if shared != (length, n):
+            shared = (length, n)
+            stats = window_stats(haystack[:n + length - 1], length, sums)
+        mean, std = stats
+        numerator -= length * mean * pattern.mean.conjugate()
+
+        # divided in double precision, stored in place
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = np.divide(numerator, (length - 1) * std * pattern.std,
+                               out=numerator)
+        # undefined like the 0/0 of correlate() for constant windows
+        values[std == 0] = np.nan
+        yield values
+
+
+def normalized_correlation(haystack, needle, nfft=None):
+    """Calculates correlate(haystack[i:], needle) for every offset i at
+    which the needle fits completely into haystack"""
+    pattern = needle if isinstance(needle, Pattern) else Pattern(needle)
+    return next(correlations(haystack, [pattern], nfft))
+
+
+def as_patterns(needles):
+    """Wraps a single needle or a list of needles into a list of Pattern"""
+    if isinstance(needles, (Pattern, np.ndarray)):
+        needles = [needles]
+    return [needle if isinstance(needle, Pattern) else Pattern(needle)
+            for needle in needles]
+
+
+def block_ranges(start, count, needles, block_size=BLOCK_SIZE):
+    """Yields the (offset, frames) haystack ranges correlation_blocks()
+    reads for count frames from start, in order"""
+    patterns = as_patterns(needles)
+    longest = max(pattern.length for pattern in patterns)
+    shortest = min(pattern.length for pattern in patterns)
+    end = start + count
+    wanted = block_size + longest - 1
+
+    position = start
+    while position + shortest <= end:
+        yield position, min(wanted, end - position)
+        if end - position < wanted:
+            return
+        position += block_size
+
+
+def correlation_blocks(read, start, count, needles, block_size=BLOCK_SIZE,
+                       correlate=correlations):
+    """Correlates one or more needles with count haystack frames starting
+    at start, block by block. read(offset, n) must return up to n haystack
+    samples from offset. Every block is read and transformed once for all
+    needles. correlate computes the values of a block, it has the
+    signature of correlations(). Yields (offset, pattern, values) for
+    each block and pattern"""
+    patterns = as_patterns(needles)
+    longest = max(pattern.length for pattern in patterns)
+    shortest = min(pattern.length for pattern in patterns)
+    nfft = fft_length(longest)
+    wanted = block_size + longest - 1
+
+    for position, frames in block_ranges(start, count, patterns, block_size):
+        block = read(position, frames)
+        if len(block) < shortest:
+            break
+        # the last block carries the offsets only shorter needles reach
+        final = len(block) < wanted
+        values = iter(correlate(block, patterns, nfft,
+                                None if final else block_size))
+        for pattern in patterns:
+            yield position, pattern, next(values)
+        metrics.add('correlated_frames', min(block_size,
+                                             len(block) - shortest + 1))
+        if final:
+            break
+
+
+def find(read, start, count, needles, threshold, block_size=BLOCK_SIZE,
+         correlate=correlations):
+    """Yields (pattern, offsets, values) of all correlation values above
+    threshold, block by block"""
+    for offset, pattern, values in correlation_blocks(read, start, count,
+                                                      needles, block_size,
+                                                      correlate):
+        idxs = np.where(values > threshold)[0]
+        if len(idxs):
+            yield pattern, idxs + offset, values[idxs]
+
+
+def pattern_paths(paths, wildcard='*'):
+    """Expands directories in paths into the files within them whose
+    names match wildcard"""
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            result += sorted(name for name in glob.glob(
+                os.path.join(path, wildcard)) if os.path.isfile(name))
+        else:
+            result.append(path)
+    return result